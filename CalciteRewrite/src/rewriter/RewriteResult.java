@@ -11,6 +11,7 @@ public class RewriteResult {
     public RelNode r2 = null;
     public RelNode r3 = null;
     public String sql = null;
+    public Double cost = null;
 
     public Long time = null;
 }
@@ -1,6 +1,7 @@
 package rewriter;
 
 import com.google.common.collect.ImmutableSet;
+import org.apache.calcite.plan.RelOptCost;
 import org.apache.calcite.plan.RelOptRule;
 import org.apache.calcite.plan.hep.HepMatchOrder;
 import org.apache.calcite.plan.hep.HepPlanner;
@@ -9,6 +10,7 @@ import org.apache.calcite.rel.RelNode;
 import org.apache.calcite.rel.RelVisitor;
 import org.apache.calcite.rel.core.RelFactories;
 import org.apache.calcite.rel.logical.LogicalFilter;
+import org.apache.calcite.rel.metadata.RelMetadataQuery;
 import org.apache.calcite.rel.rel2sql.RelToSqlConverter;
 import org.apache.calcite.rel.rules.CoreRules;
 import org.apache.calcite.sql.pretty.SqlPrettyWriter;
@@ -56,8 +58,7 @@ public class Rewriter {
         }
     }
 
-    private static List<Map<String, String>> matchRules(String sql, List<String> createTables, Map<String, RelOptRule> ruleSet, String database, boolean verbose) {
-        RelOptFixture fixture = inputSql(sql, createTables, database);
+    private static List<Map<String, String>> matchRules(RelOptFixture fixture, Map<String, RelOptRule> ruleSet, String database, boolean verbose) {
         List<Map<String, String>> matchRules = new ArrayList<>();
         try {
             RelNode relBefore = fixture.toRel();
@@ -109,26 +110,45 @@ public class Rewriter {
         return matchRules;
     }
 
-    public static List<Map<String, String>> matchExploreRules(String sql, List<String> createTables, String database, boolean verbose) {
-        return matchRules(sql, createTables, EXPLORE_RULES, database, verbose);
-    }
-
-    public static List<Map<String, String>> matchNormalRules(String sql, List<String> createTables, String database, boolean verbose) {
-        return matchRules(sql, createTables, NORMAL_RULES, database, verbose);
-    }
-
-    public static List<Map<String, String>> matchAllRules(String sql, List<String> createTables, String database, boolean verbose) {
-        List<Map<String, String>> normalRules = matchNormalRules(sql, createTables, database, verbose);
+    private static List<Map<String, String>> matchAllRules(RelOptFixture fixture, String database, boolean verbose) {
+        List<Map<String, String>> normalRules = matchRules(fixture, NORMAL_RULES, database, verbose);
         normalRules.forEach(r -> {
             r.put("type", "normal");
         });
-        List<Map<String, String>> exploreRules = matchExploreRules(sql, createTables, database, verbose);
+        List<Map<String, String>> exploreRules = matchRules(fixture, EXPLORE_RULES, database, verbose);
         exploreRules.forEach(r -> {
             r.put("type", "explore");
         });
         return Stream.concat(normalRules.stream(), exploreRules.stream()).collect(Collectors.toList());
     }
 
+    public static List<Map<String, String>> matchExploreRules(String sql, List<String> createTables, String database, boolean verbose) {
+        return matchRules(inputSql(sql, createTables, database), EXPLORE_RULES, database, verbose);
+    }
+
+    public static List<Map<String, String>> matchNormalRules(String sql, List<String> createTables, String database, boolean verbose) {
+        return matchRules(inputSql(sql, createTables, database), NORMAL_RULES, database, verbose);
+    }
+
+    public static List<Map<String, String>> matchAllRules(String sql, List<String> createTables, String database, boolean verbose) {
+        return matchAllRules(inputSql(sql, createTables, database), database, verbose);
+    }
+
+    public static List<Map<String, String>> matchExploreRules(String sql, int schemaId, boolean verbose) {
+        final String database = getSchema(schemaId).database;
+        return matchRules(inputSql(sql, schemaId), EXPLORE_RULES, database, verbose);
+    }
+
+    public static List<Map<String, String>> matchNormalRules(String sql, int schemaId, boolean verbose) {
+        final String database = getSchema(schemaId).database;
+        return matchRules(inputSql(sql, schemaId), NORMAL_RULES, database, verbose);
+    }
+
+    public static List<Map<String, String>> matchAllRules(String sql, int schemaId, boolean verbose) {
+        final String database = getSchema(schemaId).database;
+        return matchAllRules(inputSql(sql, schemaId), database, verbose);
+    }
+
     private static void _rewrite(RewriteResult res, List<String> ruleNames, int rounds, RelOptFixture fixture) {
         for  (int i = 0; i < rounds; i ++) {
             for (String ruleName: ruleNames) {
@@ -168,7 +188,15 @@ public class Rewriter {
 
     public static List<RewriteResult> traverseRewrite(String sql, List<String> createTables, List<String> ruleNames, int rounds, String database) {
         long startTime = System.currentTimeMillis();
-        RelOptFixture fixture = inputSql(sql, createTables, database);
+        return traverseRewrite(inputSql(sql, createTables, database), ruleNames, rounds, database, startTime);
+    }
+
+    public static List<RewriteResult> traverseRewrite(String sql, int schemaId, List<String> ruleNames, int rounds) {
+        long startTime = System.currentTimeMillis();
+        return traverseRewrite(inputSql(sql, schemaId), ruleNames, rounds, getSchema(schemaId).database, startTime);
+    }
+
+    private static List<RewriteResult> traverseRewrite(RelOptFixture fixture, List<String> ruleNames, int rounds, String database, long startTime) {
         List<List<RewriteResult>> midResultsDP = new ArrayList<>();
         try {
             final RelNode r1 = fixture.toRel();
@@ -251,9 +279,134 @@ public class Rewriter {
         return Collections.emptyList();
     }
 
+    private static void _finish(RewriteResult midRes, int rounds, String database, RelOptFixture fixture) {
+        midRes.r3 = midRes.r2;
+        for (int i = 0; i < rounds; i ++) {
+            try {
+                HepProgramBuilder builder = new HepProgramBuilder();
+                PRUNE_EMPTY_RULES.forEach(builder::addRuleInstance);
+                HepPlanner hepPlanner = new HepPlanner(builder.addMatchOrder(HepMatchOrder.TOP_DOWN).build());
+                midRes.r3 = fixture
+                        .withPlanner(hepPlanner)
+                        .findBest(midRes.r3);
+            } catch (Exception ignored) {
+                break;
+            }
+        }
+
+        try {
+            midRes.sql = outputSql(
+                    (new SqlPrettyWriter()).format(
+                            (new RelToSqlConverter(getProduct(database).getDialect())).visitRoot(midRes.r3).asStatement()
+                    )
+            );
+        } catch (Exception e) {
+            // e.printStackTrace();
+        }
+    }
+
+    /**
+     * Cumulative cost as (rows, cpu, io), compared in that order. Rows come first as in VolcanoCost.isLt,
+     * which compares nothing else; cpu and io break the ties between rewrites with the same row estimate.
+     */
+    private static double[] estimateCost(RelNode rel) {
+        try {
+            final RelMetadataQuery mq = rel.getCluster().getMetadataQuery();
+            final RelOptCost cost = mq.getCumulativeCost(rel);
+            if (cost != null && !cost.isInfinite()) {
+                return new double[] {cost.getRows(), cost.getCpu(), cost.getIo()};
+            }
+        } catch (Exception ignored) {}
+        return new double[] {Double.MAX_VALUE, Double.MAX_VALUE, Double.MAX_VALUE};
+    }
+
+    public static List<RewriteResult> searchRewrite(String sql, int schemaId, List<String> ruleNames, int rounds, int beamWidth, long timeout) {
+        long startTime = System.currentTimeMillis();
+        return searchRewrite(inputSql(sql, schemaId), ruleNames, rounds, beamWidth, timeout, getSchema(schemaId).database, startTime);
+    }
+
+    /**
+     * Beam search over rule orderings. Like traverseRewrite, each rule is used at most once per
+     * sequence, but a sequence is only extended if its last rule changed the plan, plans reached by
+     * several orderings are expanded once, and each level keeps the beamWidth cheapest plans by
+     * Calcite's cumulative cost. Expansion stops after timeout milliseconds (non-positive for none);
+     * SQL is only generated for the kept sequences.
+     */
+    private static List<RewriteResult> searchRewrite(RelOptFixture fixture, List<String> ruleNames, int rounds, int beamWidth, long timeout, String database, long startTime) {
+        List<RewriteResult> results = new ArrayList<>();
+        try {
+            final RelNode r1 = fixture.toRel();
+            RelNode r2 = r1;
+            try {
+                r2 = fixture
+                        .withRule(
+                                CoreRules.PROJECT_TO_SEMI_JOIN,
+                                CoreRules.JOIN_ON_UNIQUE_TO_SEMI_JOIN,
+                                CoreRules.JOIN_TO_SEMI_JOIN
+                        )
+                        .findBest(r1);
+            } catch (Exception ignored) {}
+            RewriteResult iniRes = new RewriteResult();
+            iniRes.r1 = r1;
+            iniRes.r2 = r2;
+            final Set<String> seen = new HashSet<>();
+            seen.add(explain(r2));
+            final Map<RewriteResult, double[]> costs = new IdentityHashMap<>();
+            List<RewriteResult> frontier = List.of(iniRes);
+            search:
+            for (int depth = 1; depth <= ruleNames.size() && !frontier.isEmpty(); depth ++) {
+                List<RewriteResult> candidates = new ArrayList<>();
+                for (RewriteResult pre: frontier) {
+                    for (String rule: ruleNames) {
+                        if (timeout > 0 && System.currentTimeMillis() - startTime > timeout) {
+                            break search;
+                        }
+                        if (pre.rules.contains(rule)) {
+                            continue;
+                        }
+                        RewriteResult midRes = new RewriteResult();
+                        midRes.r1 = pre.r1;
+                        midRes.r2 = pre.r2;
+                        midRes.rules = new ArrayList<>(pre.rules);
+                        _rewrite(midRes, List.of(rule), rounds, fixture);
+                        if (midRes.r2 == pre.r2 || !seen.add(explain(midRes.r2))) {
+                            continue;
+                        }
+                        final double[] cost = estimateCost(midRes.r2);
+                        costs.put(midRes, cost);
+                        midRes.cost = cost[0];
+                        candidates.add(midRes);
+                    }
+                }
+                candidates.sort((a, b) -> Arrays.compare(costs.get(a), costs.get(b)));
+                frontier = candidates.subList(0, Math.min(beamWidth, candidates.size()));
+                results.addAll(frontier);
+            }
+
+            for (RewriteResult midRes: results) {
+                _finish(midRes, rounds, database, fixture);
+            }
+            long time = System.currentTimeMillis() - startTime;
+            results.forEach(r -> {
+                r.time = time;
+            });
+        } catch(Exception e) {
+            // e.printStackTrace();
+        }
+        return results;
+    }
+
     public static RewriteResult rewrite(String sql, List<String> createTables, List<String> ruleNames, int rounds, String database) {
         long startTime = System.currentTimeMillis();
-        RelOptFixture fixture = inputSql(sql, createTables, database);
+        return rewrite(inputSql(sql, createTables, database), ruleNames, rounds, database, startTime);
+    }
+
+    public static RewriteResult rewrite(String sql, int schemaId, List<String> ruleNames, int rounds) {
+        long startTime = System.currentTimeMillis();
+        return rewrite(inputSql(sql, schemaId), ruleNames, rounds, getSchema(schemaId).database, startTime);
+    }
+
+    private static RewriteResult rewrite(RelOptFixture fixture, List<String> ruleNames, int rounds, String database, long startTime) {
         RewriteResult res = new RewriteResult();
         try {
             res.r1 = fixture.toRel();
@@ -295,7 +448,7 @@ public class Rewriter {
                         && ruleNames.contains("JOIN_TO_CORRELATE")) {
                     List<String> debugRuleNames = new ArrayList<>(ruleNames);
                     debugRuleNames.remove("JOIN_TO_CORRELATE");
-                    res = rewrite(sql, createTables, debugRuleNames, rounds, database);
+                    res = rewrite(fixture, debugRuleNames, rounds, database, startTime);
                 } else {
                      e.printStackTrace();
                 }
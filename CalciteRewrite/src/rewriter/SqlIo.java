@@ -6,10 +6,13 @@ import com.alibaba.innodb.java.reader.schema.provider.impl.SqlTableDefProvider;
 import org.apache.calcite.avatica.util.Casing;
 import org.apache.calcite.config.CalciteConnectionConfig;
 import org.apache.calcite.plan.Contexts;
+import org.apache.calcite.rel.type.RelDataTypeFactory;
 import org.apache.calcite.sql.SqlDialect;
 import org.apache.calcite.sql.dialect.PostgresqlSqlDialect;
 import org.apache.calcite.sql.fun.SqlLibrary;
 import org.apache.calcite.sql.fun.SqlLibraryOperatorTableFactory;
+import org.apache.calcite.sql.test.SqlTestFactory;
+import org.apache.calcite.sql.validate.SqlValidatorCatalogReader;
 import org.apache.calcite.test.RelOptFixture;
 import org.apache.calcite.test.catalog.MyMockCatalogReader;
 
@@ -98,12 +101,81 @@ public class SqlIo {
             return SqlDialect.DatabaseProduct.UNKNOWN;
         }
     }
-    public static RelOptFixture inputSql(String sql, List<String> createTables, String database) {
+    /** A registered schema: its parsed table definitions, catalog readers and the fixture configured for them. */
+    public static class Schema {
+        public final String database;
+        public final Map<String, TableDef> tables;
+        public final RelOptFixture fixture;
+        private final Map<RelDataTypeFactory, SqlValidatorCatalogReader> catalogReaders = Collections.synchronizedMap(new WeakHashMap<>());
+
+        Schema(List<String> createTables, String database) {
+            this.database = database;
+            this.tables = new SqlTableDefProvider(createTables).load();
+            this.fixture = schemaFixture(this::catalogReader, database);
+        }
+
+        /** The catalog reader over these tables, built once per type factory rather than per call. */
+        SqlValidatorCatalogReader catalogReader(RelDataTypeFactory typeFactory, boolean caseSensitive) {
+            final Map<String, TableDef> tableDefs = tables;
+            return catalogReaders.computeIfAbsent(typeFactory, f ->
+                    new MyMockCatalogReader(f, caseSensitive) {
+                        @Override protected Map<String, TableInfo> initTables() {
+                            final Map<String, TableInfo> tableInfoMap = new HashMap<>();
+                            tableInfoMap.put("SALES", new TableInfo(tableDefs));
+                            return tableInfoMap;
+                        }
+                    }.init());
+        }
+    }
+
+    private static final Map<String, Integer> SCHEMA_IDS = new HashMap<>();
+    private static final List<Schema> SCHEMAS = new ArrayList<>();
+
+    /** Parses the CREATE TABLE statements once and returns a handle for the matching and rewrite calls. */
+    public static synchronized int registerSchema(List<String> createTables, String database) {
+        final String key = database + "\u0000" + String.join("\u0000", createTables);
+        Integer schemaId = SCHEMA_IDS.get(key);
+        if (schemaId == null) {
+            schemaId = SCHEMAS.size();
+            SCHEMAS.add(new Schema(createTables, database));
+            SCHEMA_IDS.put(key, schemaId);
+        }
+        return schemaId;
+    }
+
+    public static synchronized Schema getSchema(int schemaId) {
+        if (schemaId < 0 || schemaId >= SCHEMAS.size()) {
+            throw new IllegalArgumentException("Unknown schema id: " + schemaId);
+        }
+        return SCHEMAS.get(schemaId);
+    }
+
+    private static String cleanSql(String sql) {
         sql = sql.replace(";", "");
         sql = sql.replaceAll("--.*?\\n", " ");
         sql = sql.replaceAll("\\n", " ");
         sql = sql.replaceAll("!=", "<>");
-        return RelOptFixture.DEFAULT.sql(sql)
+        return sql;
+    }
+
+    private static RelOptFixture schemaFixture(SqlTestFactory.CatalogReaderFactory catalogReaderFactory, String database) {
+        return RelOptFixture.DEFAULT
+                .withCatalogReaderFactory(catalogReaderFactory)
+                .withFactory(f -> f.withOperatorTable(opTab ->
+                                SqlLibraryOperatorTableFactory.INSTANCE.getOperatorTable(
+                                        SqlLibrary.STANDARD, getOperatorTable(database)))
+                        .withParserConfig(parserConfig -> getProduct(database).getDialect().configureParser(parserConfig).withCaseSensitive(false))
+                )
+                .withContext(c -> Contexts.of(CalciteConnectionConfig.DEFAULT, c));
+    }
+
+    public static RelOptFixture inputSql(String sql, int schemaId) {
+        return getSchema(schemaId).fixture.sql(cleanSql(sql));
+    }
+
+    public static RelOptFixture inputSql(String sql, List<String> createTables, String database) {
+        // parses the schema on every call, registered schemas reuse their table definitions
+        return RelOptFixture.DEFAULT.sql(cleanSql(sql))
                 .withCatalogReaderFactory((typeFactory, caseSensitive) ->
                         new MyMockCatalogReader(typeFactory, caseSensitive) {
                             @Override protected Map<String, TableInfo> initTables() {
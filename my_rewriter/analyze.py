@@ -8,14 +8,16 @@ import json
 import typing as t
 import argparse
 import re
+import ast
 from collections import defaultdict
 import sys
 
 sys.path.append('..')
 from my_rewriter.database import DBArgs, Database
-from my_rewriter.config import init_db_config, init_llms
-from my_rewriter.db_utils import compare, actual_time, actual_time_once
-from my_rewriter.my_utils import MyModel
+from my_rewriter.config import init_db_config, init_llms, LATENCY_WORKERS, LATENCY_ISOLATION
+from my_rewriter.db_utils import compare, actual_time_once
+from my_rewriter.latency import LATENCY_ISOLATION_MODES, RACE_MODES, measure_latencies, compare_latencies, race_latencies
+from my_rewriter.query_trace import TRACE_SUFFIX, read_trace
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--compute_latency', action='store_true', required=False, help='whether to compute SQL latency')
@@ -23,6 +25,10 @@ parser.add_argument('--database', type=str, required=True)
 parser.add_argument('--logdir', type=str, default='logs')
 parser.add_argument('--large', action='store_true', required=False, help='whether to execute SQL queries on large database')
 parser.add_argument('--no_reflection', action='store_true', required=False, help='whether to reflect query rewrite')
+parser.add_argument('--latency_workers', type=int, default=LATENCY_WORKERS, help='number of queries whose latency is measured concurrently')
+parser.add_argument('--latency_isolation', type=str, default=LATENCY_ISOLATION, choices=LATENCY_ISOLATION_MODES, help='which latency measurements may overlap')
+parser.add_argument('--adaptive_latency', action='store_true', required=False, help='sample each query and its rewrites until their difference is decided, cancelling clearly slower rewrites')
+parser.add_argument('--race', type=str, default='off', choices=['off'] + RACE_MODES, help='with --large, race each query against its rewrites and cancel the runs that fall behind')
 args = parser.parse_args()
 
 model_args = init_llms(args.logdir, load_model=False)
@@ -48,13 +54,54 @@ def is_improved(t: t.Dict, idx: int, compute_latency: bool) -> bool:
         if compute_latency:
             if args.large:
                 return t['input_latency'] > t['rewrites'][idx]['output_latency']
+            elif 'output_improved' in t['rewrites'][idx]:
+                return t['rewrites'][idx]['output_improved']
             else:
                 return compare(t['input_var'], t['rewrites'][idx]['output_var'])
         else:
             return t['input_cost'] > t['rewrites'][idx]['output_cost']
     return False
 
-def _analyze(name: str, input_latency: float) -> dict:
+def _check_rewrites(rewrite_res: t.List[dict]):
+    if 'no_steps' in args.logdir or args.no_reflection:
+        assert len(rewrite_res) == 1
+    else:
+        assert len(rewrite_res) == 2
+
+def _analyze_trace(trace_filename: str) -> dict:
+    span_ns = defaultdict(int)
+    input_cost = None
+    rewrite_res = []
+    llm = {'calls': 0, 'cached': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+    for event in read_trace(trace_filename):
+        if event['kind'] == 'span':
+            span_ns[event['name']] += event['end_ns'] - event['start_ns']
+            if event['name'] == 'input_cost':
+                input_cost = event.get('cost')
+        elif event['kind'] == 'rewrite':
+            res = {k: event[k] for k in ['used_rules', 'output_sql', 'output_cost', 'time']}
+            if res['output_cost'] == -1:
+                res['output_cost'] = float("inf")
+            if event.get('cached'):
+                res['cached'] = True
+            rewrite_res.append(res)
+        elif event['kind'] == 'llm':
+            llm['calls'] += 1
+            llm['cached'] += int(event['cached'])
+            llm['prompt_tokens'] += event.get('prompt_tokens', 0)
+            llm['completion_tokens'] += event.get('completion_tokens', 0)
+    if args.no_reflection:
+        rewrite_res = rewrite_res[:1]
+    _check_rewrites(rewrite_res)
+
+    retrieval_time = span_ns['retrieval'] / 1e6
+    arrange_time = (span_ns['summarize_strategies'] + span_ns['select_rules'] + span_ns['arrange_rules'] + (span_ns['rearrange_rules'] if len(rewrite_res) == 2 else 0)) / 1e6
+    rewrite_time = sum([res['time'] for res in rewrite_res])
+
+    return {'input_cost': input_cost, 'time': {'retrieval': retrieval_time, 'arrange': arrange_time, 'rewrite': rewrite_time}, 'rewrites': rewrite_res, 'llm': llm}
+
+def _analyze(name: str) -> dict:
+    # logs of runs that predate query traces, timed from the log lines at second granularity
     log_filename = f'{LOG_DIR}/{name}.log'
     
     retrieval_start = None
@@ -64,7 +111,6 @@ def _analyze(name: str, input_latency: float) -> dict:
     arrange_end = None
     rearrange_time = None
     rewrite_res = []
-    model = MyModel(model_args)
     with open(log_filename, 'r') as f:
         lines = list(f.readlines())
         retrieval_start = lines[0].split(',')[0]
@@ -86,36 +132,20 @@ def _analyze(name: str, input_latency: float) -> dict:
                 arrange_end = line.split(',')[0]
                 arrange_end = datetime.strptime(arrange_end, '%H:%M:%S')
             elif 'root DEBUG {\'messages\'' in line:
-                obj = eval(line[line.find('{'):])
-                if obj['messages'][0]['content'] == model.REARRANGE_RULES_SYS_PROMPT:
+                obj = ast.literal_eval(line[line.find('{'):])
+                if obj['messages'][0]['content'] == model_args['REARRANGE_RULES_SYS_PROMPT']:
                     rearrange_time = obj['time']
             elif 'root INFO Rewrite Execution Results' in line:
-                res = eval(line[line.find('{'):])
+                res = ast.literal_eval(line[line.find('{'):])
                 db = Database(pg_args)
                 res['output_cost'] = db.cost_estimation(res['output_sql'])
                 if res['output_cost'] == -1:
                     res['output_cost'] = float("inf")
-                if args.compute_latency:
-                    if res['output_sql'] == 'None':
-                        res['output_latency'] = input_latency
-                        if not args.large:
-                            res['output_var'] = [input_latency] * 5
-                    else:
-                        if args.large:
-                            output_latency = actual_time_once(res['output_sql'], pg_args, 3600)
-                        else:
-                            output_latency, output_var = actual_time(res['output_sql'], pg_args, 300)
-                        res['output_latency'] = output_latency
-                        if not args.large:
-                            res['output_var'] = output_var
                 rewrite_res.append(res)
                 if len(rewrite_res) == 1 and args.no_reflection:
                     break
 
-    if 'no_steps' in args.logdir or args.no_reflection:
-        assert len(rewrite_res) == 1
-    else:
-        assert len(rewrite_res) == 2
+    _check_rewrites(rewrite_res)
     
     retrieval_time = (retrieval_end - retrieval_start).seconds * 1000
     arrange_time = (((arrange_first_end - retrieval_end).seconds if arrange_first_end is not None else 0) + (arrange_end - arrange_second_start).seconds + (rearrange_time if len(rewrite_res) == 2 else 0)) * 1000
@@ -125,22 +155,25 @@ def _analyze(name: str, input_latency: float) -> dict:
     return rewrite_obj
 
 def analyze(query: str, name: str) -> dict:
-    db = Database(pg_args)
-    input_cost = db.cost_estimation(query)
+    trace_filename = f'{LOG_DIR}/{name}{TRACE_SUFFIX}'
+    if os.path.exists(trace_filename):
+        rewrite_obj = _analyze_trace(trace_filename)
+        input_cost = rewrite_obj['input_cost']
+        if input_cost is None:
+            # a trace of a run that failed before the input cost was estimated
+            logging.warning(f'No input cost in {trace_filename}, estimating it again')
+            input_cost = Database(pg_args).cost_estimation(query)
+    else:
+        rewrite_obj = _analyze(name)
+        input_cost = Database(pg_args).cost_estimation(query)
     if input_cost == -1:
         input_cost = float("inf")
-    if args.compute_latency:
-        if args.large:
-            input_latency = actual_time_once(query, pg_args, 3600)
-        else:
-            input_latency, input_var = actual_time(query, pg_args, 300)
     final_res = {'template': name, 'input_sql': query, 'input_cost': input_cost, 'time': {'retrieval': 0, 'arrange': 0, 'rewrite': 0}, 'rewrites': []}
-    if args.compute_latency:
-        final_res['input_latency'] = input_latency
-        if not args.large:
-            final_res['input_var'] = input_var
-    rewrite_obj = _analyze(name, input_latency=input_latency if args.compute_latency else None)
+    if 'llm' in rewrite_obj:
+        final_res['llm'] = rewrite_obj['llm']
     final_res['rewrites'].extend(rewrite_obj['rewrites'])
+    # rewrites served from the rewrite cache took no Calcite time in this run
+    final_res['rewrite_cached'] = any([r.get('cached', False) for r in final_res['rewrites']])
     final_res['time']['retrieval'] += rewrite_obj['time']['retrieval']
     final_res['time']['arrange'] += rewrite_obj['time']['arrange']
     final_res['time']['rewrite'] += rewrite_obj['time']['rewrite']
@@ -148,6 +181,54 @@ def analyze(query: str, name: str) -> dict:
     final_res['best_index'] = best_idx
     return final_res
 
+def compute_latencies(template_rewrites: t.List[dict]):
+    # a second pass, so that all inputs and rewrites are measured in one interleaved schedule
+    comparisons = {}
+    sqls = []
+    for t in template_rewrites:
+        sqls.append(t['input_sql'])
+        sqls.extend([r['output_sql'] for r in t['rewrites'] if r['output_sql'] != 'None'])
+    if args.large and args.race != 'off':
+        latencies = {}
+        for t in template_rewrites:
+            output_sqls = [r['output_sql'] for r in t['rewrites'] if r['output_sql'] != 'None']
+            raced = race_latencies([t['input_sql']] + output_sqls, pg_args, 3600, mode=args.race)
+            for sql, res in raced.items():
+                latencies[sql] = (res['time'], None)
+                comparisons[(t['input_sql'], sql)] = {'censored': res['censored']}
+    elif args.large:
+        latencies = {sql: (actual_time_once(sql, pg_args, 3600), None) for sql in dict.fromkeys(sqls)}
+    elif args.adaptive_latency:
+        pairs = [(t['input_sql'], [r['output_sql'] for r in t['rewrites'] if r['output_sql'] != 'None']) for t in template_rewrites]
+        latencies = {}
+        for (input_sql, _), (input_res, output_res) in zip(pairs, compare_latencies(pairs, pg_args, 300, workers=args.latency_workers, isolation=args.latency_isolation)):
+            latencies[input_sql] = input_res
+            for output_sql, res in output_res.items():
+                latencies[output_sql] = (res['time'], res['times'])
+                comparisons[(input_sql, output_sql)] = res
+    else:
+        latencies = measure_latencies(sqls, pg_args, 300, workers=args.latency_workers, isolation=args.latency_isolation)
+    for t in template_rewrites:
+        input_latency, input_var = latencies[t['input_sql']]
+        t['input_latency'] = input_latency
+        if not args.large:
+            t['input_var'] = input_var
+        if (t['input_sql'], t['input_sql']) in comparisons:
+            t['input_censored'] = comparisons[(t['input_sql'], t['input_sql'])]['censored']
+        for res in t['rewrites']:
+            if res['output_sql'] == 'None':
+                res['output_latency'] = input_latency
+                if not args.large:
+                    res['output_var'] = [input_latency] * 5
+            else:
+                res['output_latency'], output_var = latencies[res['output_sql']]
+                if not args.large:
+                    res['output_var'] = output_var
+                if (t['input_sql'], res['output_sql']) in comparisons:
+                    res['output_censored'] = comparisons[(t['input_sql'], res['output_sql'])]['censored']
+                    if 'improved' in comparisons[(t['input_sql'], res['output_sql'])]:
+                        res['output_improved'] = comparisons[(t['input_sql'], res['output_sql'])]['improved']
+
 schema_path = os.path.join('..', DATASET, 'create_tables.sql')
 schema = open(schema_path, 'r').read()
 
@@ -185,6 +266,9 @@ else:
                 rewrite_obj = analyze(query, name)
                 template_rewrites.append(rewrite_obj)
 
+if args.compute_latency:
+    compute_latencies(template_rewrites)
+
 input_attr = 'input_latency' if args.compute_latency else 'input_cost'
 output_attr = 'output_latency' if args.compute_latency else 'output_cost'
 
@@ -218,12 +302,19 @@ logging.info(f'95th Percentile Input: {input_latency_95th}')
 
 average_retrieval = sum([t['time']['retrieval'] for t in template_rewrites]) / len(template_rewrites)
 average_arrange = sum([t['time']['arrange'] for t in template_rewrites]) / len(template_rewrites)
-average_rewrite = sum([t['time']['rewrite'] for t in template_rewrites]) / len(template_rewrites)
+timed_rewrites = [t for t in template_rewrites if not t.get('rewrite_cached', False)]
+average_rewrite = sum([t['time']['rewrite'] for t in timed_rewrites]) / len(timed_rewrites) if timed_rewrites else 0.0
 logging.info(f'Average Retrieval Time: {average_retrieval}')
 logging.info(f'Average Arrange Time: {average_arrange}')
-logging.info(f'Average Rewrite Time: {average_rewrite}')
+logging.info(f'Average Rewrite Time: {average_rewrite} ({len(template_rewrites) - len(timed_rewrites)} queries with cached rewrites excluded)')
 logging.info(f'Average Total Time: {average_retrieval + average_arrange + average_rewrite}')
 
+traced = [t['llm'] for t in template_rewrites if 'llm' in t]
+if traced:
+    logging.info(f'Average LLM Calls: {sum([llm["calls"] for llm in traced]) / len(traced)} ({sum([llm["cached"] for llm in traced]) / len(traced)} cached)')
+    logging.info(f'Average LLM Prompt Tokens: {sum([llm["prompt_tokens"] for llm in traced]) / len(traced)}')
+    logging.info(f'Average LLM Completion Tokens: {sum([llm["completion_tokens"] for llm in traced]) / len(traced)}')
+
 if args.large:
     overall_latencies = [t['time']['retrieval'] + t['time']['arrange'] + t['time']['rewrite'] + o for t, o in zip(template_rewrites, output_latencies)]
 
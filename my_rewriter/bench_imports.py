@@ -0,0 +1,47 @@
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+from prettytable import PrettyTable
+
+# entry points of analysis-only, retrieval-only and full rewrite runs
+MODULES = ['my_rewriter.config', 'my_rewriter.db_utils', 'my_rewriter.database', 'rag.nl_rules', 'rag.gen_rewrites_from_rules', 'my_rewriter.my_utils', 'my_rewriter.rag_retrieve', 'my_rewriter.test_utils']
+# subsystems that should only be initialized on first use
+SUBSYSTEMS = ['llama_index.core', 'chromadb', 'scipy', 'openai']
+
+PROBE = '''
+import sys
+import time
+import json
+sys.path.append('..')
+start = time.perf_counter()
+__import__({module!r})
+elapsed = time.perf_counter() - start
+loaded = [m for m in {subsystems!r} if m in sys.modules]
+if 'jpype' in sys.modules and sys.modules['jpype'].isJVMStarted():
+    loaded.append('jvm')
+if 'rag.nl_rules' in sys.modules and sys.modules['rag.nl_rules'].get_rule_functions.cache_info().currsize > 0:
+    loaded.append('rule_kb')
+print(json.dumps({{'time': elapsed, 'loaded': loaded}}))
+'''
+
+def probe(module: str) -> dict:
+    # a fresh interpreter per measurement, so nothing is already imported
+    out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, subsystems=SUBSYSTEMS)], capture_output=True, text=True)
+    if out.returncode != 0:
+        return {'time': float('nan'), 'loaded': [out.stderr.strip().split('\n')[-1]]}
+    return json.loads(out.stdout.strip().split('\n')[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    table = PrettyTable(['Module', 'Import Time (s)', 'Initialized'])
+    for module in args.modules:
+        results = [probe(module) for _ in range(args.repeat)]
+        table.add_row([module, round(statistics.median([r['time'] for r in results]), 3), ', '.join(results[-1]['loaded'])])
+    print(table)
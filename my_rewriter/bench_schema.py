@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+import logging
+import argparse
+
+sys.path.append('..')
+from my_rewriter.rewrite import java_class, to_java_string, to_java_list, to_java_int, to_java_bool, to_python_list, split_schema, register_schema, match_all_rules, rewrite
+from rag.bench_nl_rules import load_queries
+
+def match_all_rules_uncached(query: str, schema: str, database: str = 'PostgreSQL'):
+    # the pre-handle path: split the schema and rebuild the catalog on every call
+    create_tables = [x for x in schema.split(';') if x.strip() != '']
+    return to_python_list(java_class('Rewriter').matchAllRules(to_java_string(query), to_java_list(create_tables), to_java_string(database), to_java_bool(False)))
+
+def rewrite_uncached(query: str, schema: str, rule_names, rounds: int = 1, database: str = 'PostgreSQL'):
+    create_tables = [x for x in schema.split(';') if x.strip() != '']
+    return java_class('Rewriter').rewrite(to_java_string(query), to_java_list(create_tables), to_java_list(rule_names), to_java_int(rounds), to_java_string(database))
+
+def timed(fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = fn()
+    return (time.perf_counter() - start) / repeat * 1000, res
+
+def summary(name: str, ms):
+    ms = sorted(ms)
+    print(f'  {name}: total {sum(ms):.1f} ms, median {ms[len(ms) // 2]:.2f} ms, max {ms[-1]:.2f} ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='dsb')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    schema = open(os.path.join('..', args.dataset, 'create_tables.sql'), 'r').read()
+    queries = load_queries(args.dataset)
+    start = time.perf_counter()
+    register_schema(split_schema(schema))
+    print(f'{args.dataset}: {len(queries)} queries, schema registered in {(time.perf_counter() - start) * 1000:.1f} ms')
+    # warm up the JVM so that neither path pays for class loading and JIT
+    match_all_rules(queries[0], split_schema(schema), verbose=False)
+    match_all_rules_uncached(queries[0], schema)
+
+    match_before, match_after, rewrite_before, rewrite_after = [], [], [], []
+    for query in queries:
+        ms, rules_before = timed(lambda: match_all_rules_uncached(query, schema), args.repeat)
+        match_before.append(ms)
+        ms, rules_after = timed(lambda: match_all_rules(query, split_schema(schema), verbose=False), args.repeat)
+        match_after.append(ms)
+        assert [str(r['name']) for r in rules_before] == [str(r['name']) for r in rules_after], f'Matched rules differ on {query}'
+
+        rule_names = [str(r['name']) for r in rules_after if str(r['type']) == 'normal']
+        ms, res_before = timed(lambda: rewrite_uncached(query, schema, rule_names), args.repeat)
+        rewrite_before.append(ms)
+        ms, res_after = timed(lambda: rewrite(query, split_schema(schema), rule_names, 1), args.repeat)
+        rewrite_after.append(ms)
+        assert str(res_before.sql) == str(res_after.sql), f'Rewrites differ on {query}'
+
+    print('match_all_rules')
+    summary('per-call schema', match_before)
+    summary('schema handle  ', match_after)
+    print(f'  overhead saved per call: {(sum(match_before) - sum(match_after)) / len(queries):.2f} ms')
+    print('rewrite')
+    summary('per-call schema', rewrite_before)
+    summary('schema handle  ', rewrite_after)
+    print(f'  overhead saved per call: {(sum(rewrite_before) - sum(rewrite_after)) / len(queries):.2f} ms')
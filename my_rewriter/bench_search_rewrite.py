@@ -0,0 +1,64 @@
+import sys
+import logging
+import argparse
+
+sys.path.append('..')
+from my_rewriter.rewrite import java_class, to_java_string, to_java_list, to_java_int, to_python_list, split_schema, register_schema, match_normal_rules, match_all_rules, search_rewrite
+from my_rewriter.config import SEARCH_TIMEOUT
+from my_rewriter.bench_schema import timed, summary
+from rag.bench_nl_rules import load_queries
+
+def traverse_rewrite(query: str, schema_id: int, rule_names, rounds: int):
+    return to_python_list(java_class('Rewriter').traverseRewrite(to_java_string(query), to_java_int(schema_id), to_java_list(rule_names), to_java_int(rounds)))
+
+def output_sqls(results) -> set:
+    return {str(r.sql) for r in results if r.sql is not None}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, default='calcite')
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--rules', type=str, default='normal', choices=['normal', 'all'], help="'all' also searches the explore rules, for larger rule sets")
+    parser.add_argument('--max_rules', type=int, default=6, help='queries matching more rules are only searched, traverseRewrite is exponential in them')
+    parser.add_argument('--timeout', type=float, default=SEARCH_TIMEOUT)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    create_tables = split_schema(open(f'../{args.dataset}/create_tables.sql', 'r').read())
+    queries = load_queries(args.dataset)
+    schema_id = register_schema(create_tables)
+    if not hasattr(java_class('Rewriter'), 'searchRewrite'):
+        sys.exit('The loaded jar has no Rewriter.searchRewrite, rebuild CalciteRewrite first')
+    match_rules = match_all_rules if args.rules == 'all' else match_normal_rules
+
+    traverse, search, covered, total = [], [], 0, 0
+    search_only, search_only_rules = [], []
+    for query in queries:
+        rule_names = list(dict.fromkeys([str(r['name']) for r in match_rules(query, create_tables, verbose=False)]))
+        if not rule_names:
+            continue
+        if len(rule_names) > args.max_rules:
+            ms, _ = timed(lambda: search_rewrite(query, create_tables, rule_names, args.rounds, timeout=args.timeout), args.repeat)
+            search_only.append(ms)
+            search_only_rules.append(len(rule_names))
+            continue
+        ms, exhaustive = timed(lambda: traverse_rewrite(query, schema_id, rule_names, args.rounds), args.repeat)
+        traverse.append(ms)
+        ms, beam = timed(lambda: search_rewrite(query, create_tables, rule_names, args.rounds, timeout=None), args.repeat)
+        search.append(ms)
+        # with one round both apply each rule once, so every plan the search keeps is also one the traversal reaches;
+        # with more rounds traverseRewrite drops sequences whose rules fire repeatedly and the search does not
+        if args.rounds == 1:
+            assert output_sqls(beam) <= output_sqls(exhaustive), f'Search produced a rewrite traverseRewrite did not on {query}'
+        covered += len(output_sqls(beam))
+        total += len(output_sqls(exhaustive))
+
+    if traverse:
+        print(f'{args.dataset}: {len(traverse)} queries, search kept {covered} of {total} distinct rewrites')
+        summary('traverse', traverse)
+        summary('search  ', search)
+        print(f'  speedup: {sum(traverse) / sum(search):.2f}x')
+    if search_only:
+        print(f'{len(search_only)} queries with {min(search_only_rules)} to {max(search_only_rules)} rules, search only (timeout {args.timeout} s)')
+        summary('search  ', search_only)
@@ -1,6 +1,7 @@
 import json
 import typing as t
 import jsonlines
+import threading
 
 from my_rewriter.config import CASE_RULES_PATH
 
@@ -10,7 +11,13 @@ with open(CASE_RULES_PATH, 'r') as fin:
         obj = json.loads(line)
         case_rules[f'{obj["id"]}-{obj["answer_id"]}'] = obj["rules"]
 
+case_rules_lock = threading.Lock()
+
 def add_case_rules(cur_case_rules: t.Dict[str, t.List[str]]):
+    with case_rules_lock:
+        _add_case_rules(cur_case_rules)
+
+def _add_case_rules(cur_case_rules: t.Dict[str, t.List[str]]):
     update_case_rules = []
     for idx, rules in cur_case_rules.items():
         if idx not in case_rules:
@@ -1,15 +1,90 @@
-from llama_index.core import Settings
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.llms.openai_like import OpenAILike
+import os
 
 CACHE_PATH = 'cache'
 CASE_RULES_PATH = 'stackoverflow-rewrite-rules-query-optimization.jsonl'
+CHROMA_DB_PATH = '../rag/chroma_db'
+# StackOverflow answers, prebuilt into a memory-mapped docstore that is rebuilt when the JSONL changes.
+DOCSTORE_SOURCE_PATH = '../rag/stackoverflow-rewrite-query-optimization.jsonl'
+DOCSTORE_PATH = '../rag/stackoverflow-rewrite-query-optimization.docstore'
+# Search the hybrid/structure indexes block by block in memory instead of one Chroma query per synthesized query.
+# The search is exact, so its rankings can differ from those of the approximate HNSW search in Chroma.
+BLOCK_RETRIEVAL = False
+
+# Persistent LLM response cache, keyed by (model name, temperature, message hash).
+# 'read_write' reads and writes through the cache, 'replay' only serves cached
+# responses and fails on a miss, 'off' always calls the model.
+LLM_CACHE_PATH = os.path.join(CACHE_PATH, 'llm_cache.sqlite')
+LLM_CACHE_MODE = 'read_write'
+LLM_CACHE_MAX_ENTRIES = 200000
+LLM_CACHE_TTL = None  # seconds, None to keep responses until evicted
+
+# Persistent query embedding cache, one float32 matrix per embedding model.
+EMBEDDING_CACHE_PATH = os.path.join(CACHE_PATH, 'embeddings')
+EMBEDDING_CACHE_ENABLED = True
+
+# Shared scheduler limits applied to every LLM call.
+LLM_MAX_IN_FLIGHT = 16
+LLM_TOKENS_PER_MINUTE = None  # None disables token budgeting
+LLM_MAX_RETRIES = 5
+LLM_BACKOFF_BASE = 1.0  # seconds
+LLM_BACKOFF_MAX = 60.0  # seconds
+
+# Maximum number of statements executed concurrently against one database. Connections are pooled
+# per session settings (statement timeout, index scans), keeping DB_POOL_MIN_SIZE open from the start.
+DB_MAX_CONCURRENCY = 8
+DB_POOL_MIN_SIZE = 1
+
+# Persistent optimizer costs keyed by (database, normalized SQL, session settings, statistics
+# version). The statistics version is re-read at most every DB_STATS_CHECK_INTERVAL seconds.
+COST_CACHE_PATH = os.path.join(CACHE_PATH, 'cost_cache.sqlite')
+COST_CACHE_ENABLED = True
+DB_STATS_CHECK_INTERVAL = 60.0
+
+# Latency measurement: concurrent EXPLAIN ANALYZE workers, isolation ('none', 'tables' keeps
+# queries on the same tables apart, 'serial'), optional CPU sets to pin the workers' backends to
+# (local server only), and runs per query, of which the fastest and slowest are trimmed.
+LATENCY_WORKERS = 1
+LATENCY_ISOLATION = 'tables'
+LATENCY_CPUS = None
+LATENCY_REPEATS = 5
+# Adaptive latency comparison of a query and its rewrites: runs per query, the early-stopping
+# significance level, the relative confidence interval width that is precise enough, and how
+# much slower than the slowest input run a rewrite run may get before it is cancelled.
+ADAPTIVE_MIN_SAMPLES = 3
+ADAPTIVE_MAX_SAMPLES = 10
+ADAPTIVE_ALPHA = 0.01
+ADAPTIVE_REL_WIDTH = 0.05
+ADAPTIVE_CANCEL_FACTOR = 1.5
+# Racing a query against its rewrites on a large database: 'sequential' or 'concurrent', how far
+# behind the best finished run a query may fall before it is cancelled, and the polling interval.
+# Concurrent runs slow each other down, so only sequential races cache their latencies.
+RACE_MODE = 'sequential'
+RACE_MARGIN = 0.1
+RACE_POLL_INTERVAL = 0.05  # seconds
+
+# Process pool for NL rule matching, None matches rules serially in the calling process.
+NL_RULE_WORKERS = None
+NL_RULE_TIMEOUT = 10.0  # seconds per rule and query, None disables the timeout
+
+# Worker processes, each with its own JVM, for Calcite rule matching and rewriting.
+# None calls Calcite in the driver process.
+REWRITE_WORKERS = None
+REWRITE_TIMEOUT = 300.0  # seconds per call, a worker that exceeds it is killed and restarted
+# Beam search over rule orderings: plans kept per sequence length, and the expansion budget.
+SEARCH_BEAM_WIDTH = 8
+SEARCH_TIMEOUT = 60.0  # seconds, None to expand until the rules are exhausted
+
+# Persistent rewrite results keyed by (query, schema, rule sequence, rounds, Calcite build).
+REWRITE_CACHE_PATH = os.path.join(CACHE_PATH, 'rewrite_cache.sqlite')
+REWRITE_CACHE_ENABLED = True
 
 def init_llms(model_type: str = '', load_model=True) -> dict[str, str]:
+    # LLM clients are only imported when they are loaded, analysis runs with load_model=False skip llama_index
+    if load_model:
+        from llama_index.core import Settings
     if 'open' in model_type:
         if load_model:
+            from llama_index.embeddings.huggingface import HuggingFaceEmbedding
             Settings.embed_model = HuggingFaceEmbedding(
                 model_name='gte-Qwen2-1.5B-instruct',
                 max_length=131072
@@ -17,6 +92,7 @@ def init_llms(model_type: str = '', load_model=True) -> dict[str, str]:
         embed_dim = 1536
     else:
         if load_model:
+            from llama_index.embeddings.openai import OpenAIEmbedding
             Settings.embed_model = OpenAIEmbedding(
                 model="text-embedding-3-small"
             )
@@ -24,6 +100,7 @@ def init_llms(model_type: str = '', load_model=True) -> dict[str, str]:
     
     if 'open' in model_type:
         if load_model:
+            from llama_index.llms.openai_like import OpenAILike
             Settings.llm = OpenAILike(
                 model="DeepSeek-R1-Distill-32B",
                 api_key="",
@@ -34,11 +111,13 @@ def init_llms(model_type: str = '', load_model=True) -> dict[str, str]:
             )
     elif 'gpt3' in model_type:
         if load_model:
+            from llama_index.llms.openai import OpenAI
             Settings.llm = OpenAI(
                 model="gpt-3.5-turbo-0125"
             )
     else:
         if load_model:
+            from llama_index.llms.openai import OpenAI
             Settings.llm = OpenAI(
                 model="gpt-4o"
             )
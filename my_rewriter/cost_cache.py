@@ -0,0 +1,75 @@
+import re
+import time
+import threading
+import typing as t
+
+from my_rewriter.config import COST_CACHE_PATH, COST_CACHE_ENABLED
+from my_rewriter.sqlite_utils import connect_sqlite, hash_key
+
+def normalize_sql(sql: str) -> str:
+    # only layout is normalized, literals and identifiers may be case-sensitive
+    return re.sub(r'\s+', ' ', sql).strip().rstrip(';').strip()
+
+class CostCache(object):
+    """Optimizer costs keyed by (database, normalized SQL, session settings, statistics version).
+
+    Rows of older statistics versions are deleted the first time a newer version is seen, i.e.
+    after the database is re-ANALYZEd.
+    """
+
+    def __init__(self, path: str, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.conn = None
+        self.versions: t.Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        if enabled:
+            self.conn = connect_sqlite(path)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS costs (key TEXT PRIMARY KEY, dbname TEXT, stats_version TEXT, cost REAL, created_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS costs_dbname ON costs (dbname, stats_version)')
+
+    @staticmethod
+    def key(dbname: str, sql: str, settings: str, stats_version: str) -> str:
+        return hash_key(dbname, normalize_sql(sql), settings, stats_version)
+
+    def _check_version(self, dbname: str, stats_version: str):
+        if self.versions.get(dbname) != stats_version:
+            self.conn.execute('DELETE FROM costs WHERE dbname = ? AND stats_version != ?', (dbname, stats_version))
+            self.versions[dbname] = stats_version
+
+    def lookup(self, dbname: str, sql: str, settings: str, stats_version: str) -> t.Optional[float]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            self._check_version(dbname, stats_version)
+            row = self.conn.execute('SELECT cost FROM costs WHERE key = ?', (self.key(dbname, sql, settings, stats_version),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def store(self, dbname: str, sql: str, settings: str, stats_version: str, cost: float):
+        # -1 marks a failed estimation, which is retried next time
+        if not self.enabled or cost == -1:
+            return
+        with self.lock:
+            self._check_version(dbname, stats_version)
+            self.conn.execute('INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?, ?)', (self.key(dbname, sql, settings, stats_version), dbname, stats_version, cost, time.time()))
+
+_cost_cache: t.Optional[CostCache] = None
+_cost_cache_lock = threading.Lock()
+
+def get_cost_cache() -> CostCache:
+    global _cost_cache
+    with _cost_cache_lock:
+        if _cost_cache is None:
+            _cost_cache = CostCache(COST_CACHE_PATH, enabled=COST_CACHE_ENABLED)
+        return _cost_cache
+
+def set_cost_cache_enabled(enabled: bool):
+    global _cost_cache
+    with _cost_cache_lock:
+        _cost_cache = CostCache(COST_CACHE_PATH, enabled=enabled)
@@ -1,10 +1,21 @@
 import psycopg2
-import json
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
 import logging
 import typing as t
 import os
+import threading
+import contextlib
+import time
+import math
 
-from my_rewriter.config import CACHE_PATH
+from my_rewriter.config import DB_MAX_CONCURRENCY, DB_POOL_MIN_SIZE, DB_STATS_CHECK_INTERVAL
+from my_rewriter.cost_cache import get_cost_cache
+from my_rewriter.latency_cache import LatencyCache, get_latency_cache_paths
+
+def statement_timeout_ms(timeout_ms: float) -> int:
+    # statement_timeout is in whole milliseconds and 0 disables it, so round up to at least 1
+    return max(1, math.ceil(timeout_ms))
 
 class DBArgs(object):
 
@@ -21,81 +32,182 @@ class DBArgs(object):
         else:
             raise NotImplementedError
 
-        self.cache = {}
-        with open(os.path.join(CACHE_PATH, f'{self.dbname}.jsonl'), 'r') as f:
-            for line in f:
-                obj = json.loads(line)
-                self.cache[obj['sql']] = obj
+        # bounds concurrent statements when queries are processed by several workers
+        self.slots = threading.BoundedSemaphore(DB_MAX_CONCURRENCY)
+        self.pools: t.Dict[t.Tuple[int, bool], ThreadedConnectionPool] = {}
+        self.pools_lock = threading.Lock()
+        # pools that had a connection fail, whose idle connections are pinged before they are handed out
+        self.suspect_pools: t.Set[t.Tuple[int, bool]] = set()
+        self.stats_version = None
+        self.stats_checked_at = 0.0
+        self.stats_lock = threading.Lock()
+
+        self.server_version = None
+        cache_path, jsonl_path = get_latency_cache_paths(self.dbname)
+        self.cache = LatencyCache(cache_path, jsonl_path=jsonl_path, server_version=self.get_server_version)
+
+    @staticmethod
+    def _pool_key(timeout: int, enable_indexscan: bool) -> t.Tuple[int, bool]:
+        return (timeout if timeout > 0 else -1, enable_indexscan)
+
+    def get_pool(self, timeout: int = -1, enable_indexscan: bool = False) -> ThreadedConnectionPool:
+        # session settings are passed as startup options, so each connection applies them once
+        key = self._pool_key(timeout, enable_indexscan)
+        with self.pools_lock:
+            if key not in self.pools:
+                options = [] if enable_indexscan else ['-c enable_indexscan=off']
+                if timeout > 0:
+                    options.append(f'-c statement_timeout={timeout}s')
+                self.pools[key] = ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_MAX_CONCURRENCY,
+                                                         database=self.dbname,
+                                                         user=self.user,
+                                                         password=self.password,
+                                                         host=self.host,
+                                                         port=self.port,
+                                                         options=' '.join(options))
+            return self.pools[key]
+
+    @contextlib.contextmanager
+    def connection(self, timeout: int = -1, enable_indexscan: bool = False) -> t.Iterator[psycopg2.extensions.connection]:
+        """Check out a pooled connection, waiting for a slot when DB_MAX_CONCURRENCY statements are running."""
+        key = self._pool_key(timeout, enable_indexscan)
+        pool = self.get_pool(timeout, enable_indexscan)
+        with self.slots:
+            conn = self._checkout(pool, key)
+            broken = False
+            try:
+                yield conn
+            except psycopg2.extensions.QueryCanceledError:
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                if broken or conn.closed:
+                    self.suspect_pools.add(key)
+                pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def _checkout(self, pool: ThreadedConnectionPool, key: t.Tuple[int, bool]) -> psycopg2.extensions.connection:
+        # every idle connection may be dead after a server restart, so try at most all of them and then a new one
+        for _ in range(DB_MAX_CONCURRENCY + 1):
+            conn = pool.getconn()
+            if conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # dropped by the server, or left mid-transaction by an interrupted caller
+                pool.putconn(conn, close=True)
+                continue
+            conn.autocommit = True
+            if key in self.suspect_pools:
+                try:
+                    conn.cursor().execute('SELECT 1')
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    pool.putconn(conn, close=True)
+                    continue
+                self.suspect_pools.discard(key)
+            return conn
+        raise psycopg2.OperationalError(f'No live connection to {self.host}:{self.port}/{self.dbname}')
+
+    def get_stats_version(self) -> str:
+        """A token that changes whenever a table is (auto-)ANALYZEd, polled at most every DB_STATS_CHECK_INTERVAL seconds."""
+        with self.stats_lock:
+            if self.stats_version is None or time.time() - self.stats_checked_at > DB_STATS_CHECK_INTERVAL:
+                with self.connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute('SELECT sum(analyze_count + autoanalyze_count), max(greatest(last_analyze, last_autoanalyze)) FROM pg_stat_user_tables')
+                    self.stats_version = ':'.join([str(x) for x in cur.fetchone()])
+                self.stats_checked_at = time.time()
+            return self.stats_version
+
+    def get_server_version(self) -> str:
+        if self.server_version is None:
+            with self.connection() as conn:
+                self.server_version = str(conn.server_version)
+        return self.server_version
+
+    def close(self):
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.closeall()
+            self.pools = {}
 
 class Database():
 
-    def __init__(self, args: DBArgs, timeout: int = -1, enable_indexscan: bool = False):
+    def __init__(self, args: DBArgs, timeout: int = -1, enable_indexscan: bool = False, cpus: t.Optional[t.List[int]] = None):
+        # connections come from the pool of args on every statement, so instances are cheap
         self.args = args
-        self.conn = None
         self.timeout = timeout
-        self.resetConn(timeout)
         self.enable_indexscan = enable_indexscan
+        self.cpus = cpus
 
-    def resetConn(self, timeout: int = -1):
-        if timeout > 0:
-            self.conn = psycopg2.connect(database=self.args.dbname,
-                                        user=self.args.user,
-                                        password=self.args.password,
-                                        host=self.args.host,
-                                        port=self.args.port,
-                                        options=f'-c statement_timeout={timeout}s')
-        else:
-            self.conn = psycopg2.connect(database=self.args.dbname,
-                                        user=self.args.user,
-                                        password=self.args.password,
-                                        host=self.args.host,
-                                        port=self.args.port)
+    def pin_backend(self, conn: psycopg2.extensions.connection):
+        # restrict the server process of conn to self.cpus, possible only for a local server we may signal
+        try:
+            os.sched_setaffinity(conn.get_backend_pid(), self.cpus)
+        except (OSError, AttributeError) as e:
+            logging.warning(f'Failed to pin backend {conn.get_backend_pid()} to CPUs {self.cpus}: {e}')
 
     def exec_fetch(self, statement: str, one: bool = True):
-        cur = self.conn.cursor()
-        cur.execute(statement)
-        if one:
-            return cur.fetchone()
-        return cur.fetchall()
+        with self.args.connection(self.timeout, self.enable_indexscan) as conn:
+            cur = conn.cursor()
+            cur.execute(statement)
+            if one:
+                return cur.fetchone()
+            return cur.fetchall()
 
-    def execute_sql(self, sql: str):
+    def execute_sql(self, sql: str, timeout_ms: t.Optional[float] = None):
+        # timeout_ms overrides the session's statement timeout for this statement only, see statement_timeout_ms
         success = 0
         i = 0
         cnt = 3
         res = None
         logs = []
-        cur = self.conn.cursor()
         while success == 0 and i < cnt:
             try:
-                if not self.enable_indexscan:
-                    cur.execute("SET enable_indexscan = off;")
-                cur.execute(sql)
+                with self.args.connection(self.timeout, self.enable_indexscan) as conn:
+                    if self.cpus is not None:
+                        self.pin_backend(conn)
+                    cur = conn.cursor()
+                    if timeout_ms is None:
+                        cur.execute(sql)
+                        res = cur.fetchall()
+                    else:
+                        cur.execute(f'SET statement_timeout = {statement_timeout_ms(timeout_ms)}')
+                        try:
+                            cur.execute(sql)
+                            res = cur.fetchall()
+                        finally:
+                            cur.execute('RESET statement_timeout')
                 success = 1
             except Exception as e:
                 logs.append(e)
                 if 'canceling statement due to statement timeout' in str(e):
                     return success, res, logs
-            if success == 1:
-                res = cur.fetchall()
             i = i + 1
         return success, res, logs
 
     def pgsql_cost_estimation(self, sql: str):
+        cache = get_cost_cache()
+        settings = f'enable_indexscan={self.enable_indexscan}'
+        stats_version = self.args.get_stats_version() if cache.enabled else ''
+        cost = cache.lookup(self.args.dbname, sql, settings, stats_version)
+        if cost is not None:
+            return cost
         success, res, logs = self.execute_sql('explain (FORMAT JSON) ' + sql)
         if success == 1:
             cost = res[0][0][0]['Plan']['Total Cost']
+            cache.store(self.args.dbname, sql, settings, stats_version, cost)
             return cost
         else:
             logging.error(f'Failed to execute pgsql_cost_estimation {sql}\n' + str(logs))
             return -1
 
-    def pgsql_actual_time(self, sql: str):
-        success, res, logs = self.execute_sql('explain (FORMAT JSON, analyze) ' + sql)
+    def pgsql_actual_time(self, sql: str, timeout_ms: t.Optional[float] = None):
+        success, res, logs = self.execute_sql('explain (FORMAT JSON, analyze) ' + sql, timeout_ms=timeout_ms)
         if success == 1:
             return res[0][0][0]['Plan']['Actual Total Time']
         else:
             if 'canceling statement due to statement timeout' in str(logs):
-                return self.timeout * 1000
+                # the timeout that was actually applied, a lower bound of the latency
+                return statement_timeout_ms(timeout_ms) if timeout_ms is not None else self.timeout * 1000
             logging.error(f'Failed to execute pgsql_actual_time {sql}\n' + str(logs))
             return -1
 
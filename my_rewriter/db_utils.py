@@ -1,58 +1,76 @@
 import typing as t
+import time
+import asyncio
 import logging
-from scipy import stats
-import json
-import os
 
-from my_rewriter.config import CACHE_PATH
 from my_rewriter.database import Database, DBArgs
-from my_rewriter.rewrite import rewrite
+from my_rewriter.rewrite import rewrite, split_schema
+from my_rewriter.rewrite_pool import get_rewrite_pool, rewrite_batch
+from my_rewriter.rewrite_cache import get_rewrite_cache
+from my_rewriter.latency import measure_latencies, store_latency
+from my_rewriter.query_trace import trace_event, trace_span
 
-def execute_rewrite(query: str, schema: str, db_args: DBArgs, rule_seq: t.List[str], rounds: int) -> t.Dict:
-    create_tables = [x for x in schema.split(';') if x.strip() != '']
-    res = rewrite(query, create_tables, rule_seq, rounds)
+def apply_rules(query: str, schema: str, rule_seq: t.List[str], rounds: int) -> t.Dict:
+    return apply_rules_batch(query, schema, [rule_seq], rounds)[0]
+
+def apply_rules_batch(query: str, schema: str, rule_seqs: t.List[t.List[str]], rounds: int) -> t.List[t.Dict]:
+    with trace_span('apply_rules', sequences=len(rule_seqs)) as span:
+        results = _apply_rules_batch(query, schema, rule_seqs, rounds, span)
+    return results
+
+def _apply_rules_batch(query: str, schema: str, rule_seqs: t.List[t.List[str]], rounds: int, span: t.Dict) -> t.List[t.Dict]:
+    cache = get_rewrite_cache()
+    results = [cache.get_rewrite(query, schema, rule_seq, rounds) for rule_seq in rule_seqs]
+    misses = [i for i, res in enumerate(results) if res is None]
+    span['cached'] = len(rule_seqs) - len(misses)
+    if not misses:
+        return results
+    create_tables = split_schema(schema)
+    pool = get_rewrite_pool()
+    if pool is not None:
+        computed = rewrite_batch(pool, [(query, create_tables, rule_seqs[i], rounds) for i in misses])
+    else:
+        computed = []
+        for i in misses:
+            res = rewrite(query, create_tables, rule_seqs[i], rounds)
+            computed.append({'used_rules': [str(r) for r in res.rules], 'output_sql': str(res.sql), 'time': int(res.time)})
+    for i, res in zip(misses, computed):
+        cache.put_rewrite(query, schema, rule_seqs[i], rounds, res)
+        results[i] = res
+    return results
 
-    db = Database(db_args)
-    used_rules = [str(r) for r in res.rules]
-    output_sql = str(res.sql)
-    rewrite_time = int(res.time)
+def estimate_rewrite_cost(rewrite_res: t.Dict, db_args: DBArgs) -> t.Dict:
+    start_ns = time.monotonic_ns()
+    output_sql = rewrite_res['output_sql']
     output_cost = -1
     if output_sql != 'None':
-        output_cost = db.cost_estimation(output_sql)
-    res_dict = {'used_rules': used_rules, 'output_sql': output_sql, 'output_cost': output_cost, 'time': rewrite_time}
+        output_cost = Database(db_args).cost_estimation(output_sql)
+    res_dict = {'used_rules': rewrite_res['used_rules'], 'output_sql': output_sql, 'output_cost': output_cost, 'time': rewrite_res['time']}
+    if rewrite_res.get('cached'):
+        res_dict['cached'] = True
     logging.info(f'Rewrite Execution Results: {res_dict}')
+    trace_event('rewrite', 'estimate_rewrite_cost', start_ns=start_ns, **res_dict)
     return res_dict
 
+def execute_rewrite(query: str, schema: str, db_args: DBArgs, rule_seq: t.List[str], rounds: int) -> t.Dict:
+    return estimate_rewrite_cost(apply_rules(query, schema, rule_seq, rounds), db_args)
+
+async def aexecute_rewrite(query: str, schema: str, db_args: DBArgs, rule_seq: t.List[str], rounds: int) -> t.Dict:
+    return await asyncio.to_thread(execute_rewrite, query, schema, db_args, rule_seq, rounds)
+
 def compare(a: t.List[float], b: t.List[float], alternative: str = 'greater', threshold: float = 0.1) -> bool:
+    from scipy import stats
     _, p_value = stats.ttest_ind(a, b, alternative=alternative)
     return p_value < threshold
 
 def actual_time(sql: str, db_args: DBArgs, timeout: int) -> t.Tuple[float, t.List[float]]:
-    if sql not in db_args.cache:
-        times = []
-        for i in range(5):
-            db = Database(db_args, timeout)
-            latency = db.pgsql_actual_time(sql)
-            if latency == -1:
-                return float("inf"), [float("inf")] * 5
-            if latency == timeout * 1000 and i == 0:
-                times = [latency] * 5
-                break
-            times.append(latency)
-        sorted_times = sorted(times)
-        actual_time = sum(sorted_times[1:-1]) / 3
-        db_args.cache[sql] = {'time': actual_time, 'times': times}
-        with open(os.path.join(CACHE_PATH, f'{db_args.dbname}.jsonl'), 'a') as f:
-            f.write(json.dumps({'sql': sql, 'time': actual_time, 'times': times}) + '\n')
-    return db_args.cache[sql]['time'], db_args.cache[sql]['times']
+    return measure_latencies([sql], db_args, timeout, workers=1, isolation='none')[sql]
 
 def actual_time_once(sql: str, db_args: DBArgs, timeout: int) -> float:
-    if sql not in db_args.cache:
+    if sql not in db_args.cache or db_args.cache[sql].get('censored'):
         db = Database(db_args, timeout)
         latency = db.pgsql_actual_time(sql)
         if latency == -1:
             return float("inf")
-        db_args.cache[sql] = {'time': latency}
-        with open(os.path.join(CACHE_PATH, f'{db_args.dbname}.jsonl'), 'a') as f:
-            f.write(json.dumps({'sql': sql, 'time': latency}) + '\n')
-    return db_args.cache[sql]['time']
\ No newline at end of file
+        store_latency(db_args, sql, {'time': latency})
+    return db_args.cache[sql]['time']
@@ -0,0 +1,116 @@
+import os
+import fcntl
+import logging
+import threading
+import typing as t
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.async_utils import run_async_tasks
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from my_rewriter.config import EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_ENABLED
+from my_rewriter.sqlite_utils import hash_key
+
+def get_embedding_identity(embed_model: BaseEmbedding) -> str:
+    return f'{type(embed_model).__name__}:{getattr(embed_model, "model_name", "")}'
+
+def embed_queries(embed_model: BaseEmbedding, texts: t.List[str]) -> t.List[t.List[float]]:
+    if isinstance(embed_model, OpenAIEmbedding) and embed_model._query_engine == embed_model._text_engine:
+        # OpenAI query and text embeddings are the same request, so all texts fit in one batched call
+        return embed_model.get_text_embedding_batch(texts)
+    return run_async_tasks([embed_model.aget_query_embedding(text) for text in texts])
+
+class EmbeddingCache(object):
+    """Query embeddings persisted per model as a float32 matrix (`.f32`) and a row-aligned list of text hashes (`.keys`).
+
+    The first line of the keys file holds the embedding dimension. Rows are only appended,
+    under an exclusive file lock, so several processes can share a cache directory.
+    """
+
+    def __init__(self, path: str, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.tables: t.Dict[str, t.Dict[str, np.ndarray]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _files(self, identity: str) -> t.Tuple[str, str]:
+        name = hash_key(identity)[:16]
+        return os.path.join(self.path, f'{name}.keys'), os.path.join(self.path, f'{name}.f32')
+
+    def _read(self, identity: str) -> t.Dict[str, np.ndarray]:
+        keys_file, data_file = self._files(identity)
+        if not os.path.exists(keys_file) or not os.path.exists(data_file):
+            return {}
+        with open(keys_file, 'r') as fin:
+            lines = fin.read().split('\n')
+        # the last element is empty, or a key whose write was interrupted
+        dim, keys = int(lines[0]), lines[1:-1]
+        data = np.fromfile(data_file, dtype=np.float32)
+        rows = min(len(keys), len(data) // dim)
+        data = data[:rows * dim].reshape(rows, dim)
+        return {key: data[i] for i, key in enumerate(keys[:rows])}
+
+    def _append(self, identity: str, keys: t.List[str], vectors: np.ndarray):
+        os.makedirs(self.path, exist_ok=True)
+        keys_file, data_file = self._files(identity)
+        with open(keys_file, 'a+b') as keys_out:
+            fcntl.flock(keys_out, fcntl.LOCK_EX)
+            try:
+                keys_out.seek(0)
+                lines = keys_out.read().split(b'\n')
+                if lines[0] == b'':
+                    keys_out.write(f'{vectors.shape[1]}\n'.encode())
+                    rows = 0
+                else:
+                    rows = len(lines) - 2
+                    if lines[-1] != b'':
+                        # drop the key of an interrupted write
+                        keys_out.truncate(keys_out.tell() - len(lines[-1]))
+                with open(data_file, 'ab') as data_out:
+                    # drop vectors whose keys were never written
+                    data_out.truncate(rows * vectors.shape[1] * 4)
+                    data_out.write(vectors.astype(np.float32).tobytes())
+                keys_out.write(''.join([f'{key}\n' for key in keys]).encode())
+            finally:
+                fcntl.flock(keys_out, fcntl.LOCK_UN)
+
+    def get_query_embeddings(self, embed_model: BaseEmbedding, texts: t.List[str]) -> t.List[t.List[float]]:
+        if len(texts) == 0:
+            return []
+        if not self.enabled:
+            return embed_queries(embed_model, texts)
+        identity = get_embedding_identity(embed_model)
+        keys = [hash_key(text) for text in texts]
+        with self.lock:
+            if identity not in self.tables:
+                self.tables[identity] = self._read(identity)
+            table = self.tables[identity]
+            missing = list(dict.fromkeys([text for text, key in zip(texts, keys) if key not in table]))
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        logging.debug(f'Embedding Cache: {len(texts) - len(missing)} hits, {len(missing)} misses')
+        if len(missing) > 0:
+            vectors = np.asarray(embed_queries(embed_model, missing), dtype=np.float32)
+            missing_keys = [hash_key(text) for text in missing]
+            with self.lock:
+                self._append(identity, missing_keys, vectors)
+                for key, vector in zip(missing_keys, vectors):
+                    table[key] = vector
+        return [table[key].tolist() for key in keys]
+
+_embedding_cache: t.Optional[EmbeddingCache] = None
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, enabled=EMBEDDING_CACHE_ENABLED)
+    return _embedding_cache
+
+def get_query_embeddings(texts: t.List[str], embed_model: t.Optional[BaseEmbedding] = None) -> t.List[t.List[float]]:
+    if embed_model is None:
+        embed_model = Settings.embed_model
+    return get_embedding_cache().get_query_embeddings(embed_model, texts)
@@ -0,0 +1,358 @@
+import logging
+import threading
+import time
+import typing as t
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import psycopg2
+import psycopg2.extensions
+
+from my_rewriter.config import LATENCY_WORKERS, LATENCY_ISOLATION, LATENCY_CPUS, LATENCY_REPEATS, ADAPTIVE_MIN_SAMPLES, ADAPTIVE_MAX_SAMPLES, ADAPTIVE_ALPHA, ADAPTIVE_REL_WIDTH, ADAPTIVE_CANCEL_FACTOR, RACE_MODE, RACE_MARGIN, RACE_POLL_INTERVAL
+from my_rewriter.database import Database, DBArgs, statement_timeout_ms
+
+LATENCY_ISOLATION_MODES = ['none', 'tables', 'serial']
+RACE_MODES = ['sequential', 'concurrent']
+
+def trimmed_mean(times: t.List[float]) -> float:
+    # the mean without the fastest and the slowest run
+    sorted_times = sorted(times)
+    return sum(sorted_times[1:-1]) / (len(sorted_times) - 2)
+
+def store_latency(db_args: DBArgs, sql: str, record: t.Dict):
+    # a censored record ends with the one run that was cancelled
+    db_args.cache[sql] = {**record, 'timeouts': int(bool(record.get('censored')))}
+
+def get_relations(db_args: DBArgs, sql: str) -> t.Optional[t.FrozenSet[str]]:
+    """Tables scanned by the plan of sql, or None if it cannot be planned."""
+    success, res, _ = Database(db_args).execute_sql('explain (FORMAT JSON) ' + sql)
+    if success != 1:
+        return None
+    relations = set()
+    stack = [res[0][0][0]['Plan']]
+    while stack:
+        plan = stack.pop()
+        if 'Relation Name' in plan:
+            relations.add(plan['Relation Name'])
+        stack.extend(plan.get('Plans', []))
+    return frozenset(relations)
+
+class TableLocks(object):
+    """Admits a query only while no running query scans one of its tables; None tables run alone."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tables = Counter()
+        self.running = 0
+        self.exclusive = False
+
+    def _free(self, tables: t.Optional[t.FrozenSet[str]]) -> bool:
+        if tables is None:
+            return self.running == 0
+        return not self.exclusive and all([self.tables[table] == 0 for table in tables])
+
+    def acquire(self, tables: t.Optional[t.FrozenSet[str]]):
+        with self.cond:
+            self.cond.wait_for(lambda: self._free(tables))
+            self.running += 1
+            if tables is None:
+                self.exclusive = True
+            else:
+                self.tables.update(tables)
+
+    def release(self, tables: t.Optional[t.FrozenSet[str]]):
+        with self.cond:
+            self.running -= 1
+            if tables is None:
+                self.exclusive = False
+            else:
+                self.tables.subtract(tables)
+            self.cond.notify_all()
+
+class LatencyScheduler(object):
+    """Measures the latency of many queries with EXPLAIN ANALYZE on pooled connections.
+
+    Repetitions are interleaved: every pending query runs once before any runs again, in alternating
+    order, so that no query is always measured right after the same neighbour. Isolation is 'none',
+    'tables' (queries sharing a scanned table never overlap) or 'serial'. With cpus, the backend of the
+    i-th worker is pinned to cpus[i % len(cpus)], which only works when the server is local.
+    Each query gets the same {'time', 'times'} record as `actual_time`.
+    """
+
+    def __init__(self, db_args: DBArgs, timeout: int, workers: int = LATENCY_WORKERS, isolation: str = LATENCY_ISOLATION, cpus: t.Optional[t.List[t.List[int]]] = LATENCY_CPUS, repeats: int = LATENCY_REPEATS):
+        if isolation not in LATENCY_ISOLATION_MODES:
+            raise ValueError(f'Invalid latency isolation mode: {isolation}')
+        self.db_args = db_args
+        self.timeout = timeout
+        self.workers = 1 if isolation == 'serial' else workers
+        # a single worker never overlaps queries, so table locks and the EXPLAIN that finds the tables are skipped
+        self.isolation = 'none' if isolation == 'tables' and self.workers <= 1 else isolation
+        self.cpus = cpus
+        self.repeats = repeats
+        self.locks = TableLocks()
+        self.slots = threading.local()
+        self.next_slot = 0
+        self.slot_lock = threading.Lock()
+
+    def _worker_cpus(self) -> t.Optional[t.List[int]]:
+        if not self.cpus:
+            return None
+        if not hasattr(self.slots, 'index'):
+            with self.slot_lock:
+                self.slots.index = self.next_slot
+                self.next_slot += 1
+        return self.cpus[self.slots.index % len(self.cpus)]
+
+    def _run(self, sql: str, tables: t.Optional[t.FrozenSet[str]], timeout_ms: t.Optional[float] = None) -> float:
+        if self.isolation == 'tables':
+            self.locks.acquire(tables)
+        try:
+            return Database(self.db_args, self.timeout, cpus=self._worker_cpus()).pgsql_actual_time(sql, timeout_ms=timeout_ms)
+        finally:
+            if self.isolation == 'tables':
+                self.locks.release(tables)
+
+    def _cached(self, sql: str) -> t.Optional[t.Dict]:
+        # a censored record only bounds the latency from below
+        record = self.db_args.cache.get(sql)
+        return None if record is None or record.get('censored') else record
+
+    def measure(self, sqls: t.List[str]) -> t.Dict[str, t.Tuple[float, t.List[float]]]:
+        results = {}
+        pending = []
+        for sql in dict.fromkeys(sqls):
+            record = self._cached(sql)
+            if record is not None:
+                results[sql] = (record['time'], record['times'])
+            else:
+                pending.append(sql)
+        tables = {sql: get_relations(self.db_args, sql) for sql in pending} if self.isolation == 'tables' else {}
+        times = {sql: [] for sql in pending}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for i in range(self.repeats):
+                order = pending if i % 2 == 0 else pending[::-1]
+                latencies = list(executor.map(lambda sql: self._run(sql, tables.get(sql)), order))
+                for sql, latency in zip(order, latencies):
+                    if latency == -1:
+                        # failed queries are not cached, as in actual_time
+                        results[sql] = (float("inf"), [float("inf")] * self.repeats)
+                    elif latency == self.timeout * 1000 and i == 0:
+                        times[sql] = [latency] * self.repeats
+                    else:
+                        times[sql].append(latency)
+                pending = [sql for sql in pending if sql not in results and len(times[sql]) < self.repeats]
+                logging.debug(f'Latency repetition {i + 1}/{self.repeats}: {len(pending)} queries pending')
+        for sql, sql_times in times.items():
+            if sql not in results:
+                record = {'time': trimmed_mean(sql_times), 'times': sql_times}
+                store_latency(self.db_args, sql, record)
+                results[sql] = (record['time'], record['times'])
+        return results
+
+    def compare(self, input_sql: str, output_sqls: t.List[str]) -> t.Tuple[t.Tuple[float, t.List[float]], t.Dict[str, t.Dict]]:
+        """Sample input_sql and its rewrites alternately until each rewrite is decided by `sequential_decision`.
+
+        Between ADAPTIVE_MIN_SAMPLES and ADAPTIVE_MAX_SAMPLES runs are taken per query; undecided pairs
+        fall back to `compare` after the last run. A rewrite run is cancelled once it exceeds the
+        slowest input run by ADAPTIVE_CANCEL_FACTOR; its record is then marked censored and the
+        rewrite is decided as not improved. Returns the input's (time, times) and, per rewrite,
+        its {'time', 'times', 'censored', 'improved'}.
+        """
+        from my_rewriter.db_utils import compare
+        timeout_ms = self.timeout * 1000
+        relations = {sql: get_relations(self.db_args, sql) for sql in [input_sql] + output_sqls} if self.isolation == 'tables' else {}
+        input_record = self._cached(input_sql)
+        input_times = list(input_record['times']) if input_record is not None else []
+        input_done = input_record is not None
+        outputs = {}
+        for sql in dict.fromkeys(output_sqls):
+            record = self._cached(sql)
+            outputs[sql] = {'times': list(record['times']) if record is not None else [], 'censored': False, 'improved': None, 'done': record is not None, 'cached': record is not None}
+        while True:
+            undecided = [sql for sql, o in outputs.items() if o['improved'] is None]
+            if not input_done and (len(input_times) < ADAPTIVE_MIN_SAMPLES or (undecided and len(input_times) < ADAPTIVE_MAX_SAMPLES)):
+                latency = self._run(input_sql, relations.get(input_sql))
+                if latency == -1:
+                    # as in measure, a failed input is infinitely slow and not cached
+                    inf_times = [float("inf")] * ADAPTIVE_MIN_SAMPLES
+                    return (float("inf"), inf_times), {sql: {'time': float("inf"), 'times': inf_times, 'censored': False, 'improved': False} for sql in outputs}
+                if latency == timeout_ms and not input_times:
+                    input_times = [latency] * ADAPTIVE_MIN_SAMPLES
+                    input_done = True
+                else:
+                    input_times.append(latency)
+                    input_done = len(input_times) >= ADAPTIVE_MAX_SAMPLES
+            elif not undecided:
+                break
+            for sql in undecided:
+                o = outputs[sql]
+                if not o['done']:
+                    cutoff = min(statement_timeout_ms(max(input_times) * ADAPTIVE_CANCEL_FACTOR), timeout_ms)
+                    latency = self._run(sql, relations.get(sql), timeout_ms=cutoff)
+                    if latency == -1:
+                        o.update(times=[float("inf")] * ADAPTIVE_MIN_SAMPLES, improved=False, done=True)
+                    elif latency >= cutoff and cutoff < timeout_ms:
+                        o['times'].append(cutoff)
+                        o.update(censored=True, improved=False, done=True)
+                    elif latency == timeout_ms and not o['times']:
+                        o.update(times=[latency] * ADAPTIVE_MIN_SAMPLES, improved=False, done=True)
+                    else:
+                        o['times'].append(latency)
+                        o['done'] = len(o['times']) >= ADAPTIVE_MAX_SAMPLES
+                if o['improved'] is None and min(len(input_times), len(o['times'])) >= ADAPTIVE_MIN_SAMPLES:
+                    o['improved'] = sequential_decision(input_times, o['times'])
+                if o['improved'] is None and o['done'] and input_done:
+                    o['improved'] = compare(input_times, o['times'])
+        if input_record is None:
+            input_record = {'time': trimmed_mean(input_times), 'times': input_times}
+            store_latency(self.db_args, input_sql, input_record)
+        results = {}
+        for sql, o in outputs.items():
+            if o['censored']:
+                record = {'time': max(o['times']), 'times': o['times'], 'censored': True}
+            else:
+                record = {'time': trimmed_mean(o['times']), 'times': o['times']}
+            if not o['cached'] and o['times'][0] != float("inf"):
+                store_latency(self.db_args, sql, record)
+            results[sql] = {'time': record['time'], 'times': record['times'], 'censored': o['censored'], 'improved': o['improved']}
+        return (input_record['time'], input_record['times']), results
+
+    def compare_all(self, pairs: t.List[t.Tuple[str, t.List[str]]]) -> t.List[t.Tuple[t.Tuple[float, t.List[float]], t.Dict[str, t.Dict]]]:
+        # one input query and its rewrites per worker
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(lambda pair: self.compare(*pair), pairs))
+
+class LatencyRace(object):
+    """Runs a query and its rewrites once each, cancelling runs that fall behind the fastest finished one.
+
+    'concurrent' starts every query at once on its own pooled connection and cancels a running query
+    once its elapsed time exceeds the best finished latency by RACE_MARGIN. 'sequential' runs them
+    one by one, each with a statement timeout of the best latency so far plus RACE_MARGIN. A cancelled
+    query gets a censored record whose time is a lower bound of its latency, so the total time spent
+    is bounded by the best plan rather than the worst. Concurrent runs contend with each other, so
+    neither their latencies nor their bounds are cached.
+    """
+
+    def __init__(self, db_args: DBArgs, timeout: int, mode: str = RACE_MODE, margin: float = RACE_MARGIN):
+        if mode not in RACE_MODES:
+            raise ValueError(f'Invalid race mode: {mode}')
+        self.db_args = db_args
+        self.timeout = timeout
+        self.mode = mode
+        self.margin = margin
+
+    def _cutoff(self, best: float) -> float:
+        return best * (1 + self.margin) if best == float("inf") else statement_timeout_ms(best * (1 + self.margin))
+
+    def _run(self, sql: str, job: t.Dict) -> t.Optional[float]:
+        # None when cancelled by the race, like pgsql_actual_time otherwise
+        with self.db_args.connection(self.timeout) as conn:
+            with job['lock']:
+                job['conn'] = conn
+                job['start'] = time.monotonic()
+            try:
+                cur = conn.cursor()
+                cur.execute('explain (FORMAT JSON, analyze) ' + sql)
+                return cur.fetchall()[0][0][0]['Plan']['Actual Total Time']
+            except psycopg2.extensions.QueryCanceledError:
+                return None if job['cancelled'] else self.timeout * 1000
+            except psycopg2.Error as e:
+                logging.error(f'Failed to execute pgsql_actual_time {sql}\n' + str(e))
+                return -1
+            finally:
+                # the connection goes back to the pool, and must not be cancelled after that
+                with job['lock']:
+                    job['conn'] = None
+
+    def _race_concurrent(self, pending: t.List[str], best: float) -> t.Dict[str, t.Dict]:
+        jobs = {sql: {'lock': threading.Lock(), 'conn': None, 'start': None, 'cancelled': False, 'elapsed': None} for sql in pending}
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {executor.submit(self._run, sql, jobs[sql]): sql for sql in pending}
+            not_done = set(futures)
+            while not_done:
+                done, not_done = wait(not_done, timeout=RACE_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sql, latency = futures[future], future.result()
+                    results[sql] = latency
+                    if latency is not None and latency != -1:
+                        best = min(best, latency)
+                for future in not_done:
+                    job = jobs[futures[future]]
+                    with job['lock']:
+                        if job['conn'] is None or job['cancelled']:
+                            continue
+                        elapsed = (time.monotonic() - job['start']) * 1000
+                        if elapsed > self._cutoff(best):
+                            # the libpq cancel request, as pg_cancel_backend but without taking another connection
+                            job['conn'].cancel()
+                            job['cancelled'] = True
+                            job['elapsed'] = elapsed
+        return {sql: {'time': jobs[sql]['elapsed'], 'censored': True} if latency is None else {'time': latency, 'censored': False} for sql, latency in results.items()}
+
+    def _race_sequential(self, pending: t.List[str], best: float) -> t.Dict[str, t.Dict]:
+        results = {}
+        for sql in pending:
+            cutoff = self._cutoff(best)
+            if cutoff >= self.timeout * 1000:
+                latency = Database(self.db_args, self.timeout).pgsql_actual_time(sql)
+                results[sql] = {'time': latency, 'censored': False}
+            else:
+                latency = Database(self.db_args, self.timeout).pgsql_actual_time(sql, timeout_ms=cutoff)
+                results[sql] = {'time': latency, 'censored': latency == cutoff}
+            if latency != -1 and not results[sql]['censored']:
+                best = min(best, latency)
+        return results
+
+    def race(self, sqls: t.List[str]) -> t.Dict[str, t.Dict]:
+        """The {'time', 'censored'} of every query; failed queries get an infinite time and are not cached."""
+        results = {}
+        pending = []
+        best = float("inf")
+        for sql in dict.fromkeys(sqls):
+            record = self.db_args.cache.get(sql)
+            if record is not None and not record.get('censored'):
+                results[sql] = {'time': record['time'], 'censored': False}
+                best = min(best, record['time'])
+            else:
+                pending.append(sql)
+        if not pending:
+            return results
+        raced = self._race_concurrent(pending, best) if self.mode == 'concurrent' else self._race_sequential(pending, best)
+        for sql, res in raced.items():
+            if res['time'] == -1:
+                res['time'] = float("inf")
+            elif self.mode == 'sequential':
+                store_latency(self.db_args, sql, {'time': res['time'], 'censored': True} if res['censored'] else {'time': res['time']})
+            results[sql] = res
+        return results
+
+def race_latencies(sqls: t.List[str], db_args: DBArgs, timeout: int, **kwargs) -> t.Dict[str, t.Dict]:
+    return LatencyRace(db_args, timeout, **kwargs).race(sqls)
+
+def sequential_decision(input_times: t.List[float], output_times: t.List[float], alpha: float = ADAPTIVE_ALPHA, rel_width: float = ADAPTIVE_REL_WIDTH) -> t.Optional[bool]:
+    """True once the rewrite is significantly faster, False once it is significantly slower or the
+    confidence interval of the difference is narrower than rel_width of the input latency, None
+    while more samples are needed. Welch's t-test at the (stricter than final) level alpha."""
+    import numpy as np
+    from scipy import stats
+    a, b = np.asarray(input_times, dtype=float), np.asarray(output_times, dtype=float)
+    va, vb = a.var(ddof=1) / len(a), b.var(ddof=1) / len(b)
+    se = np.sqrt(va + vb)
+    if se == 0:
+        return bool(a.mean() > b.mean())
+    df = (va + vb) ** 2 / (va ** 2 / (len(a) - 1) + vb ** 2 / (len(b) - 1))
+    statistic = (a.mean() - b.mean()) / se
+    if stats.t.sf(statistic, df) < alpha:
+        return True
+    if stats.t.cdf(statistic, df) < alpha:
+        return False
+    if stats.t.ppf(1 - alpha / 2, df) * se < rel_width * a.mean():
+        return False
+    return None
+
+def measure_latencies(sqls: t.List[str], db_args: DBArgs, timeout: int, **kwargs) -> t.Dict[str, t.Tuple[float, t.List[float]]]:
+    return LatencyScheduler(db_args, timeout, **kwargs).measure(sqls)
+
+def compare_latencies(pairs: t.List[t.Tuple[str, t.List[str]]], db_args: DBArgs, timeout: int, **kwargs) -> t.List[t.Tuple[t.Tuple[float, t.List[float]], t.Dict[str, t.Dict]]]:
+    return LatencyScheduler(db_args, timeout, **kwargs).compare_all(pairs)
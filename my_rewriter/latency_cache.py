@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import typing as t
+from collections.abc import MutableMapping
+
+if __name__ == '__main__':
+    sys.path.append('..')
+from my_rewriter.config import CACHE_PATH
+from my_rewriter.cost_cache import normalize_sql
+from my_rewriter.sqlite_utils import connect_sqlite, hash_key
+
+class LatencyCache(MutableMapping):
+    """Measured latencies of one database in SQLite, keyed by the hash of the normalized SQL.
+
+    A drop-in for the dict of `{'time', 'times'}` records that DBArgs used to load from
+    `<dbname>.jsonl`. Lookups hit the index instead of loading every record, and values are
+    copies, so a record is updated by assigning it again. Records measured on another server
+    version are ignored. Records imported from the JSONL file have no server version and are
+    always served. New lines of the JSONL file are imported on open.
+    """
+
+    def __init__(self, path: str, jsonl_path: t.Optional[str] = None, server_version: t.Optional[t.Callable[[], str]] = None):
+        self.path = path
+        self.server_version = server_version
+        self.lock = threading.Lock()
+        self.conn = connect_sqlite(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS latencies (key TEXT PRIMARY KEY, sql TEXT, time REAL, times TEXT, runs INTEGER, timeouts INTEGER, censored INTEGER, server_version TEXT, updated_at REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS imports (path TEXT PRIMARY KEY, offset INTEGER)')
+        if jsonl_path is not None and os.path.exists(jsonl_path):
+            self.import_jsonl(jsonl_path)
+
+    def _version(self) -> t.Optional[str]:
+        return self.server_version() if self.server_version is not None else None
+
+    @staticmethod
+    def _row(key: str, sql: str, record: t.Dict, server_version: t.Optional[str]) -> tuple:
+        times = record.get('times')
+        timeouts = record.get('timeouts', int(bool(record.get('censored'))))
+        return (key, sql, record['time'], json.dumps(times) if times is not None else None, len(times) if times is not None else 1, timeouts, int(bool(record.get('censored'))), server_version, time.time())
+
+    def import_jsonl(self, jsonl_path: str) -> int:
+        """Import the lines appended to jsonl_path since the last import, later lines winning."""
+        with self.lock:
+            row = self.conn.execute('SELECT offset FROM imports WHERE path = ?', (os.path.abspath(jsonl_path),)).fetchone()
+            offset = row[0] if row is not None else 0
+            if offset > os.path.getsize(jsonl_path):
+                # the file was rewritten, e.g. by export_jsonl
+                offset = 0
+            with open(jsonl_path, 'rb') as fin:
+                fin.seek(offset)
+                lines = fin.read().split(b'\n')
+            # the last element is empty, or a line whose write is still in progress
+            complete, offset = lines[:-1], offset + sum([len(line) + 1 for line in lines[:-1]])
+            rows = []
+            for line in complete:
+                if line.strip():
+                    obj = json.loads(line)
+                    rows.append(self._row(hash_key(normalize_sql(obj['sql'])), obj['sql'], obj, None))
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('INSERT OR REPLACE INTO latencies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.conn.execute('INSERT OR REPLACE INTO imports VALUES (?, ?)', (os.path.abspath(jsonl_path), offset))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    def __getitem__(self, sql: str) -> t.Dict:
+        with self.lock:
+            row = self.conn.execute('SELECT time, times, censored, server_version FROM latencies WHERE key = ?', (hash_key(normalize_sql(sql)),)).fetchone()
+        if row is None or (row[3] is not None and row[3] != self._version()):
+            raise KeyError(sql)
+        record = {'time': row[0]}
+        if row[1] is not None:
+            record['times'] = json.loads(row[1])
+        if row[2]:
+            record['censored'] = True
+        return record
+
+    def __setitem__(self, sql: str, record: t.Dict):
+        row = self._row(hash_key(normalize_sql(sql)), sql, record, self._version())
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO latencies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def __delitem__(self, sql: str):
+        with self.lock:
+            cur = self.conn.execute('DELETE FROM latencies WHERE key = ?', (hash_key(normalize_sql(sql)),))
+        if cur.rowcount == 0:
+            raise KeyError(sql)
+
+    def __iter__(self) -> t.Iterator[str]:
+        with self.lock:
+            sqls = [row[0] for row in self.conn.execute('SELECT sql FROM latencies')]
+        return iter(sqls)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM latencies').fetchone()[0]
+
+    def compact(self, keep_censored: bool = False) -> int:
+        """Drop records of other server versions (and censored ones), then reclaim the space."""
+        version = self._version()
+        with self.lock:
+            cur = self.conn.execute('DELETE FROM latencies WHERE server_version IS NOT NULL AND server_version != ?', (version,)) if version is not None else None
+            deleted = cur.rowcount if cur is not None else 0
+            if not keep_censored:
+                deleted += self.conn.execute('DELETE FROM latencies WHERE censored = 1').rowcount
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.conn.execute('VACUUM')
+        return deleted
+
+    def export_jsonl(self, jsonl_path: str):
+        # one line per query, e.g. to replace an append-only file that has grown with duplicates
+        tmp_path = f'{jsonl_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fout:
+            for sql in self:
+                try:
+                    fout.write(json.dumps({'sql': sql, **self[sql]}) + '\n')
+                except KeyError:
+                    continue
+        os.replace(tmp_path, jsonl_path)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO imports VALUES (?, ?)', (os.path.abspath(jsonl_path), os.path.getsize(jsonl_path)))
+
+def get_latency_cache_paths(dbname: str) -> t.Tuple[str, str]:
+    return os.path.join(CACHE_PATH, f'{dbname}.sqlite'), os.path.join(CACHE_PATH, f'{dbname}.jsonl')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, choices=['import', 'compact', 'export', 'stats'])
+    parser.add_argument('--dbname', type=str, required=True)
+    parser.add_argument('--server_version', type=str, default=None, help='server_version_num to keep when compacting, records of other versions are dropped')
+    parser.add_argument('--keep_censored', action='store_true', help='keep lower bounds of cancelled runs when compacting')
+    args = parser.parse_args()
+
+    path, jsonl_path = get_latency_cache_paths(args.dbname)
+    cache = LatencyCache(path, server_version=(lambda: args.server_version) if args.server_version else None)
+    if args.command == 'import':
+        print(f'Imported {cache.import_jsonl(jsonl_path)} records from {jsonl_path}')
+    elif args.command == 'compact':
+        print(f'Dropped {cache.compact(keep_censored=args.keep_censored)} records, {len(cache)} left')
+    elif args.command == 'export':
+        cache.export_jsonl(jsonl_path)
+        print(f'Exported {len(cache)} records to {jsonl_path}')
+    print(f'{path}: {len(cache)} records, {os.path.getsize(path)} bytes')
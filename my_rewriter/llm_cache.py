@@ -0,0 +1,93 @@
+import json
+import time
+import threading
+import typing as t
+
+from my_rewriter.config import LLM_CACHE_PATH, LLM_CACHE_MODE, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL
+from my_rewriter.sqlite_utils import connect_sqlite, hash_key
+
+if t.TYPE_CHECKING:
+    from llama_index.core.llms import LLM
+
+LLM_CACHE_MODES = ['off', 'read_write', 'replay']
+
+class LLMCacheMiss(KeyError):
+    pass
+
+def get_llm_identity(llm: 'LLM') -> t.Tuple[str, t.Optional[float]]:
+    model_name = getattr(llm, 'model', None) or type(llm).__name__
+    temperature = getattr(llm, 'temperature', None)
+    return str(model_name), temperature
+
+class LLMCache(object):
+
+    def __init__(self, path: str, mode: str = 'read_write', max_entries: t.Optional[int] = None, ttl: t.Optional[float] = None):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f'Invalid LLM cache mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = None
+        self.size = 0
+        if mode != 'off':
+            self.conn = connect_sqlite(path)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, temperature REAL, response TEXT, created_at REAL, accessed_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+            if ttl is not None:
+                self.conn.execute('DELETE FROM responses WHERE created_at < ?', (time.time() - ttl,))
+            self.size = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(model_name: str, temperature: t.Optional[float], messages: t.List[t.Dict]) -> str:
+        messages_hash = hash_key(json.dumps(messages, sort_keys=True, ensure_ascii=False))
+        return hash_key(model_name, str(temperature), messages_hash)
+
+    def lookup(self, llm: 'LLM', messages: t.List[t.Dict]) -> t.Optional[str]:
+        if self.mode == 'off':
+            return None
+        model_name, temperature = get_llm_identity(llm)
+        key = self.key(model_name, temperature, messages)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT response, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= 1
+                row = None
+            if row is not None:
+                self.conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        if row is None:
+            if self.mode == 'replay':
+                raise LLMCacheMiss(f'No cached response of {model_name} (temperature={temperature}) for messages: {messages}')
+            return None
+        return row[0]
+
+    def store(self, llm: 'LLM', messages: t.List[t.Dict], response: str):
+        if self.mode != 'read_write':
+            return
+        model_name, temperature = get_llm_identity(llm)
+        key = self.key(model_name, temperature, messages)
+        now = time.time()
+        with self.lock:
+            exists = self.conn.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone() is not None
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, model_name, temperature, response, now, now))
+            if not exists:
+                self.size += 1
+            if self.max_entries is not None and self.size > self.max_entries:
+                # evict least recently used responses
+                self.conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)', (self.size - self.max_entries,))
+                self.size = self.max_entries
+
+_llm_cache: t.Optional[LLMCache] = None
+
+def get_llm_cache() -> LLMCache:
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMCache(LLM_CACHE_PATH, mode=LLM_CACHE_MODE, max_entries=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL)
+    return _llm_cache
+
+def set_llm_cache_mode(mode: str):
+    global _llm_cache
+    _llm_cache = LLMCache(LLM_CACHE_PATH, mode=mode, max_entries=LLM_CACHE_MAX_ENTRIES, ttl=LLM_CACHE_TTL)
@@ -0,0 +1,198 @@
+import asyncio
+import time
+import random
+import logging
+import threading
+import typing as t
+import functools
+
+from my_rewriter.config import LLM_MAX_IN_FLIGHT, LLM_TOKENS_PER_MINUTE, LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX
+
+if t.TYPE_CHECKING:
+    from llama_index.core.base.llms.types import ChatResponse
+
+POLL_INTERVAL = 0.05  # seconds between async attempts to take an in-flight slot
+
+@functools.lru_cache(maxsize=None)
+def get_retryable_errors() -> t.Tuple[t.Type[Exception], ...]:
+    # openai is imported with the first request rather than with this module
+    import openai
+    return (ConnectionResetError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+def estimate_tokens(messages: t.List[t.Dict]) -> int:
+    # roughly 4 characters per token for English text and SQL
+    return sum([len(str(m.get('content', ''))) for m in messages]) // 4 + 1
+
+def get_token_counts(response: 'ChatResponse') -> t.Dict[str, int]:
+    usage = response.additional_kwargs or {}
+    return {k: int(usage[k]) for k in ['prompt_tokens', 'completion_tokens', 'total_tokens'] if k in usage}
+
+def get_token_usage(response: 'ChatResponse') -> t.Optional[int]:
+    usage = response.additional_kwargs or {}
+    if 'total_tokens' in usage:
+        return int(usage['total_tokens'])
+    return None
+
+class LLMScheduler(object):
+    """Bounds in-flight LLM requests and tokens per minute across threads and event loops.
+
+    The in-flight limit adapts: it is halved when the provider rate-limits a request
+    and grows back by one slot per `limit` successful requests.
+    """
+
+    def __init__(self, max_in_flight: int = 16, tokens_per_minute: t.Optional[int] = None, max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.limit = float(max_in_flight)
+        self.tokens = float(tokens_per_minute) if tokens_per_minute else 0.0
+        self.refill_time = time.monotonic()
+
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.used_tokens = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def _try_acquire_slot(self) -> bool:
+        with self.cond:
+            if self.in_flight < max(1, int(self.limit)):
+                self.in_flight += 1
+                return True
+            return False
+
+    def _release_slot(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def _reserve_tokens(self, n: int) -> float:
+        # token bucket that may go into debt, returns the seconds to wait until the reservation is covered
+        if not self.tokens_per_minute:
+            return 0.0
+        with self.cond:
+            now = time.monotonic()
+            rate = self.tokens_per_minute / 60.0
+            self.tokens = min(float(self.tokens_per_minute), self.tokens + (now - self.refill_time) * rate)
+            self.refill_time = now
+            self.tokens -= min(n, self.tokens_per_minute)
+            return max(0.0, -self.tokens / rate)
+
+    def _refund_tokens(self, n: int):
+        if not self.tokens_per_minute:
+            return
+        with self.cond:
+            self.tokens = min(float(self.tokens_per_minute), self.tokens + n)
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _on_start(self, queue_time: float):
+        with self.cond:
+            self.requests += 1
+            self.queue_time_total += queue_time
+            self.queue_time_max = max(self.queue_time_max, queue_time)
+
+    def _on_success(self, estimated_tokens: int, response: 'ChatResponse'):
+        used_tokens = get_token_usage(response)
+        if used_tokens is None:
+            used_tokens = estimated_tokens
+        elif used_tokens > estimated_tokens:
+            self._reserve_tokens(used_tokens - estimated_tokens)
+        else:
+            self._refund_tokens(estimated_tokens - used_tokens)
+        with self.cond:
+            self.used_tokens += used_tokens
+            self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+
+    def _on_error(self, e: Exception, attempt: int) -> float:
+        import openai
+        with self.cond:
+            self.retries += 1
+            if isinstance(e, openai.RateLimitError):
+                self.rate_limited += 1
+                self.limit = max(1.0, self.limit / 2)
+        delay = self._backoff(attempt)
+        logging.warning(f'LLM request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s')
+        return delay
+
+    async def arun(self, fn: t.Callable[[], t.Awaitable['ChatResponse']], messages: t.List[t.Dict]) -> t.Tuple['ChatResponse', float]:
+        start = time.monotonic()
+        while not self._try_acquire_slot():
+            await asyncio.sleep(POLL_INTERVAL)
+        try:
+            estimated_tokens = estimate_tokens(messages)
+            wait = self._reserve_tokens(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            queue_time = time.monotonic() - start
+            self._on_start(queue_time)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await fn()
+                    break
+                except get_retryable_errors() as e:
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self._on_error(e, attempt))
+            self._on_success(estimated_tokens, response)
+            return response, queue_time
+        finally:
+            self._release_slot()
+
+    def run(self, fn: t.Callable[[], 'ChatResponse'], messages: t.List[t.Dict]) -> t.Tuple['ChatResponse', float]:
+        start = time.monotonic()
+        with self.cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.cond.wait(POLL_INTERVAL)
+            self.in_flight += 1
+        try:
+            estimated_tokens = estimate_tokens(messages)
+            wait = self._reserve_tokens(estimated_tokens)
+            if wait > 0:
+                time.sleep(wait)
+            queue_time = time.monotonic() - start
+            self._on_start(queue_time)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = fn()
+                    break
+                except get_retryable_errors() as e:
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self._on_error(e, attempt))
+            self._on_success(estimated_tokens, response)
+            return response, queue_time
+        finally:
+            self._release_slot()
+
+    def get_metrics(self) -> t.Dict[str, float]:
+        with self.cond:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'used_tokens': self.used_tokens,
+                'in_flight_limit': int(self.limit),
+                'avg_queue_time': self.queue_time_total / self.requests if self.requests > 0 else 0.0,
+                'max_queue_time': self.queue_time_max
+            }
+
+_llm_scheduler: t.Optional[LLMScheduler] = None
+
+def get_llm_scheduler() -> LLMScheduler:
+    global _llm_scheduler
+    if _llm_scheduler is None:
+        _llm_scheduler = LLMScheduler(LLM_MAX_IN_FLIGHT, tokens_per_minute=LLM_TOKENS_PER_MINUTE, max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX)
+    return _llm_scheduler
+
+def set_llm_scheduler_limits(max_in_flight: int = LLM_MAX_IN_FLIGHT, tokens_per_minute: t.Optional[int] = LLM_TOKENS_PER_MINUTE):
+    global _llm_scheduler
+    _llm_scheduler = LLMScheduler(max_in_flight, tokens_per_minute=tokens_per_minute, max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX)
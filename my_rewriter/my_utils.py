@@ -3,42 +3,68 @@ import typing as t
 import re
 import logging
 import time
-import openai
 from collections import defaultdict
 import asyncio
-
-from llama_index.core.llms import LLM
-from llama_index.core.base.llms.types import ChatMessage
-from llama_index.core import Settings
-from llama_index.core.schema import (
-    BaseNode,
-    TextNode,
-    NodeWithScore
-)
-from llama_index.llms.openai import OpenAI
+import functools
 
 from my_rewriter.case_rules import case_rules, add_case_rules
-from rag.gen_rewrites_from_rules import calcite_rules
-
-def chat(messages: List[Dict]) -> str:
-    chat_messages = [ChatMessage(**m) for m in messages]
+from my_rewriter.llm_cache import get_llm_cache
+from my_rewriter.llm_scheduler import get_llm_scheduler, get_token_counts
+from my_rewriter.query_trace import trace_event
+from rag.gen_rewrites_from_rules import get_calcite_rules
+
+# llama_index takes most of a second to import, so it is imported by the functions that use it
+if t.TYPE_CHECKING:
+    from llama_index.core.llms import LLM
+    from llama_index.core.schema import NodeWithScore
+
+def run_async(task: t.Awaitable) -> t.Any:
+    from llama_index.core.async_utils import run_async_tasks
+    return run_async_tasks([task])[0]
+
+def chat(messages: List[Dict], model: 'LLM' = None) -> str:
+    from llama_index.core import Settings
+    from llama_index.core.base.llms.types import ChatMessage
+    if model is None:
+        model = Settings.llm
     start = time.time()
-    response = Settings.llm.chat(chat_messages)
-    logging.debug({'messages': messages, 'response': response.message.content, 'time': time.time() - start})
-    return response.message.content
-
-async def achat(messages: List[Dict], model: LLM = None) -> str:
+    start_ns = time.monotonic_ns()
+    queue_time = 0.0
+    token_counts = {}
+    llm_cache = get_llm_cache()
+    content = llm_cache.lookup(model, messages)
+    cached = content is not None
+    if content is None:
+        chat_messages = [ChatMessage(**m) for m in messages]
+        response, queue_time = get_llm_scheduler().run(lambda: model.chat(chat_messages), messages)
+        content = response.message.content
+        token_counts = get_token_counts(response)
+        llm_cache.store(model, messages, content)
+    logging.debug({'messages': messages, 'response': content, 'time': time.time() - start, 'queue_time': queue_time})
+    trace_event('llm', 'chat', start_ns=start_ns, queue_ns=int(queue_time * 1e9), cached=cached, **token_counts)
+    return content
+
+async def achat(messages: List[Dict], model: 'LLM' = None) -> str:
+    from llama_index.core import Settings
+    from llama_index.core.base.llms.types import ChatMessage
     if model is None:
         model = Settings.llm
-    chat_messages = [ChatMessage(**m) for m in messages]
     start = time.time()
-    try:
-        response = await model.achat(chat_messages)
-    except (ConnectionResetError, openai.APIConnectionError):
-        time.sleep(5)
-        response = await model.achat(chat_messages)
-    logging.debug({'messages': messages, 'response': response.message.content, 'time': time.time() - start})
-    return response.message.content
+    start_ns = time.monotonic_ns()
+    queue_time = 0.0
+    token_counts = {}
+    llm_cache = get_llm_cache()
+    content = llm_cache.lookup(model, messages)
+    cached = content is not None
+    if content is None:
+        chat_messages = [ChatMessage(**m) for m in messages]
+        response, queue_time = await get_llm_scheduler().arun(lambda: model.achat(chat_messages), messages)
+        content = response.message.content
+        token_counts = get_token_counts(response)
+        llm_cache.store(model, messages, content)
+    logging.debug({'messages': messages, 'response': content, 'time': time.time() - start, 'queue_time': queue_time})
+    trace_event('llm', 'chat', start_ns=start_ns, queue_ns=int(queue_time * 1e9), cached=cached, **token_counts)
+    return content
 
 def get_rule_sets(rule_names: t.List[str]) -> t.Dict[str, t.List[str]]:
     rule_groups_dict  = {}
@@ -126,14 +152,17 @@ RULE_DIVISIONS = [
     'INTERSECT_TO_DISTINCT']
 ]
 
-rule_groups = []
-for rule_group in RULE_DIVISIONS:
-    rules = []
-    for rule_name in rule_group:
-        sub_rules = calcite_rules[rule_name]
-        rule_str = f'### Rule {rule_name}:\n{sub_rules}'
-        rules.append(rule_str)
-    rule_groups.append('\n\n'.join(rules))
+@functools.lru_cache(maxsize=None)
+def get_rule_groups() -> t.List[str]:
+    rule_groups = []
+    for rule_group in RULE_DIVISIONS:
+        rules = []
+        for rule_name in rule_group:
+            sub_rules = get_calcite_rules()[rule_name]
+            rule_str = f'### Rule {rule_name}:\n{sub_rules}'
+            rules.append(rule_str)
+        rule_groups.append('\n\n'.join(rules))
+    return rule_groups
 
 CALCITE_OPERATOR_GROUPS = [['AGGREGATE'], ['CORRELATE'], ['FILTER'], ['INTERSECT', 'MINUS', 'UNION', 'SET_OP'], ['JOIN'], ['PROJECT'], ['SORT'], ['VALUES'], ['WINDOW']]
 
@@ -179,14 +208,14 @@ class MyModel:
                 list_str = response[start_idx + len(prefix): end_idx].strip()
                 try:
                     rule_names = eval(list_str)
-                    return [rule_name.upper() for rule_name in rule_names if rule_name.upper() in calcite_rules]
+                    return [rule_name.upper() for rule_name in rule_names if rule_name.upper() in get_calcite_rules()]
                 except:
                     pass
         return []
 
-    async def select_rules_from_cases(self, retriever_res: List[NodeWithScore], normal_rules: List[t.Dict[str, str]], explore_rules: List[t.Dict[str, str]]) -> t.List[t.List[t.Dict[str, str]]]:
+    async def select_rules_from_cases(self, retriever_res: List['NodeWithScore'], normal_rules: List[t.Dict[str, str]], explore_rules: List[t.Dict[str, str]]) -> t.List[t.List[t.Dict[str, str]]]:
         normal_rule_names = [obj['name'] for obj in normal_rules]
-        selected_rules = [[{'name': name, 'rewrite': calcite_rules[name]} for name in normal_rule_names]]
+        selected_rules = [[{'name': name, 'rewrite': get_calcite_rules()[name]} for name in normal_rule_names]]
 
         selected_case_rules = defaultdict(float)
         task_names = []
@@ -201,7 +230,7 @@ class MyModel:
                         selected_case_rules[r] += node.score
                 continue
             
-            for i, rules_str in enumerate(rule_groups):
+            for i, rules_str in enumerate(get_rule_groups()):
                 task_names.append((node.id_, i))
                 task_scores.append(node.score)
                 tasks.append(self.select_case_rules(node.text, rules_str))
@@ -220,14 +249,14 @@ class MyModel:
         logging.info('Selected Rules from Retrieved Rewrite Cases: ' + str(sorted_selected_case_rule_names))
         # sorted_selected_case_rule_names = sorted_selected_case_rule_names[:similarity_top_k]
 
-        sorted_selected_case_rules = [{'name': name, 'rewrite': calcite_rules[name]} for name in sorted_selected_case_rule_names]
+        sorted_selected_case_rules = [{'name': name, 'rewrite': get_calcite_rules()[name]} for name in sorted_selected_case_rule_names]
         selected_rules.append(sorted_selected_case_rules)
 
-        left_explore_rules = [{'name': r['name'], 'rewrite': calcite_rules[r['name']]} for r in explore_rules if r['name'] not in sorted_selected_case_rule_names]
+        left_explore_rules = [{'name': r['name'], 'rewrite': get_calcite_rules()[r['name']]} for r in explore_rules if r['name'] not in sorted_selected_case_rule_names]
         selected_rules.append(left_explore_rules)
         return selected_rules
 
-    async def gen_all_rewrites_from_cases(self, query: str, retriever_res: List[NodeWithScore], case_batch: int = 5) -> List[str]:
+    async def gen_all_rewrites_from_cases(self, query: str, retriever_res: List['NodeWithScore'], case_batch: int = 5) -> List[str]:
         tasks = []
         cases_suggestions = []
         for i in range(0, len(retriever_res), case_batch):
@@ -239,10 +268,10 @@ class MyModel:
             cases_suggestions.extend(cur_cases_suggestions)
         return cases_suggestions
 
-    def cluster_rewrites(self, query: str, strategies_str: str, strategies: t.List[str]) -> t.List[t.List[str]]:
+    async def acluster_rewrites(self, query: str, strategies_str: str, strategies: t.List[str]) -> t.List[t.List[str]]:
         messages = [{'role': 'system', 'content': self.CLUSTER_REWRITE_SYS_PROMPT}, {'role': 'user', 'content': self.CLUSTER_REWRITE_USER_PROMPT.format(sql=query, strategies=strategies_str)}]
         for _ in range(2):
-            response = chat(messages)
+            response = await achat(messages)
             
             prefix = '```python'
             suffix = '```'
@@ -261,6 +290,9 @@ class MyModel:
         logging.warn(f"Failed to cluster rewrite strategies: {response}")
         return [strategies]
 
+    def cluster_rewrites(self, query: str, strategies_str: str, strategies: t.List[str]) -> t.List[t.List[str]]:
+        return run_async(self.acluster_rewrites(query, strategies_str, strategies))
+
     async def summarize_rewrites(self, query: str, strategies_str: str, cluster: t.List[str]) -> str:
         if len(cluster) == 1:
             return cluster[0]
@@ -272,7 +304,7 @@ class MyModel:
     async def summarize_all_strategies(self, query: str, strategies: List[str]) -> List[str]:
         strategies_str = '\n\n'.join([f'Query Rewrite {i + 1}:\n"""{s}"""' for i, s in enumerate(strategies)])
         logging.info('Generated Rewrite Strategies:\n' + strategies_str)
-        strategy_clusters = self.cluster_rewrites(query, strategies_str, strategies)
+        strategy_clusters = await self.acluster_rewrites(query, strategies_str, strategies)
 
         tasks = []
         for cluster in strategy_clusters:
@@ -281,13 +313,13 @@ class MyModel:
         task_results = await asyncio.gather(*tasks)
         return task_results
 
-    async def gen_summarize_strategies(self, query: str, retriever_res: List[NodeWithScore], strategies: List[str], case_batch: int = 5) -> t.List[str]:
+    async def gen_summarize_strategies(self, query: str, retriever_res: List['NodeWithScore'], strategies: List[str], case_batch: int = 5) -> t.List[str]:
         cases_suggestions = await self.gen_all_rewrites_from_cases(query, retriever_res, case_batch=case_batch)
         all_strategies = strategies + cases_suggestions
         summarized_strategies = await self.summarize_all_strategies(query, all_strategies)
         return summarized_strategies
 
-    def arrange_rule_sets(self, query: str, suggestions_str: str, rule_names: t.List[str], rules_str: str) -> t.List[t.List[str]]:
+    async def aarrange_rule_sets(self, query: str, suggestions_str: str, rule_names: t.List[str], rules_str: str) -> t.List[t.List[str]]:
         rule_groups_dict = get_rule_sets(rule_names)
         if len(rule_groups_dict) == 0:
             return []
@@ -296,7 +328,7 @@ class MyModel:
 
         arranged_rule_sets = []
         for _ in range(2):
-            response = chat(messages)
+            response = await achat(messages)
             
             res = re.findall(r'```python\s*(.+?)\s*```', response, re.I | re.DOTALL)
             for python_content in res:
@@ -310,16 +342,19 @@ class MyModel:
         logging.warn(f"Failed to arrange selected rule sets: {response}")
         return []
 
-    def arrange_rules(self, query: str, suggestions_str: str, selected_rules: t.List[t.Dict[str, str]]) -> t.List[str]:
+    def arrange_rule_sets(self, query: str, suggestions_str: str, rule_names: t.List[str], rules_str: str) -> t.List[t.List[str]]:
+        return run_async(self.aarrange_rule_sets(query, suggestions_str, rule_names, rules_str))
+
+    async def aarrange_rules(self, query: str, suggestions_str: str, selected_rules: t.List[t.Dict[str, str]]) -> t.List[str]:
         rules_str = '\n\n'.join([f'### Rule {r["name"]}:\n"""{r["rewrite"]}"""' for r in selected_rules])
         rule_names = [r['name'] for r in selected_rules]
-        arranged_rule_sets: t.List[t.List[str]] = self.arrange_rule_sets(query, suggestions_str, rule_names, rules_str)
+        arranged_rule_sets: t.List[t.List[str]] = await self.aarrange_rule_sets(query, suggestions_str, rule_names, rules_str)
         logging.info(f'Arranged Rule Sets: {arranged_rule_sets}')
         arranged_rule_sets_str = '\n\n'.join([f'### Rule Sequence {i+1}: ' + str(seq).replace("'", '"') for i, seq in enumerate(arranged_rule_sets)])
         messages = [{'role': 'system', 'content': self.ARRANGE_RULES_SYS_PROMPT}, {'role': 'user', 'content': self.ARRANGE_RULES_USER_PROMPT.format(sql=query, suggestions=suggestions_str, rules=rules_str, rule_sequences=arranged_rule_sets_str)}]
 
         for _ in range(2):
-            response = chat(messages)
+            response = await achat(messages)
             
             prefix = '```python'
             suffix = '```'
@@ -337,14 +372,17 @@ class MyModel:
         logging.warn(f"Failed to arrange selected rules: {response}")
         return rule_names
 
-    def rearrange_rules(self, query: str, suggestions_str: str, selected_rules: t.List[t.Dict[str, str]], arranged_rules: t.List[str], used_rules: t.List[str]) -> t.List[str]:
+    def arrange_rules(self, query: str, suggestions_str: str, selected_rules: t.List[t.Dict[str, str]]) -> t.List[str]:
+        return run_async(self.aarrange_rules(query, suggestions_str, selected_rules))
+
+    async def arearrange_rules(self, query: str, suggestions_str: str, selected_rules: t.List[t.Dict[str, str]], arranged_rules: t.List[str], used_rules: t.List[str]) -> t.List[str]:
         rules_str = '\n\n'.join([f'### Rule {r["name"]}:\n"""{r["rewrite"]}"""' for r in selected_rules])
         rule_names = [r['name'] for r in selected_rules]
         unused_rules = [r for r in arranged_rules if r not in used_rules]
         messages = [{'role': 'system', 'content': self.REARRANGE_RULES_SYS_PROMPT}, {'role': 'user', 'content': self.REARRANGE_RULES_USER_PROMPT.format(sql=query, suggestions=suggestions_str, rules=rules_str, arranged_rules=str(arranged_rules).replace("'", '"'), used_rules=str(used_rules).replace("'", '"'), unused_rules=str(unused_rules).replace("'", '"'))}]
 
         for _ in range(2):
-            response = chat(messages)
+            response = await achat(messages)
             
             prefix = '```python'
             suffix = '```'
@@ -362,12 +400,15 @@ class MyModel:
         logging.warn(f"Failed to re-arrange selected rules: {response}")
         return rule_names
 
-    def select_rules(self, query: str, suggestions_str: str, rules: t.List[t.Dict[str, str]]) -> t.List[t.Dict[str, str]]:
+    def rearrange_rules(self, query: str, suggestions_str: str, selected_rules: t.List[t.Dict[str, str]], arranged_rules: t.List[str], used_rules: t.List[str]) -> t.List[str]:
+        return run_async(self.arearrange_rules(query, suggestions_str, selected_rules, arranged_rules, used_rules))
+
+    async def aselect_rules(self, query: str, suggestions_str: str, rules: t.List[t.Dict[str, str]]) -> t.List[t.Dict[str, str]]:
         rules_str = '\n\n'.join([f'### Rule {r["name"]}:\n"""{r["rewrite"]}"""' for i, r in enumerate(rules)])
         messages = [{'role': 'system', 'content': self.SELECT_RULES_SYS_PROMPT}, {'role': 'user', 'content': self.SELECT_RULES_USER_PROMPT.format(sql=query, suggestions=suggestions_str, rules=rules_str)}]
 
         for _ in range(2):
-            response = chat(messages)
+            response = await achat(messages)
             
             prefix = '```python'
             suffix = '```'
@@ -387,6 +428,9 @@ class MyModel:
         logging.warn(f"Failed to select relevant rules: {response}")
         return []
 
+    def select_rules(self, query: str, suggestions_str: str, rules: t.List[t.Dict[str, str]]) -> t.List[t.Dict[str, str]]:
+        return run_async(self.aselect_rules(query, suggestions_str, rules))
+
     def select_arrange_rules(self, query: str, selected_rules: t.List[t.Dict[str, str]]) -> t.List[str]:
         rules_str = '\n\n'.join([f'### Rule {r["name"]}:\n"""{r["description"]}"""' for r in selected_rules])
         rule_names = [r['name'] for r in selected_rules]
@@ -410,7 +454,7 @@ class MyModel:
         logging.warn(f"Failed to perform LLM-only rule-based rewrite: {response}")
         return []
     
-    def rag_select_arrange_rules(self, query: str, selected_rules: t.List[t.Dict[str, str]], retrieved_rules: t.List[t.Dict[str, str]], retrieved_qas: t.List[NodeWithScore]) -> t.List[str]:
+    def rag_select_arrange_rules(self, query: str, selected_rules: t.List[t.Dict[str, str]], retrieved_rules: t.List[t.Dict[str, str]], retrieved_qas: t.List['NodeWithScore']) -> t.List[str]:
         rules_str = '\n\n'.join([f'### Rule {r["name"]}:\n"""{r["description"]}"""' for r in selected_rules])
         rule_names = [r['name'] for r in selected_rules]
         documents_str = '\n\n'.join([f'"""### Rule {r["name"]}:\n{r["description"]}"""' for r in retrieved_rules] + [f'"""{r.text}"""' for r in retrieved_qas])
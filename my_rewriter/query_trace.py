@@ -0,0 +1,69 @@
+import json
+import time
+import threading
+import contextvars
+import contextlib
+import typing as t
+
+TRACE_SUFFIX = '.trace.jsonl'
+
+class QueryTrace(object):
+    """Structured events of one query, written as JSON lines to `<name>.trace.jsonl` next to its log.
+
+    Each event has a `kind`, a `name`, and `start_ns`/`end_ns` from a monotonic clock, relative to
+    the start of the trace. Events are written as they happen, so a crashed run keeps its prefix,
+    and a rerun of the query replaces the trace rather than adding a second copy of its events.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start_ns = time.monotonic_ns()
+        self.fout = open(path, 'w')
+
+    def record(self, kind: str, name: str, start_ns: int, end_ns: int, **fields):
+        line = json.dumps({'kind': kind, 'name': name, 'start_ns': start_ns - self.start_ns, 'end_ns': end_ns - self.start_ns, **fields})
+        with self.lock:
+            self.fout.write(line + '\n')
+            self.fout.flush()
+
+    def close(self):
+        with self.lock:
+            self.fout.close()
+
+_query_trace: contextvars.ContextVar[t.Optional[QueryTrace]] = contextvars.ContextVar('query_trace', default=None)
+
+@contextlib.contextmanager
+def query_trace(trace_filename: str):
+    trace = QueryTrace(trace_filename)
+    token = _query_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _query_trace.reset(token)
+        trace.close()
+
+def trace_event(kind: str, name: str, start_ns: t.Optional[int] = None, **fields):
+    """Record an event of the query traced in the current context, if any; start_ns defaults to now."""
+    trace = _query_trace.get()
+    if trace is None:
+        return
+    end_ns = time.monotonic_ns()
+    trace.record(kind, name, start_ns if start_ns is not None else end_ns, end_ns, **fields)
+
+@contextlib.contextmanager
+def trace_span(name: str, **fields):
+    """Time the body as a 'span' event; fields added to the yielded dict are recorded with it."""
+    start_ns = time.monotonic_ns()
+    try:
+        yield fields
+    finally:
+        trace_event('span', name, start_ns=start_ns, **fields)
+
+def read_trace(trace_filename: str) -> t.List[t.Dict]:
+    events = []
+    with open(trace_filename, 'r') as fin:
+        for line in fin:
+            if line.endswith('\n'):
+                events.append(json.loads(line))
+    return events
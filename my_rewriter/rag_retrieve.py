@@ -1,3 +1,4 @@
+import os
 import logging
 import sys
 from typing import Any, Dict, List, Optional, Sequence, Union, cast, Tuple
@@ -5,10 +6,10 @@ import typing as t
 from collections import defaultdict
 import json
 import itertools
+import threading
+import time
 
-import chromadb
 from llama_index.core import VectorStoreIndex, StorageContext, Settings
-from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 from llama_index.core.async_utils import run_async_tasks
@@ -17,81 +18,146 @@ from llama_index.core.schema import (
     TextNode,
     NodeWithScore
 )
-from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.core.retrievers import BaseRetriever
 
+from my_rewriter.config import CHROMA_DB_PATH, BLOCK_RETRIEVAL, DOCSTORE_SOURCE_PATH, DOCSTORE_PATH
 from my_rewriter.my_utils import achat
 from rag.my_query_fusion_retriver import MyQueryFusionRetriever, FUSION_MODES
 from rag.my_structure_retriever import MyStructureRetriever
-from rag.prompts import STACKOVERFLOW_QA_PROMPT
+from rag.block_index import BlockVectorIndex
+from rag.reference_index import ReferenceIndex, get_reference_index_path, build_reference_index
+from rag.binary_docstore import BinaryDocStore, load_docstore
 from rag.gen_rewrites_from_rules import gen_rewrites_from_rules
 
-def init_docstore() -> SimpleDocumentStore:
-    docstore = SimpleDocumentStore()
-
-    def read_docs(filename: str) -> Sequence[BaseNode]:
-        doc_nodes = []
-        with open(filename, 'r') as fin:
-            for line in fin.readlines():
-                obj = json.loads(line)
-                myid = f'{obj["id"]}-{obj["answer_id"]}'
-                doc = STACKOVERFLOW_QA_PROMPT.format(title=obj["question_title"], question_body=obj["question_body"], answer_body=obj["answer_body"])
-                text_node = TextNode(
-                    text=doc, 
-                    id_ = myid
-                )
-                doc_nodes.append(text_node)
-        return doc_nodes
-
-    doc_nodes = read_docs('../rag/stackoverflow-rewrite-query-optimization.jsonl')
-    docstore.add_documents(doc_nodes)
-    return docstore
-
-def rag_retrieve(query: str, schema: str, docstore: SimpleDocumentStore, embed_dim: int, RETRIEVER_TOP_K: int = 10) -> Dict:
-    # initialize client
-    db = chromadb.PersistentClient(path="../rag/chroma_db")
-
-    # get collection
-    stackoverflow_chroma_collection = db.get_or_create_collection("stackoverflow")
-
-    # assign chroma as the vector_store to the context
-    stackoverflow_vector_store = ChromaVectorStore(chroma_collection=stackoverflow_chroma_collection)
-    stackoverflow_storage_context = StorageContext.from_defaults(vector_store=stackoverflow_vector_store)
-
-    # load your index from stored vectors
-    stackoverflow_index = VectorStoreIndex.from_vector_store(
-        stackoverflow_vector_store, storage_context=stackoverflow_storage_context
-    )
-
-    stackoverflow_retriever = stackoverflow_index.as_retriever(similarity_top_k=RETRIEVER_TOP_K)
-
-    retriever = MyQueryFusionRetriever(docstore=docstore, qa_retriever=stackoverflow_retriever, schema=schema, embed_dim=embed_dim, mode=FUSION_MODES.RECIPROCAL_RANK, similarity_top_k=RETRIEVER_TOP_K, use_async=False, verbose=True)
+if t.TYPE_CHECKING:
+    import chromadb
+
+def init_docstore() -> BinaryDocStore:
+    return load_docstore(DOCSTORE_SOURCE_PATH, DOCSTORE_PATH)
+
+INDEX_COLLECTIONS = {'hybrid': 'stackoverflow', 'semantics': 'stackoverflow_summary', 'structure': 'stackoverflow_structure'}
+
+class RetrievalContext(object):
+    """Chroma client and vector indexes opened once and shared by every query (and thread) of a process."""
+
+    def __init__(self, path: str = CHROMA_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.client = None
+        self.collections = {}
+        self.indexes = {}
+        self.retrievers = {}
+        self.block_indexes = {}
+        self.reference_indexes = {}
+        self.timings = {}
+
+    def _get_client(self) -> 'chromadb.PersistentClient':
+        if self.client is None:
+            # chromadb is imported when the first index is opened
+            import chromadb
+            start = time.time()
+            self.client = chromadb.PersistentClient(path=self.path)
+            self.timings['client'] = time.time() - start
+        return self.client
+
+    def get_index(self, collection_name: str) -> VectorStoreIndex:
+        with self.lock:
+            if collection_name not in self.indexes:
+                client = self._get_client()
+                start = time.time()
+                collection = client.get_or_create_collection(collection_name)
+                from llama_index.vector_stores.chroma import ChromaVectorStore
+                vector_store = ChromaVectorStore(chroma_collection=collection)
+                storage_context = StorageContext.from_defaults(vector_store=vector_store)
+                self.collections[collection_name] = collection
+                self.indexes[collection_name] = VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context)
+                self.timings[collection_name] = time.time() - start
+            return self.indexes[collection_name]
+
+    def get_retriever(self, collection_name: str, similarity_top_k: int) -> BaseRetriever:
+        index = self.get_index(collection_name)
+        key = (collection_name, similarity_top_k)
+        with self.lock:
+            if key not in self.retrievers:
+                self.retrievers[key] = index.as_retriever(similarity_top_k=similarity_top_k)
+            return self.retrievers[key]
+
+    def get_block_index(self, collection_name: str) -> BlockVectorIndex:
+        self.get_index(collection_name)
+        with self.lock:
+            if collection_name not in self.block_indexes:
+                start = time.time()
+                self.block_indexes[collection_name] = BlockVectorIndex.from_collection(self.collections[collection_name])
+                self.timings[f'{collection_name}_block_index'] = time.time() - start
+            return self.block_indexes[collection_name]
+
+    def get_reference_index(self, collection_name: str) -> ReferenceIndex:
+        self.get_index(collection_name)
+        with self.lock:
+            if collection_name not in self.reference_indexes:
+                start = time.time()
+                path = get_reference_index_path(self.path, collection_name)
+                if os.path.exists(path):
+                    self.reference_indexes[collection_name] = ReferenceIndex.load(path)
+                else:
+                    # stores built before the reference index get one from their node metadata
+                    self.reference_indexes[collection_name] = build_reference_index(self.path, collection_name, collection=self.collections[collection_name])
+                self.timings[f'{collection_name}_references'] = time.time() - start
+            return self.reference_indexes[collection_name]
+
+    def warm_up(self, collection_names: t.Optional[t.List[str]] = None, block_retrieval: bool = BLOCK_RETRIEVAL) -> Dict[str, float]:
+        if collection_names is None:
+            collection_names = list(INDEX_COLLECTIONS.values())
+        for collection_name in collection_names:
+            self.get_index(collection_name)
+            collection = self.collections[collection_name]
+            # chroma loads the vector segment lazily, so run one query against a stored vector
+            start = time.time()
+            peek = collection.peek(1)
+            if peek['embeddings'] is not None and len(peek['embeddings']) > 0:
+                collection.query(query_embeddings=[peek['embeddings'][0]], n_results=1)
+            self.timings[f'{collection_name}_load'] = time.time() - start
+            self.get_reference_index(collection_name)
+            if block_retrieval and collection_name != INDEX_COLLECTIONS['semantics']:
+                self.get_block_index(collection_name)
+        return self.timings
+
+_retrieval_context: t.Optional[RetrievalContext] = None
+_retrieval_context_lock = threading.Lock()
+
+def get_retrieval_context() -> RetrievalContext:
+    global _retrieval_context
+    with _retrieval_context_lock:
+        if _retrieval_context is None:
+            _retrieval_context = RetrievalContext()
+        return _retrieval_context
+
+def rag_retrieve(query: str, schema: str, docstore: BinaryDocStore, embed_dim: int, RETRIEVER_TOP_K: int = 10, context: t.Optional[RetrievalContext] = None, block_retrieval: bool = BLOCK_RETRIEVAL) -> Dict:
+    if context is None:
+        context = get_retrieval_context()
+    start = time.time()
+    stackoverflow_retriever = context.get_retriever(INDEX_COLLECTIONS['hybrid'], RETRIEVER_TOP_K)
+    block_index = context.get_block_index(INDEX_COLLECTIONS['hybrid']) if block_retrieval else None
+    reference_index = context.get_reference_index(INDEX_COLLECTIONS['hybrid'])
+    logging.debug(f'Retriever Setup Time: {time.time() - start}')
+
+    retriever = MyQueryFusionRetriever(docstore=docstore, qa_retriever=stackoverflow_retriever, schema=schema, embed_dim=embed_dim, mode=FUSION_MODES.RECIPROCAL_RANK, similarity_top_k=RETRIEVER_TOP_K, use_async=False, verbose=True, block_index=block_index, reference_index=reference_index)
     retriever_res = retriever.retrieve(query)
     logging.info('Retrieved Rewrite Cases: ' + str(retriever_res))
     return {"retriever_res": retriever_res, "rewrites": retriever._queries}
 
-def rag_semantics_retrieve(query: str, schema: str, docstore: SimpleDocumentStore, RETRIEVER_TOP_K: int = 10) -> Dict:
-    # initialize client
-    db = chromadb.PersistentClient(path="../rag/chroma_db")
-
-    # get collection
-    stackoverflow_chroma_collection = db.get_or_create_collection("stackoverflow_summary")
-
-    # assign chroma as the vector_store to the context
-    stackoverflow_vector_store = ChromaVectorStore(chroma_collection=stackoverflow_chroma_collection)
-    stackoverflow_storage_context = StorageContext.from_defaults(vector_store=stackoverflow_vector_store)
-
-    # load your index from stored vectors
-    stackoverflow_index = VectorStoreIndex.from_vector_store(
-        stackoverflow_vector_store, storage_context=stackoverflow_storage_context
-    )
-
-    retriever = stackoverflow_index.as_retriever(similarity_top_k=RETRIEVER_TOP_K)
+def rag_semantics_retrieve(query: str, schema: str, docstore: BinaryDocStore, RETRIEVER_TOP_K: int = 10, context: t.Optional[RetrievalContext] = None) -> Dict:
+    if context is None:
+        context = get_retrieval_context()
+    start = time.time()
+    retriever = context.get_retriever(INDEX_COLLECTIONS['semantics'], RETRIEVER_TOP_K)
+    reference_index = context.get_reference_index(INDEX_COLLECTIONS['semantics'])
+    logging.debug(f'Retriever Setup Time: {time.time() - start}')
     result = retriever.retrieve(query)
 
     node_with_scores = []
     for cur_node in result:
-        cur_node_ids = eval(cur_node.metadata['references'])
+        cur_node_ids = reference_index.get(cur_node.node)
         assert len(cur_node_ids) == 1
         cur_node_id = cur_node_ids[0]
         node_with_scores.append(NodeWithScore(node=docstore.get_node(cur_node_id), score=cur_node.get_score()))
@@ -100,25 +166,16 @@ def rag_semantics_retrieve(query: str, schema: str, docstore: SimpleDocumentStor
     rewrites, _ = gen_rewrites_from_rules(sql=query, schema=schema, fun=achat, verbose=True)
     return {"retriever_res": node_with_scores, "rewrites": rewrites}
 
-def rag_structure_retrieve(query: str, schema: str, docstore: SimpleDocumentStore, embed_dim: int, RETRIEVER_TOP_K: int = 10) -> Dict:
-    # initialize client
-    db = chromadb.PersistentClient(path="../rag/chroma_db")
-
-    # get collection
-    stackoverflow_chroma_collection = db.get_or_create_collection("stackoverflow_structure")
+def rag_structure_retrieve(query: str, schema: str, docstore: BinaryDocStore, embed_dim: int, RETRIEVER_TOP_K: int = 10, context: t.Optional[RetrievalContext] = None, block_retrieval: bool = BLOCK_RETRIEVAL) -> Dict:
+    if context is None:
+        context = get_retrieval_context()
+    start = time.time()
+    stackoverflow_retriever = context.get_retriever(INDEX_COLLECTIONS['structure'], RETRIEVER_TOP_K)
+    block_index = context.get_block_index(INDEX_COLLECTIONS['structure']) if block_retrieval else None
+    reference_index = context.get_reference_index(INDEX_COLLECTIONS['structure'])
+    logging.debug(f'Retriever Setup Time: {time.time() - start}')
 
-    # assign chroma as the vector_store to the context
-    stackoverflow_vector_store = ChromaVectorStore(chroma_collection=stackoverflow_chroma_collection)
-    stackoverflow_storage_context = StorageContext.from_defaults(vector_store=stackoverflow_vector_store)
-
-    # load your index from stored vectors
-    stackoverflow_index = VectorStoreIndex.from_vector_store(
-        stackoverflow_vector_store, storage_context=stackoverflow_storage_context
-    )
-
-    stackoverflow_retriever = stackoverflow_index.as_retriever(similarity_top_k=RETRIEVER_TOP_K)
-
-    retriever = MyStructureRetriever(docstore=docstore, qa_retriever=stackoverflow_retriever, embed_dim=embed_dim, schema=schema, mode=FUSION_MODES.RECIPROCAL_RANK, similarity_top_k=RETRIEVER_TOP_K, use_async=False, verbose=True)
+    retriever = MyStructureRetriever(docstore=docstore, qa_retriever=stackoverflow_retriever, embed_dim=embed_dim, schema=schema, mode=FUSION_MODES.RECIPROCAL_RANK, similarity_top_k=RETRIEVER_TOP_K, use_async=False, verbose=True, block_index=block_index, reference_index=reference_index)
     retriever_res = retriever.retrieve(query)
     logging.info('Retrieved Rewrite Cases: ' + str(retriever_res))
-    return {"retriever_res": retriever_res, "rewrites": retriever._queries}
\ No newline at end of file
+    return {"retriever_res": retriever_res, "rewrites": retriever._queries}
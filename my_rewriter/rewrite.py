@@ -1,23 +1,53 @@
 import os
+import functools
+import threading
 import typing as t
 import jpype as jp
 import jpype.imports
 from jpype.types import *
 
+from my_rewriter.config import SEARCH_BEAM_WIDTH, SEARCH_TIMEOUT
+from my_rewriter.sqlite_utils import hash_key
+
 # zip -d LearnedRewrite.jar META-INF/DUMMY.SF
 # zip -d LearnedRewrite.jar META-INF/DUMMY.DSA
-''' Configure JAVA environment for JPype '''
-classpath = []
 local_lib_dir = 'CalciteRewrite/out/artifacts/LearnedRewrite_jar'
-classpath.extend([os.path.join(local_lib_dir, jar) for jar in os.listdir(local_lib_dir)])
+JAVA_CLASSES = {
+    'Rewriter': 'rewriter.Rewriter',
+    'RewriteResult': 'rewriter.RewriteResult',
+    'MyRules': 'rewriter.MyRules',
+    'SqlIo': 'rewriter.SqlIo',
+    'ArrayList': 'java.util.ArrayList',
+    'LearnedRewriter': 'learned.LearnedRewriter',
+    'JSONObject': 'org.json.simple.JSONObject',
+}
+_java_classes: t.Dict[str, t.Any] = {}
+_java_lock = threading.Lock()
+
+def start_jvm():
+    ''' Configure JAVA environment for JPype, the JVM is started on first use rather than on import '''
+    with _java_lock:
+        if not jp.isJVMStarted():
+            classpath = [os.path.join(local_lib_dir, jar) for jar in os.listdir(local_lib_dir)]
+            jp.startJVM(jp.getDefaultJVMPath(), classpath=classpath)
+
+@functools.lru_cache(maxsize=None)
+def get_rewriter_version() -> str:
+    ''' Fingerprint of the Calcite jars, persisted rewrites are only reused by the same build '''
+    jars = sorted(os.listdir(local_lib_dir)) if os.path.isdir(local_lib_dir) else []
+    stats = [os.stat(os.path.join(local_lib_dir, jar)) for jar in jars]
+    return hash_key(*[f'{jar}:{stat.st_size}:{stat.st_mtime_ns}' for jar, stat in zip(jars, stats)])
 
-if not jp.isJVMStarted():
-    jp.startJVM(jp.getDefaultJVMPath(), classpath=classpath)
+def java_class(name: str) -> t.Any:
+    if name not in _java_classes:
+        start_jvm()
+        _java_classes[name] = jp.JClass(JAVA_CLASSES[name])
+    return _java_classes[name]
 
-from rewriter import Rewriter, RewriteResult, MyRules
-from java.util import ArrayList
-from learned import LearnedRewriter
-from org.json.simple import JSONObject
+def __getattr__(name: str) -> t.Any:
+    if name in JAVA_CLASSES:
+        return java_class(name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 def to_java_string(s: str) -> JString:
     return JString(s)
@@ -28,27 +58,65 @@ def to_java_bool(b: bool) -> JBoolean:
 def to_java_int(i: int) -> JInt:
     return JInt(i)
 
-def to_java_list(lst: t.List) -> ArrayList:
-    return ArrayList(lst)
+def to_java_long(i: int) -> JLong:
+    return JLong(i)
 
-def to_python_list(lst: ArrayList) -> t.List:
+def to_java_list(lst: t.List) -> 'ArrayList':
+    return java_class('ArrayList')(lst)
+
+def to_python_list(lst: 'ArrayList') -> t.List:
     return list(lst)
 
-def match_normal_rules(query: str, create_tables: t.List[str], database: str = 'PostgreSQL', verbose: bool = True) -> t.List[t.Dict[str, str]]:
-    return to_python_list(Rewriter.matchNormalRules(to_java_string(query), to_java_list(create_tables), to_java_string(database), to_java_bool(verbose)))
+@functools.lru_cache(maxsize=None)
+def split_schema(schema: str) -> t.Tuple[str, ...]:
+    return tuple([x for x in schema.split(';') if x.strip() != ''])
+
+@functools.lru_cache(maxsize=None)
+def _register_schema(create_tables: t.Tuple[str, ...], database: str) -> int:
+    return int(java_class('SqlIo').registerSchema(to_java_list(list(create_tables)), to_java_string(database)))
+
+def register_schema(create_tables: t.Sequence[str], database: str = 'PostgreSQL') -> int:
+    """Parse the CREATE TABLE statements once in the JVM and return the schema handle the Calcite calls reuse."""
+    return _register_schema(tuple(create_tables), database)
+
+@functools.lru_cache(maxsize=None)
+def schema_handles_supported() -> bool:
+    ''' Jars built before SqlIo.registerSchema only have the (sql, createTables, database) overloads '''
+    return hasattr(java_class('SqlIo'), 'registerSchema')
+
+def match_normal_rules(query: str, create_tables: t.Sequence[str], database: str = 'PostgreSQL', verbose: bool = True) -> t.List[t.Dict[str, str]]:
+    if not schema_handles_supported():
+        return to_python_list(java_class('Rewriter').matchNormalRules(to_java_string(query), to_java_list(list(create_tables)), to_java_string(database), to_java_bool(verbose)))
+    return to_python_list(java_class('Rewriter').matchNormalRules(to_java_string(query), to_java_int(register_schema(create_tables, database)), to_java_bool(verbose)))
+
+def match_explore_rules(query: str, create_tables: t.Sequence[str], database: str = 'PostgreSQL', verbose: bool = True) -> t.List[t.Dict[str, str]]:
+    if not schema_handles_supported():
+        return to_python_list(java_class('Rewriter').matchExploreRules(to_java_string(query), to_java_list(list(create_tables)), to_java_string(database), to_java_bool(verbose)))
+    return to_python_list(java_class('Rewriter').matchExploreRules(to_java_string(query), to_java_int(register_schema(create_tables, database)), to_java_bool(verbose)))
+
+def match_all_rules(query: str, create_tables: t.Sequence[str], database: str = 'PostgreSQL', verbose: bool = True) -> t.List[t.Dict[str, str]]:
+    if not schema_handles_supported():
+        return to_python_list(java_class('Rewriter').matchAllRules(to_java_string(query), to_java_list(list(create_tables)), to_java_string(database), to_java_bool(verbose)))
+    return to_python_list(java_class('Rewriter').matchAllRules(to_java_string(query), to_java_int(register_schema(create_tables, database)), to_java_bool(verbose)))
 
-def match_explore_rules(query: str, create_tables: t.List[str], database: str = 'PostgreSQL', verbose: bool = True) -> t.List[t.Dict[str, str]]:
-    return to_python_list(Rewriter.matchExploreRules(to_java_string(query), to_java_list(create_tables), to_java_string(database), to_java_bool(verbose)))
+def rewrite(query: str, create_tables: t.Sequence[str], rule_names: t.List[str], rounds: int, database: str = 'PostgreSQL') -> 'RewriteResult':
+    if not schema_handles_supported():
+        return java_class('Rewriter').rewrite(to_java_string(query), to_java_list(list(create_tables)), to_java_list(rule_names), to_java_int(rounds), to_java_string(database))
+    return java_class('Rewriter').rewrite(to_java_string(query), to_java_int(register_schema(create_tables, database)), to_java_list(rule_names), to_java_int(rounds))
 
-def match_all_rules(query: str, create_tables: t.List[str], database: str = 'PostgreSQL', verbose: bool = True) -> t.List[t.Dict[str, str]]:
-    return to_python_list(Rewriter.matchAllRules(to_java_string(query), to_java_list(create_tables), to_java_string(database), to_java_bool(verbose)))
+def search_rewrite(query: str, create_tables: t.Sequence[str], rule_names: t.List[str], rounds: int, beam_width: int = SEARCH_BEAM_WIDTH, timeout: t.Optional[float] = SEARCH_TIMEOUT, database: str = 'PostgreSQL') -> t.List['RewriteResult']:
+    """Explore orderings of rule_names by beam search, returning the kept sequences level by level, cheapest first.
 
-def rewrite(query: str, create_tables: t.List[str], rule_names: t.List[str], rounds: int, database: str = 'PostgreSQL') -> RewriteResult:
-    return Rewriter.rewrite(to_java_string(query), to_java_list(create_tables), to_java_list(rule_names), to_java_int(rounds), to_java_string(database))
+    Jars built before Rewriter.searchRewrite fall back to the exhaustive traverseRewrite, whose results have no cost.
+    """
+    if not schema_handles_supported() or not hasattr(java_class('Rewriter'), 'searchRewrite'):
+        return to_python_list(java_class('Rewriter').traverseRewrite(to_java_string(query), to_java_list(list(create_tables)), to_java_list(rule_names), to_java_int(rounds), to_java_string(database)))
+    timeout_ms = 0 if timeout is None else int(timeout * 1000)
+    return to_python_list(java_class('Rewriter').searchRewrite(to_java_string(query), to_java_int(register_schema(create_tables, database)), to_java_list(rule_names), to_java_int(rounds), to_java_int(beam_width), to_java_long(timeout_ms)))
 
-def learned_rewrite(query: str, create_tables: t.List[str], budget: int, host: str, port: str, user: str, password: str, dbname: str) -> JSONObject:
-    return LearnedRewriter.learnedRewrite(to_java_string(query), to_java_list(create_tables), to_java_int(budget), to_java_string(host), to_java_string(port), to_java_string(user), to_java_string(password), to_java_string(dbname))
+def learned_rewrite(query: str, create_tables: t.List[str], budget: int, host: str, port: str, user: str, password: str, dbname: str) -> 'JSONObject':
+    return java_class('LearnedRewriter').learnedRewrite(to_java_string(query), to_java_list(create_tables), to_java_int(budget), to_java_string(host), to_java_string(port), to_java_string(user), to_java_string(password), to_java_string(dbname))
 
 def get_normal_rules() -> t.List[str]:
-    normal_rules = sorted([str(r) for r in MyRules.NORMAL_RULES.keySet()])
+    normal_rules = sorted([str(r) for r in java_class('MyRules').NORMAL_RULES.keySet()])
     return normal_rules
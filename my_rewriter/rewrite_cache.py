@@ -0,0 +1,64 @@
+import json
+import time
+import threading
+import typing as t
+
+from my_rewriter.config import REWRITE_CACHE_PATH, REWRITE_CACHE_ENABLED
+from my_rewriter.rewrite import get_rewriter_version
+from my_rewriter.sqlite_utils import connect_sqlite, hash_key
+
+class RewriteCache(object):
+    """Rewrite results shared across runs.
+
+    Failed rewrites (those carrying an 'error') are not stored, so they are retried on the next run.
+    A hit took no Calcite time in this run, so it is returned with `time` 0 and `cached` set.
+    Output costs are not stored here: estimate_rewrite_cost gets them from the cost cache, whose
+    keys include the statistics version, so a cached rewrite is re-costed after an ANALYZE.
+    """
+
+    def __init__(self, path: str, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+        if enabled:
+            self.conn = connect_sqlite(path)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rewrites (key TEXT PRIMARY KEY, used_rules TEXT, output_sql TEXT, time INTEGER, created_at REAL)')
+
+    @staticmethod
+    def key(query: str, schema: str, rule_seq: t.List[str], rounds: int) -> str:
+        return hash_key(get_rewriter_version(), schema, query, json.dumps(rule_seq), str(rounds))
+
+    def get_rewrite(self, query: str, schema: str, rule_seq: t.List[str], rounds: int) -> t.Optional[t.Dict]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self.conn.execute('SELECT used_rules, output_sql, time FROM rewrites WHERE key = ?', (self.key(query, schema, rule_seq, rounds),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {'used_rules': json.loads(row[0]), 'output_sql': row[1], 'time': 0, 'cached': True}
+
+    def put_rewrite(self, query: str, schema: str, rule_seq: t.List[str], rounds: int, rewrite_res: t.Dict):
+        if not self.enabled or 'error' in rewrite_res:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO rewrites VALUES (?, ?, ?, ?, ?)', (self.key(query, schema, rule_seq, rounds), json.dumps(rewrite_res['used_rules']), rewrite_res['output_sql'], rewrite_res['time'], time.time()))
+
+_rewrite_cache: t.Optional[RewriteCache] = None
+_rewrite_cache_lock = threading.Lock()
+
+def get_rewrite_cache() -> RewriteCache:
+    global _rewrite_cache
+    with _rewrite_cache_lock:
+        if _rewrite_cache is None:
+            _rewrite_cache = RewriteCache(REWRITE_CACHE_PATH, enabled=REWRITE_CACHE_ENABLED)
+        return _rewrite_cache
+
+def set_rewrite_cache_enabled(enabled: bool):
+    global _rewrite_cache
+    with _rewrite_cache_lock:
+        _rewrite_cache = RewriteCache(REWRITE_CACHE_PATH, enabled=enabled)
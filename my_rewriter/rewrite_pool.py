@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import subprocess
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+
+from my_rewriter.config import REWRITE_WORKERS, REWRITE_TIMEOUT
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RewriteWorkerError(Exception):
+    elapsed: float = 0.0
+
+class RewriteWorker(object):
+    """A child process with its own JVM, serving Calcite calls over a pair of pipes.
+
+    Requests and replies are pickled over dedicated pipes rather than stdin/stdout, so that
+    anything Calcite prints cannot corrupt the protocol.
+    """
+
+    def __init__(self):
+        parent_read, child_write = os.pipe()
+        child_read, parent_write = os.pipe()
+        self.process = subprocess.Popen(_worker_command(child_read, child_write), pass_fds=(child_read, child_write))
+        os.close(child_read)
+        os.close(child_write)
+        self.reader = Connection(parent_read, writable=False)
+        self.writer = Connection(parent_write, readable=False)
+
+    def call(self, op: str, args: tuple, timeout: t.Optional[float]) -> t.Any:
+        self.writer.send((op, args))
+        if not self.reader.poll(timeout):
+            raise TimeoutError(f'{op} did not finish in {timeout}s')
+        status, res = self.reader.recv()
+        if status == 'error':
+            raise RewriteWorkerError(res)
+        return res
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.reader.close()
+        self.writer.close()
+
+class RewritePool(object):
+    """Long-lived JVM worker processes shared by every thread of the driver.
+
+    Each call checks out an idle worker, so a batch runs on all workers in parallel. A worker that
+    crashes or exceeds the timeout is killed and replaced, and only its call fails.
+    """
+
+    def __init__(self, workers: int, timeout: t.Optional[float] = REWRITE_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        for _ in range(workers):
+            self.idle.put(RewriteWorker())
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.restarts = 0
+
+    def call(self, op: str, args: tuple) -> t.Any:
+        worker = self.idle.get()
+        try:
+            return worker.call(op, args, self.timeout)
+        except (TimeoutError, EOFError, OSError) as e:
+            logging.warning(f'Rewrite worker {worker.process.pid} failed ({type(e).__name__}: {e}), restarting it')
+            worker.close()
+            worker = RewriteWorker()
+            self.restarts += 1
+            raise RewriteWorkerError(f'{type(e).__name__}: {e}')
+        finally:
+            self.idle.put(worker)
+
+    def map(self, op: str, batch: t.List[tuple]) -> t.List[t.Any]:
+        # failed items come back as their RewriteWorkerError
+        def run(args: tuple) -> t.Any:
+            start = time.time()
+            try:
+                return self.call(op, args)
+            except RewriteWorkerError as e:
+                e.elapsed = time.time() - start
+                return e
+        return list(self.executor.map(run, batch))
+
+    def shutdown(self):
+        self.executor.shutdown()
+        while not self.idle.empty():
+            self.idle.get().close()
+
+def rewrite_batch(pool: RewritePool, batch: t.List[t.Tuple[str, t.List[str], t.List[str], int]], database: str = 'PostgreSQL') -> t.List[t.Dict]:
+    """Rewrite many (query, create_tables, rule_names, rounds) items; failed items get output_sql 'None'."""
+    results = pool.map('rewrite', [(query, create_tables, rule_names, rounds, database) for query, create_tables, rule_names, rounds in batch])
+    for i, res in enumerate(results):
+        if isinstance(res, RewriteWorkerError):
+            logging.warning(f'Rewrite failed: {res}')
+            results[i] = {'used_rules': [], 'output_sql': 'None', 'time': int(res.elapsed * 1000), 'error': str(res)}
+    return results
+
+def match_all_rules_batch(pool: RewritePool, batch: t.List[t.Tuple[str, t.List[str]]], database: str = 'PostgreSQL') -> t.List[t.List[t.Dict[str, str]]]:
+    """Match Calcite rules for many (query, create_tables) items; failed items match no rules."""
+    results = pool.map('match_all_rules', [(query, create_tables, database) for query, create_tables in batch])
+    for i, res in enumerate(results):
+        if isinstance(res, RewriteWorkerError):
+            logging.warning(f'Calcite rule matching failed: {res}')
+            results[i] = []
+    return results
+
+_rewrite_pool: t.Optional[RewritePool] = None
+_rewrite_pool_lock = threading.Lock()
+
+def get_rewrite_pool() -> t.Optional[RewritePool]:
+    # None when Calcite is called in the driver process
+    global _rewrite_pool
+    with _rewrite_pool_lock:
+        if _rewrite_pool is None and REWRITE_WORKERS:
+            _rewrite_pool = RewritePool(REWRITE_WORKERS)
+            atexit.register(_rewrite_pool.shutdown)
+        return _rewrite_pool
+
+def set_rewrite_workers(workers: t.Optional[int], timeout: t.Optional[float] = REWRITE_TIMEOUT):
+    global _rewrite_pool
+    with _rewrite_pool_lock:
+        if _rewrite_pool is not None:
+            _rewrite_pool.shutdown()
+            _rewrite_pool = None
+        if workers:
+            _rewrite_pool = RewritePool(workers, timeout=timeout)
+            atexit.register(_rewrite_pool.shutdown)
+
+def _worker_command(read_fd: int, write_fd: int) -> t.List[str]:
+    # a fresh interpreter rather than a fork: the JVM cannot be forked and the driver's script is not re-run
+    return [sys.executable, '-c', f'import sys; sys.path.append({ROOT_DIR!r}); from my_rewriter.rewrite_pool import serve_worker; serve_worker({read_fd}, {write_fd})']
+
+def serve_worker(read_fd: int, write_fd: int):
+    from my_rewriter.rewrite import start_jvm, rewrite, match_all_rules
+    reader = Connection(read_fd, writable=False)
+    writer = Connection(write_fd, readable=False)
+    start_jvm()
+    while True:
+        try:
+            op, args = reader.recv()
+        except EOFError:
+            return
+        try:
+            if op == 'rewrite':
+                query, create_tables, rule_names, rounds, database = args
+                res = rewrite(query, create_tables, rule_names, rounds, database=database)
+                reply = {'used_rules': [str(r) for r in res.rules], 'output_sql': str(res.sql), 'time': int(res.time)}
+            elif op == 'match_all_rules':
+                query, create_tables, database = args
+                reply = [{k: str(r[k]) for k in ['name', 'type', 'plan_before', 'plan_after']} for r in match_all_rules(query, create_tables, database=database)]
+            else:
+                raise ValueError(f'Unknown rewrite worker op: {op}')
+            writer.send(('ok', reply))
+        except Exception as e:
+            writer.send(('error', f'{type(e).__name__}: {e}'))
+
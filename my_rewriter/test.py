@@ -6,21 +6,39 @@ import re
 import json
 
 sys.path.append('..')
-from my_rewriter.config import init_llms, init_db_config
+from my_rewriter.config import init_llms, init_db_config, LLM_CACHE_MODE, LLM_MAX_IN_FLIGHT, LLM_TOKENS_PER_MINUTE, REWRITE_WORKERS, REWRITE_CACHE_ENABLED, COST_CACHE_ENABLED
+from my_rewriter.llm_cache import LLM_CACHE_MODES, set_llm_cache_mode
+from my_rewriter.llm_scheduler import get_llm_scheduler, set_llm_scheduler_limits
+from my_rewriter.rewrite_pool import set_rewrite_workers
+from my_rewriter.rewrite_cache import set_rewrite_cache_enabled
+from my_rewriter.cost_cache import set_cost_cache_enabled
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--database', type=str, required=True)
 parser.add_argument('--logdir', type=str, default='logs')
 parser.add_argument('--index', type=str, default='hybrid')
 parser.add_argument('--topk', type=int, default=10)
+parser.add_argument('--llm_cache', type=str, default=LLM_CACHE_MODE, choices=LLM_CACHE_MODES, help='LLM response cache mode')
+parser.add_argument('--workers', type=int, default=1, help='number of queries rewritten concurrently')
+parser.add_argument('--llm_max_in_flight', type=int, default=LLM_MAX_IN_FLIGHT, help='maximum number of concurrent LLM requests')
+parser.add_argument('--llm_tpm', type=int, default=LLM_TOKENS_PER_MINUTE, help='LLM tokens-per-minute budget')
+parser.add_argument('--rewrite_workers', type=int, default=REWRITE_WORKERS, help='number of JVM worker processes for Calcite, none to call Calcite in this process')
+parser.add_argument('--rewrite_cache', action=argparse.BooleanOptionalAction, default=REWRITE_CACHE_ENABLED, help='reuse rewrite results from previous runs')
+parser.add_argument('--cost_cache', action=argparse.BooleanOptionalAction, default=COST_CACHE_ENABLED, help='reuse optimizer costs from previous runs while the statistics are unchanged')
 args = parser.parse_args()
 
 model_args = init_llms(args.logdir)
+set_llm_cache_mode(args.llm_cache)
+set_llm_scheduler_limits(args.llm_max_in_flight, tokens_per_minute=args.llm_tpm)
+set_rewrite_workers(args.rewrite_workers)
+set_rewrite_cache_enabled(args.rewrite_cache)
+set_cost_cache_enabled(args.cost_cache)
 pg_config = init_db_config(args.database)
 
 from my_rewriter.database import DBArgs, Database
 from my_rewriter.test_utils import test
-from my_rewriter.rag_retrieve import init_docstore
+from my_rewriter.workload import run_workload
+from my_rewriter.rag_retrieve import init_docstore, get_retrieval_context, INDEX_COLLECTIONS
 
 RETRIEVER_TOP_K = args.topk
 CASE_BATCH = 5
@@ -47,6 +65,12 @@ schema_path = os.path.join('..', DATASET, 'create_tables.sql')
 schema = open(schema_path, 'r').read()
 
 docstore = init_docstore()
+if args.index in INDEX_COLLECTIONS:
+    print(f'Retrieval warm-up timings: {get_retrieval_context().warm_up([INDEX_COLLECTIONS[args.index]])}')
+
+jobs = []
+def add_job(name: str, query: str):
+    jobs.append((name, lambda: test(name, query, schema, pg_args, model_args, docstore, LOG_DIR, RETRIEVER_TOP_K=RETRIEVER_TOP_K, CASE_BATCH=CASE_BATCH, RULE_BATCH=RULE_BATCH, REWRITE_ROUNDS=REWRITE_ROUNDS, index=args.index)))
 
 if DATASET == 'calcite':
     queries_path = os.path.join('..', DATASET, f'{DATASET}.jsonl')
@@ -55,14 +79,14 @@ if DATASET == 'calcite':
             obj = json.loads(line)
             query = obj['input_sql']
             name = sorted([x['name'] for x in obj['rewrites']])[0]
-            test(name, query, schema, pg_args, model_args, docstore, LOG_DIR, RETRIEVER_TOP_K=RETRIEVER_TOP_K, CASE_BATCH=CASE_BATCH, RULE_BATCH=RULE_BATCH, REWRITE_ROUNDS=REWRITE_ROUNDS, index=args.index)
+            add_job(name, query)
 elif DATASET == 'hbom':
     queries_filename = os.path.join('..', DATASET, 'queries.sql')
     content = open(queries_filename, 'r').read()
     queries = [q.strip() + ';' for q in content.split(';') if q.strip()]
     for j, query in enumerate(queries):
         name = f'query{j}'
-        test(name, query, schema, pg_args, model_args, docstore, LOG_DIR, RETRIEVER_TOP_K=RETRIEVER_TOP_K, CASE_BATCH=CASE_BATCH, RULE_BATCH=RULE_BATCH, REWRITE_ROUNDS=REWRITE_ROUNDS, index=args.index)
+        add_job(name, query)
 else:
     queries_path = os.path.join('..', DATASET)
     query_templates = os.listdir(queries_path)
@@ -74,4 +98,8 @@ else:
             queries = [q.strip() + ';' for q in content.split(';') if q.strip()]
             for j, query in enumerate(queries):
                 name = f'{template}_{idx}' if len(queries) == 1 else f'{template}_{idx}_{j}'
-                test(name, query, schema, pg_args, model_args, docstore, LOG_DIR, RETRIEVER_TOP_K=RETRIEVER_TOP_K, CASE_BATCH=CASE_BATCH, RULE_BATCH=RULE_BATCH, REWRITE_ROUNDS=REWRITE_ROUNDS, index=args.index)
\ No newline at end of file
+                add_job(name, query)
+
+run_workload(jobs, workers=args.workers)
+
+print(f'LLM scheduler metrics: {get_llm_scheduler().get_metrics()}')
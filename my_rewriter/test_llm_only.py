@@ -8,14 +8,17 @@ from llama_index.core import Settings
 from llama_index.llms.openai import OpenAI
 
 sys.path.append('..')
-from my_rewriter.config import init_llms, init_db_config
+from my_rewriter.config import init_llms, init_db_config, LLM_CACHE_MODE
+from my_rewriter.llm_cache import LLM_CACHE_MODES, set_llm_cache_mode
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--database', type=str, required=True)
 parser.add_argument('--logdir', type=str, default='logs_llm_only')
+parser.add_argument('--llm_cache', type=str, default=LLM_CACHE_MODE, choices=LLM_CACHE_MODES, help='LLM response cache mode')
 args = parser.parse_args()
 
 model_args = init_llms(args.logdir)
+set_llm_cache_mode(args.llm_cache)
 pg_config = init_db_config(args.database)
 
 from my_rewriter.rag_rewrite import execute_rewrite
@@ -0,0 +1,73 @@
+import logging
+import contextvars
+import contextlib
+import typing as t
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+LOG_FORMAT = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s'
+LOG_DATEFMT = '%H:%M:%S'
+
+_query_log_handler: contextvars.ContextVar[t.Optional[logging.Handler]] = contextvars.ContextVar('query_log_handler', default=None)
+
+class QueryLogRouter(logging.Handler):
+    """Root handler that writes each record to the log file of the query being processed in the current context.
+
+    Warnings and errors outside of any query, e.g. the failures collected by run_workload, go to stderr.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        handler = _query_log_handler.get()
+        if handler is not None:
+            handler.handle(record)
+        elif logging.lastResort is not None and record.levelno >= logging.lastResort.level:
+            logging.lastResort.handle(record)
+
+def install_query_log_router():
+    if any(isinstance(handler, QueryLogRouter) for handler in logging.root.handlers):
+        return
+    # Remove all handlers associated with the root logger object.
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.root.addHandler(QueryLogRouter(level=logging.DEBUG))
+    logging.root.setLevel(logging.DEBUG)
+
+@contextlib.contextmanager
+def query_log(log_filename: str):
+    install_query_log_router()
+    handler = logging.FileHandler(log_filename, mode='a')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    token = _query_log_handler.set(handler)
+    try:
+        yield
+    except Exception:
+        # while the query's log is still routed, so that its traceback ends up next to the rest of it
+        logging.exception('Failed to process the query')
+        raise
+    finally:
+        _query_log_handler.reset(token)
+        handler.close()
+
+def run_workload(jobs: t.List[t.Tuple[str, t.Callable[[], t.Any]]], workers: int = 1) -> t.Dict[str, t.Any]:
+    """Run named jobs on a pool of `workers` threads and return their results by name.
+
+    With one worker, jobs run in order and the first failure is raised as before. With more,
+    a failing job does not stop the others, and the failures are raised once all jobs are done.
+    """
+    results = {}
+    if workers <= 1:
+        for name, job in jobs:
+            results[name] = job()
+        return results
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job): name for name, job in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(f'Failed to process {name}', exc_info=e)
+                failures[name] = e
+    if failures:
+        raise RuntimeError(f'{len(failures)} of {len(jobs)} jobs failed: {sorted(failures)}') from next(iter(failures.values()))
+    return results
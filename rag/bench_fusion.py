@@ -0,0 +1,94 @@
+import sys
+import time
+import random
+import argparse
+from collections import defaultdict
+
+sys.path.append('..')
+from llama_index.core.schema import TextNode, NodeWithScore
+from rag.fusion import reciprocal_rank_fusion, relative_score_fusion
+
+def reference_rrf(results, k=60.0):
+    # previous per-list Python implementation, keyed by node content
+    retriever_num_queries = defaultdict(int)
+    for query_tuple in results:
+        retriever_num_queries[query_tuple[1]] += 1
+    fused_scores = {}
+    text_to_node = {}
+    retriever_records = defaultdict(list)
+    for query_tuple, nodes_with_scores in results.items():
+        for rank, node_with_score in enumerate(sorted(nodes_with_scores, key=lambda x: x.score or 0.0, reverse=True)):
+            text = node_with_score.node.get_content()
+            text_to_node[text] = node_with_score
+            if text not in fused_scores:
+                fused_scores[text] = 0.0
+            cur_score = 1.0 / (rank + k) / retriever_num_queries[query_tuple[1]]
+            fused_scores[text] += cur_score
+            retriever_records[text].append((query_tuple[1], cur_score))
+    return [(text_to_node[text].node.node_id, score) for text, score in sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)]
+
+def reference_relative(results, retriever_weights, dist_based=False):
+    min_max_scores = {}
+    for query_tuple, nodes_with_scores in results.items():
+        scores = [n.score for n in nodes_with_scores]
+        if dist_based:
+            mean_score = sum(scores) / len(scores)
+            std_dev = (sum((x - mean_score) ** 2 for x in scores) / len(scores)) ** 0.5
+            min_max_scores[query_tuple] = (mean_score - 3 * std_dev, mean_score + 3 * std_dev)
+        else:
+            min_max_scores[query_tuple] = (min(scores), max(scores))
+    retriever_num_queries = defaultdict(int)
+    for query_tuple in results:
+        retriever_num_queries[query_tuple[1]] += 1
+    all_scores = {}
+    all_ids = {}
+    for query_tuple, nodes_with_scores in results.items():
+        min_score, max_score = min_max_scores[query_tuple]
+        for n in nodes_with_scores:
+            if max_score == min_score:
+                score = 1.0 if max_score > 0 else 0.0
+            else:
+                score = (n.score - min_score) / (max_score - min_score)
+            score *= retriever_weights[query_tuple[1]]
+            score /= retriever_num_queries[query_tuple[1]]
+            text = n.node.get_content()
+            if text in all_scores:
+                all_scores[text] += score
+            else:
+                all_scores[text] = score
+                all_ids[text] = n.node.node_id
+    return [(all_ids[text], score) for text, score in sorted(all_scores.items(), key=lambda x: x[1], reverse=True)]
+
+def gen_results(num_queries: int, num_candidates: int, top_k: int, seed: int):
+    rnd = random.Random(seed)
+    nodes = [TextNode(id_=f'{i}-{i}', text=f'answer {i} ' + 'x' * rnd.randint(2000, 8000)) for i in range(num_candidates)]
+    results = {}
+    for q in range(num_queries):
+        picked = rnd.sample(range(num_candidates), top_k)
+        # coarse scores so that ties occur
+        results[(f'query {q}', 0)] = [NodeWithScore(node=nodes[i], score=round(rnd.random(), 2)) for i in picked]
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, nargs='+', default=[50, 200, 800])
+    parser.add_argument('--candidates', type=int, default=2000)
+    parser.add_argument('--topk', type=int, default=10)
+    args = parser.parse_args()
+
+    for num_queries in args.queries:
+        for name, reference, fused in [
+            ('reciprocal_rank', lambda r: reference_rrf(r), lambda r: reciprocal_rank_fusion(r)[0]),
+            ('relative_score', lambda r: reference_relative(r, [1.0]), lambda r: relative_score_fusion(r, [1.0])),
+            ('dist_based_score', lambda r: reference_relative(r, [1.0], dist_based=True), lambda r: relative_score_fusion(r, [1.0], dist_based=True)),
+        ]:
+            results = gen_results(num_queries, args.candidates, args.topk, seed=num_queries)
+            start = time.perf_counter()
+            expected = reference(results)
+            reference_time = time.perf_counter() - start
+            results = gen_results(num_queries, args.candidates, args.topk, seed=num_queries)
+            start = time.perf_counter()
+            actual = [(n.node.node_id, n.score) for n in fused(results)]
+            fused_time = time.perf_counter() - start
+            assert actual == expected, f'{name} differs from the reference with {num_queries} queries'
+            print(f'{name:>16} {num_queries:>4} queries: reference {reference_time * 1000:8.2f} ms, numpy {fused_time * 1000:8.2f} ms')
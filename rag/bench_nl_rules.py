@@ -0,0 +1,74 @@
+import sys
+import os
+import re
+import json
+import time
+import logging
+import argparse
+
+sys.path.append('..')
+from rag.nl_rules import match_nl_rules, match_nl_rules_batch, start_nl_rule_pool, shutdown_nl_rule_pool
+
+def load_queries(dataset: str):
+    queries = []
+    if dataset == 'calcite':
+        with open(os.path.join('..', dataset, f'{dataset}.jsonl'), 'r') as fin:
+            for line in fin.readlines():
+                queries.append(json.loads(line)['input_sql'])
+        return queries
+    queries_path = os.path.join('..', dataset)
+    for template in sorted(os.listdir(queries_path)):
+        for idx in range(2):
+            query_filename = f'{queries_path}/{template}/{template}_{idx}.sql'
+            if not os.path.exists(query_filename):
+                continue
+            content = re.sub(r'--.*\n', '', open(query_filename, 'r').read())
+            queries.extend([q.strip() + ';' for q in content.split(';') if q.strip()])
+    return queries
+
+def bench(queries, schema, parse_once: bool, repeat: int):
+    times = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            rules = match_nl_rules(query, schema, parse_once=parse_once, workers=None)
+        times.append((time.perf_counter() - start) / repeat)
+        results.append([r['name'] for r in rules])
+    return times, results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', type=str, nargs='+', default=['tpch', 'dsb'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='process pool size for the batch run, 0 to skip it')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    for dataset in args.datasets:
+        schema = open(os.path.join('..', dataset, 'create_tables.sql'), 'r').read()
+        queries = load_queries(dataset)
+        # warm up the schema memo so both runs see the same process state
+        match_nl_rules(queries[0], schema, workers=None)
+        before, before_rules = bench(queries, schema, parse_once=False, repeat=args.repeat)
+        after, after_rules = bench(queries, schema, parse_once=True, repeat=args.repeat)
+        assert before_rules == after_rules, f'Matched rules differ on {dataset}'
+        before_ms = sorted([x * 1000 for x in before])
+        after_ms = sorted([x * 1000 for x in after])
+        print(f'{dataset}: {len(queries)} queries')
+        print(f'  re-parse per rule: total {sum(before_ms):.1f} ms, median {before_ms[len(before_ms) // 2]:.2f} ms, max {before_ms[-1]:.2f} ms')
+        print(f'  parse once:        total {sum(after_ms):.1f} ms, median {after_ms[len(after_ms) // 2]:.2f} ms, max {after_ms[-1]:.2f} ms')
+        print(f'  speedup: {sum(before_ms) / sum(after_ms):.2f}x')
+        if args.workers:
+            start_nl_rule_pool(args.workers, [schema])
+            start = time.perf_counter()
+            batch_rules = match_nl_rules_batch(queries, schema, workers=args.workers)
+            batch_ms = (time.perf_counter() - start) * 1000
+            assert [[r['name'] for r in rules] for rules in batch_rules] == after_rules, f'Batch matched rules differ on {dataset}'
+            start = time.perf_counter()
+            for query in queries:
+                match_nl_rules(query, schema, workers=args.workers)
+            single_ms = (time.perf_counter() - start) * 1000
+            print(f'  {args.workers} workers, batch:     total {batch_ms:.1f} ms ({sum(after_ms) / batch_ms:.2f}x over parse once)')
+            print(f'  {args.workers} workers, per query: total {single_ms:.1f} ms ({sum(after_ms) / single_ms:.2f}x over parse once)')
+    shutdown_nl_rule_pool()
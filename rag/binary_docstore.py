@@ -0,0 +1,122 @@
+import os
+import mmap
+import json
+import struct
+import hashlib
+import typing as t
+
+from llama_index.core.schema import BaseNode, TextNode
+
+from rag.prompts import STACKOVERFLOW_QA_PROMPT
+
+# header: magic, version, node count, source fingerprint, then the byte offsets of the
+# id offsets table, text offsets table, id blob and text blob
+MAGIC = b'LLM4RWDS'
+VERSION = 1
+HEADER = struct.Struct('<8sII32sQQQQ')
+
+def get_source_fingerprint(source_path: str) -> bytes:
+    # rebuild when the StackOverflow dump or the document prompt changes
+    stat = os.stat(source_path)
+    h = hashlib.sha256()
+    h.update(f'{stat.st_size}\0{stat.st_mtime_ns}\0'.encode('utf-8'))
+    h.update(STACKOVERFLOW_QA_PROMPT.encode('utf-8'))
+    return h.digest()
+
+def read_source_docs(source_path: str) -> t.Dict[str, str]:
+    docs = {}
+    with open(source_path, 'r') as fin:
+        for line in fin:
+            obj = json.loads(line)
+            myid = f'{obj["id"]}-{obj["answer_id"]}'
+            docs[myid] = STACKOVERFLOW_QA_PROMPT.format(title=obj["question_title"], question_body=obj["question_body"], answer_body=obj["answer_body"])
+    return docs
+
+def build_docstore(source_path: str, path: str):
+    docs = read_source_docs(source_path)
+    ids = [id.encode('utf-8') for id in docs.keys()]
+    texts = [text.encode('utf-8') for text in docs.values()]
+
+    def offsets(blobs: t.List[bytes]) -> bytes:
+        res = [0]
+        for b in blobs:
+            res.append(res[-1] + len(b))
+        return struct.pack(f'<{len(res)}Q', *res)
+
+    id_offsets, text_offsets = offsets(ids), offsets(texts)
+    id_offsets_pos = HEADER.size
+    text_offsets_pos = id_offsets_pos + len(id_offsets)
+    ids_pos = text_offsets_pos + len(text_offsets)
+    texts_pos = ids_pos + sum([len(b) for b in ids])
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(HEADER.pack(MAGIC, VERSION, len(ids), get_source_fingerprint(source_path), id_offsets_pos, text_offsets_pos, ids_pos, texts_pos))
+        fout.write(id_offsets)
+        fout.write(text_offsets)
+        fout.writelines(ids)
+        fout.writelines(texts)
+    os.replace(tmp_path, path)
+
+class BinaryDocStore(object):
+    """Read-only docstore over a memory-mapped file of StackOverflow documents.
+
+    Only the id table is decoded on open; node text is decoded when the node is requested.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as fin:
+            self.buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, self.fingerprint, id_offsets_pos, text_offsets_pos, self.ids_pos, self.texts_pos = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} docstore')
+        self.count = count
+        self.text_offsets_pos = text_offsets_pos
+        id_offsets = struct.unpack_from(f'<{count + 1}Q', self.buf, id_offsets_pos)
+        # the offsets are in bytes, so ids are sliced before they are decoded
+        ids = self.buf[self.ids_pos:self.ids_pos + id_offsets[-1]]
+        self.rows = {}
+        for i in range(count):
+            self.rows[ids[id_offsets[i]:id_offsets[i + 1]].decode('utf-8')] = i
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _text(self, row: int) -> str:
+        start, end = struct.unpack_from('<2Q', self.buf, self.text_offsets_pos + row * 8)
+        return self.buf[self.texts_pos + start:self.texts_pos + end].decode('utf-8')
+
+    def document_exists(self, doc_id: str) -> bool:
+        return doc_id in self.rows
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> t.Optional[BaseNode]:
+        row = self.rows.get(doc_id)
+        if row is None:
+            if raise_error:
+                raise ValueError(f'doc_id {doc_id} not found.')
+            return None
+        return TextNode(text=self._text(row), id_=doc_id)
+
+    def get_node(self, node_id: str, raise_error: bool = True) -> t.Optional[BaseNode]:
+        return self.get_document(node_id, raise_error=raise_error)
+
+    def get_nodes(self, node_ids: t.List[str], raise_error: bool = True) -> t.List[BaseNode]:
+        nodes = [self.get_node(node_id, raise_error=raise_error) for node_id in node_ids]
+        return [n for n in nodes if n is not None]
+
+    @property
+    def docs(self) -> t.Dict[str, BaseNode]:
+        return {doc_id: self.get_document(doc_id) for doc_id in self.rows}
+
+def load_docstore(source_path: str, path: str) -> BinaryDocStore:
+    # the source is optional once the binary docstore has been built
+    if os.path.exists(source_path):
+        stale = True
+        if os.path.exists(path):
+            try:
+                stale = BinaryDocStore(path).fingerprint != get_source_fingerprint(source_path)
+            except ValueError:
+                pass
+        if stale:
+            build_docstore(source_path, path)
+    return BinaryDocStore(path)
@@ -0,0 +1,81 @@
+import math
+import typing as t
+
+import numpy as np
+from llama_index.core.schema import BaseNode, TextNode, NodeWithScore
+from llama_index.core.vector_stores.utils import legacy_metadata_dict_to_node, metadata_dict_to_node
+
+class BlockVectorIndex(object):
+    """Exact search over collection vectors stored as scaled concatenations of blocks.
+
+    A query of the form `[v_1 | ... | v_B] * scale` is searched for every combination of
+    variants of each block without materializing the concatenations: the inner product with a
+    stored vector is the sum of per-block inner products, so each block variant is scored once
+    and the scores of all combinations are assembled by broadcasting.
+    """
+
+    def __init__(self, ids: t.List[str], embeddings: np.ndarray, metadatas: t.List[t.Dict], documents: t.List[str], space: str = 'l2'):
+        if space not in ['l2', 'ip', 'cosine']:
+            raise ValueError(f'Unsupported distance space: {space}')
+        self.ids = ids
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.metadatas = metadatas
+        self.documents = documents
+        self.space = space
+        self.norms = np.einsum('ij,ij->i', self.embeddings, self.embeddings, dtype=np.float64)
+
+    @classmethod
+    def from_collection(cls, collection) -> 'BlockVectorIndex':
+        res = collection.get(include=['embeddings', 'metadatas', 'documents'])
+        space = (collection.metadata or {}).get('hnsw:space', 'l2')
+        embeddings = res['embeddings'] if len(res['ids']) > 0 else np.zeros((0, 0), dtype=np.float32)
+        return cls(res['ids'], embeddings, res['metadatas'], res['documents'], space=space)
+
+    def get_node(self, idx: int) -> BaseNode:
+        # rebuilt from the stored metadata the same way as ChromaVectorStore._query
+        metadata, text = self.metadatas[idx] or {}, self.documents[idx]
+        try:
+            return metadata_dict_to_node(metadata, text=text)
+        except Exception:
+            metadata, node_info, relationships = legacy_metadata_dict_to_node(metadata)
+            return TextNode(text=text or '', id_=self.ids[idx], metadata=metadata, start_char_idx=node_info.get('start', None), end_char_idx=node_info.get('end', None), relationships=relationships)
+
+    def _block_scores(self, block_variants: t.List[np.ndarray], scale: float) -> t.Tuple[np.ndarray, np.ndarray]:
+        # inner products and squared norms of every combination, shaped (n_1, ..., n_B, N) and (n_1, ..., n_B, 1)
+        dims = [v.shape[1] for v in block_variants]
+        if sum(dims) != self.embeddings.shape[1]:
+            raise ValueError(f'Block dimensions {dims} do not add up to the index dimension {self.embeddings.shape[1]}')
+        dots = np.zeros([1] * len(block_variants) + [len(self.ids)])
+        query_norms = np.zeros([1] * (len(block_variants) + 1))
+        offset = 0
+        for b, variants in enumerate(block_variants):
+            block_dots = (variants @ self.embeddings[:, offset:offset + dims[b]].T).astype(np.float64) * scale
+            block_norms = np.einsum('ij,ij->i', variants, variants, dtype=np.float64) * scale * scale
+            shape = [1] * len(block_variants)
+            shape[b] = variants.shape[0]
+            dots = dots + block_dots.reshape(shape + [len(self.ids)])
+            query_norms = query_norms + block_norms.reshape(shape + [1])
+            offset += dims[b]
+        return dots, query_norms
+
+    def search_product(self, block_variants: t.List[t.List[t.List[float]]], scale: float, similarity_top_k: int) -> t.Dict[t.Tuple[int, ...], t.List[NodeWithScore]]:
+        """Return the top-k nodes, scored like ChromaVectorStore (exp(-distance)), for every combination of block variants."""
+        variants = [np.asarray(v, dtype=np.float32).reshape(len(v), -1) for v in block_variants]
+        if len(self.ids) == 0 or any([v.shape[0] == 0 for v in variants]):
+            return {}
+        dots, query_norms = self._block_scores(variants, scale)
+        if self.space == 'l2':
+            distances = query_norms + self.norms - 2 * dots
+        elif self.space == 'ip':
+            distances = 1.0 - dots
+        else:
+            distances = 1.0 - dots / np.maximum(np.sqrt(query_norms) * np.sqrt(self.norms), 1e-30)
+        distances = distances.reshape(-1, len(self.ids))
+        k = min(similarity_top_k, len(self.ids))
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < len(self.ids) else np.tile(np.arange(len(self.ids)), (distances.shape[0], 1))
+        results = {}
+        for row, combination in enumerate(np.ndindex(*[v.shape[0] for v in variants])):
+            # break distance ties by collection order
+            order = top[row][np.lexsort((top[row], distances[row, top[row]]))]
+            results[combination] = [NodeWithScore(node=self.get_node(idx), score=math.exp(-distances[row, idx])) for idx in order]
+        return results
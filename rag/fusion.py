@@ -0,0 +1,116 @@
+import typing as t
+from collections import defaultdict
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore
+
+class FusionInput(object):
+    """Result lists flattened into (query row, candidate column, score) entries, with candidates keyed by node id.
+
+    Entries are kept in result order, and sums are accumulated row by row with `np.add.at`,
+    so fused scores are bit-identical to adding them up one result list at a time.
+    """
+
+    def __init__(self, results: t.Dict[t.Tuple[str, int], t.List[NodeWithScore]]):
+        self.nodes: t.List[NodeWithScore] = []
+        rows = []
+        for row, nodes_with_scores in enumerate(results.values()):
+            self.nodes.extend(nodes_with_scores)
+            rows.extend([row] * len(nodes_with_scores))
+        self.num_rows = len(results)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.retrievers = np.asarray([query_tuple[1] for query_tuple in results], dtype=np.int64)
+        self.node_ids = np.asarray([n.node.id_ for n in self.nodes], dtype=object)
+        self.scores = np.asarray([n.score if n.score is not None else 0.0 for n in self.nodes], dtype=np.float64)
+
+    def rows_per_retriever(self) -> np.ndarray:
+        # number of queries sent to the retriever of each row
+        counts = np.bincount(self.retrievers, minlength=self.retrievers.max() + 1 if self.num_rows > 0 else 0)
+        return counts[self.retrievers]
+
+    def columns(self, order: np.ndarray) -> t.Tuple[np.ndarray, int]:
+        # number candidates by their first appearance when entries are visited in `order`
+        _, first, inverse = np.unique(self.node_ids[order].astype(str), return_index=True, return_inverse=True)
+        rank_of_unique = np.empty(len(first), dtype=np.int64)
+        rank_of_unique[np.argsort(first, kind='stable')] = np.arange(len(first))
+        cols = np.empty(len(order), dtype=np.int64)
+        cols[order] = rank_of_unique[inverse.reshape(-1)]
+        return cols, len(first)
+
+    def row_stats(self, values: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+        # sequential per-row sums (matching Python's sum) and row lengths
+        lengths = np.bincount(self.rows, minlength=self.num_rows)
+        sums = np.zeros(self.num_rows)
+        np.add.at(sums, self.rows, values)
+        return sums, lengths
+
+def reciprocal_rank_fusion(results: t.Dict[t.Tuple[str, int], t.List[NodeWithScore]], k: float = 60.0) -> t.Tuple[t.List[NodeWithScore], t.Dict[str, t.List[t.Tuple[int, float]]]]:
+    fusion = FusionInput(results)
+    if len(fusion.nodes) == 0:
+        return [], {}
+    # rank within each result list by descending score, keeping the list order of ties
+    order = np.lexsort((np.arange(len(fusion.nodes)), -fusion.scores, fusion.rows))
+    row_starts = np.searchsorted(fusion.rows[order], np.arange(fusion.num_rows))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - row_starts[fusion.rows[order]]
+    contributions = 1.0 / (ranks + k) / fusion.rows_per_retriever()[fusion.rows]
+
+    cols, num_cols = fusion.columns(order)
+    fused = np.zeros(num_cols)
+    np.add.at(fused, cols[order], contributions[order])
+    # the node reported for a candidate is its last occurrence
+    last_pos = np.full(num_cols, -1, dtype=np.int64)
+    np.maximum.at(last_pos, cols[order], np.arange(len(order)))
+    last = order[last_pos]
+
+    reranked_nodes = []
+    retriever_records = defaultdict(list)
+    for node_id, retriever_idx, contribution in zip(fusion.node_ids[order].tolist(), fusion.retrievers[fusion.rows[order]].tolist(), contributions[order].tolist()):
+        retriever_records[node_id].append((retriever_idx, contribution))
+    last, fused = last.tolist(), fused.tolist()
+    for col in np.argsort(-np.asarray(fused), kind='stable').tolist():
+        node_with_score = fusion.nodes[last[col]]
+        node_with_score.score = fused[col]
+        reranked_nodes.append(node_with_score)
+    return reranked_nodes, retriever_records
+
+def relative_score_fusion(results: t.Dict[t.Tuple[str, int], t.List[NodeWithScore]], retriever_weights: t.List[float], dist_based: bool = False) -> t.List[NodeWithScore]:
+    fusion = FusionInput(results)
+    if len(fusion.nodes) == 0:
+        return []
+    rows = fusion.rows
+    if dist_based:
+        # min and max from the mean and std dev of each result list
+        sums, lengths = fusion.row_stats(fusion.scores)
+        means = sums / np.maximum(lengths, 1)
+        # float_power calls C pow like Python's `**`, numpy's `**` takes different fast paths
+        sq_sums, _ = fusion.row_stats(np.float_power(fusion.scores - means[rows], 2.0))
+        std_devs = np.float_power(sq_sums / np.maximum(lengths, 1), 0.5)
+        min_scores, max_scores = means - 3 * std_devs, means + 3 * std_devs
+    else:
+        min_scores = np.full(fusion.num_rows, np.inf)
+        max_scores = np.full(fusion.num_rows, -np.inf)
+        np.minimum.at(min_scores, rows, fusion.scores)
+        np.maximum.at(max_scores, rows, fusion.scores)
+    min_scores, max_scores = min_scores[rows], max_scores[rows]
+    same = max_scores == min_scores
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(same, np.where(max_scores > 0, 1.0, 0.0), (fusion.scores - min_scores) / (max_scores - min_scores))
+    scores = scores * np.asarray(retriever_weights, dtype=np.float64)[fusion.retrievers[rows]]
+    scores = scores / fusion.rows_per_retriever()[rows]
+
+    order = np.arange(len(fusion.nodes))
+    cols, num_cols = fusion.columns(order)
+    fused = np.zeros(num_cols)
+    np.add.at(fused, cols, scores)
+    # the node reported for a candidate is its first occurrence
+    first = np.full(num_cols, len(order), dtype=np.int64)
+    np.minimum.at(first, cols, order)
+
+    fused_nodes = []
+    first, fused = first.tolist(), fused.tolist()
+    for col in np.argsort(-np.asarray(fused), kind='stable').tolist():
+        node_with_score = fusion.nodes[first[col]]
+        node_with_score.score = fused[col]
+        fused_nodes.append(node_with_score)
+    return fused_nodes
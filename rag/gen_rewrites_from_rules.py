@@ -3,60 +3,53 @@ import asyncio
 import json
 import typing as t
 import re
-from llama_index.core.async_utils import run_async_tasks
+import functools
 import logging
 from difflib import Differ 
 from copy import deepcopy
 
 from rag.prompts import *
 from my_rewriter.rewrite import get_normal_rules
-from my_rewriter.rewrite import match_all_rules, match_normal_rules
-
-calcite_rules: t.Dict[str, str] = {}
-with open('../explain_rule/calcite_rewrite_rules_structured.jsonl', 'r') as fin:
-    for line in fin.readlines():
-        rule = json.loads(line)
-        rule_name = rule['name']
-        sub_rules = rule['rewrite_rules_structured']
-        sub_rules_str = '\n'.join([f'Case {i+1}:\n**Conditions**: {r["conditions"]}\n**Transformations**: {r["transformations"]}' for i, r in enumerate(sub_rules)]) if len(sub_rules) > 1 else f'**Conditions**: {sub_rules[0]["conditions"]}\n**Transformations**: {sub_rules[0]["transformations"]}'
-        calcite_rules[rule_name] = sub_rules_str
-
-rule_descriptions = {}
-with open('../knowledge-base/rule_cluster_summaries_structured.jsonl', 'r') as fin:
-    for line in fin:
-        rule = json.loads(line)
-        conditions = rule['conditions']
-        transformations = rule['transformations']
-        rule_descriptions[rule['index']] = f'**Conditions**: {conditions}\n**Transformations**: {transformations}'
-
-rules_path = '../knowledge-base/rule_cluster_funcs'
-for file in os.listdir(rules_path):
-    filename = os.sep.join([rules_path, file])
-    func_str = open(filename, 'r').read()
-    exec(func_str, globals())
-
-RULE_FUNCTIONS = [can_be_optimized_by_index_transformation, can_be_optimized_by_index_pushdown, can_be_optimized_by_having, can_be_optimized_by_subquery_to_join, can_be_optimized_by_index_like, can_be_optimized_by_index_block, can_be_optimized_by_and_or, can_be_optimized_by_multiple_indexes,can_be_optimized_by_outer_join, can_be_optimized_by_index_scan, can_be_optimized_by_set_op, can_be_optimized_by_right_join, can_be_optimized_by_inner_join_on, can_be_optimized_by_tight_index_scan, can_be_optimized_by_filter_first_group_by_last, can_be_optimized_by_group_by_first, can_be_optimized_by_limit, can_be_optimized_by_cte_filter_first_group_by_last, can_be_optimized_by_distinct, can_be_optimized_by_function, can_be_optimized_by_order_by_index, can_be_optimized_by_null, can_be_optimized_by_window_order_over, can_be_optimized_by_multiple_table_scan, can_be_optimized_by_non_deterministic_function, can_be_optimized_by_constant_folding, can_be_optimized_by_out_of_range, can_be_optimized_by_index_min_max, can_be_optimized_by_condition_pushdown, can_be_optimized_by_subquery_to_exists]
-
-NL_RULES: t.List[str] = [r.__name__ for r in RULE_FUNCTIONS]
-NORMAL_RULES: t.List[str] = get_normal_rules()
-
-def match_nl_rules(sql: str, schema: str) -> t.List[t.Dict]:
-    rules = []
-    for i,func in enumerate(RULE_FUNCTIONS):
-        try:
-            res = func(sql, schema)
-            if res:
-                rule = {'name': func.__name__, 'description': rule_descriptions[i]}
-                if isinstance(res, str):
-                    rule['hint'] = res
-                rules.append(rule)
-        except Exception as e:
-            logging.warn(e)
-    return rules
+from my_rewriter.rewrite import match_all_rules, match_normal_rules, split_schema
+from my_rewriter.rewrite_pool import get_rewrite_pool, match_all_rules_batch
+from rag.nl_rules import NL_RULES, match_nl_rules, get_rule_descriptions, get_rule_functions
+
+@functools.lru_cache(maxsize=None)
+def get_calcite_rules() -> t.Dict[str, str]:
+    calcite_rules = {}
+    with open('../explain_rule/calcite_rewrite_rules_structured.jsonl', 'r') as fin:
+        for line in fin.readlines():
+            rule = json.loads(line)
+            rule_name = rule['name']
+            sub_rules = rule['rewrite_rules_structured']
+            sub_rules_str = '\n'.join([f'Case {i+1}:\n**Conditions**: {r["conditions"]}\n**Transformations**: {r["transformations"]}' for i, r in enumerate(sub_rules)]) if len(sub_rules) > 1 else f'**Conditions**: {sub_rules[0]["conditions"]}\n**Transformations**: {sub_rules[0]["transformations"]}'
+            calcite_rules[rule_name] = sub_rules_str
+    return calcite_rules
+
+@functools.lru_cache(maxsize=None)
+def get_normal_rule_names() -> t.List[str]:
+    # starts the JVM
+    return get_normal_rules()
+
+def __getattr__(name: str) -> t.Any:
+    # the rule KB and the JVM are loaded on first use rather than on import
+    if name == 'calcite_rules':
+        return get_calcite_rules()
+    if name == 'NORMAL_RULES':
+        return get_normal_rule_names()
+    if name == 'rule_descriptions':
+        return get_rule_descriptions()
+    if name == 'RULE_FUNCTIONS':
+        return get_rule_functions()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 def match_calcite_rules(sql: str, schema: str) -> t.List[t.Dict]:
-    create_tables = [x for x in schema.split(';') if x.strip() != '']
-    rule_objs = match_all_rules(sql, create_tables)
+    create_tables = split_schema(schema)
+    pool = get_rewrite_pool()
+    if pool is not None:
+        rule_objs = match_all_rules_batch(pool, [(sql, create_tables)])[0]
+    else:
+        rule_objs = match_all_rules(sql, create_tables)
     
     rules = []
     for r in rule_objs:
@@ -64,7 +57,7 @@ def match_calcite_rules(sql: str, schema: str) -> t.List[t.Dict]:
         rule_type = str(r['type'])
         plan_before = str(r['plan_before'])
         plan_after = str(r['plan_after'])
-        sub_rules = calcite_rules[rule_name]
+        sub_rules = get_calcite_rules()[rule_name]
         rules.append({'name': rule_name, 'type': rule_type, 'plan_before': plan_before, 'plan_after': plan_after, 'sub_rules': sub_rules})
     return rules
 
@@ -153,6 +146,7 @@ def gen_rewrites_from_rules(sql: str, schema: str, fun: t.Callable, verbose: boo
     tasks = []
     tasks.append(gen_rewrites_from_calcite_rules(sql, matched_calcite_rules, fun))
     tasks.append(gen_rewrites_from_nl_rules(sql, matched_nl_rules, fun))
+    from llama_index.core.async_utils import run_async_tasks
     task_results = run_async_tasks(tasks)
     rewrites = {}
     for name, res in zip(task_names, task_results):
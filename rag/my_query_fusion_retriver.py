@@ -6,6 +6,7 @@ import openai
 import time
 import logging
 import math
+import itertools
 
 from llama_index.core.async_utils import run_async_tasks
 from llama_index.core.callbacks.base import CallbackManager
@@ -20,7 +21,12 @@ from llama_index.core.storage.docstore import BaseDocumentStore
 from llama_index.core.base.llms.types import ChatMessage, LogProb, CompletionResponse
 
 from rag.gen_sql_templates import gen_sql_templates
-from rag.gen_rewrites_from_rules import gen_rewrites_from_rules, get_one_hot, NL_RULES, NORMAL_RULES
+from rag.gen_rewrites_from_rules import gen_rewrites_from_rules, get_one_hot, get_normal_rule_names, NL_RULES
+from rag.block_index import BlockVectorIndex
+from rag.fusion import reciprocal_rank_fusion, relative_score_fusion
+from rag.reference_index import ReferenceIndex
+from my_rewriter.my_utils import chat, achat
+from my_rewriter.embedding_cache import get_query_embeddings
 
 
 class FUSION_MODES(str, Enum):
@@ -47,6 +53,8 @@ class MyQueryFusionRetriever(BaseRetriever):
         callback_manager: Optional[CallbackManager] = None,
         objects: Optional[List[IndexNode]] = None,
         object_map: Optional[dict] = None,
+        block_index: Optional[BlockVectorIndex] = None,
+        reference_index: Optional[ReferenceIndex] = None,
     ) -> None:
         self.docstore = docstore
         self.embed_dim = embed_dim
@@ -56,6 +64,8 @@ class MyQueryFusionRetriever(BaseRetriever):
         self.use_async = use_async
 
         self._retrievers = [qa_retriever]
+        self._block_index = block_index
+        self._reference_index = reference_index if reference_index is not None else ReferenceIndex.empty()
         self._queries = dict()
         self._retriever_weights = [1.0]
         self._llm = (
@@ -69,24 +79,12 @@ class MyQueryFusionRetriever(BaseRetriever):
         )
 
     def _chat(self, messages: List[Dict]) -> str:
-        chat_messages = [ChatMessage(**m) for m in messages]
-        start = time.time()
-        response = self._llm.chat(chat_messages)
-        logging.debug({'messages': messages, 'response': response.message.content, 'time': time.time() - start})
-        return response.message.content
+        return chat(messages, model=self._llm)
     
     async def _achat(self, messages: List[Dict]) -> str:
-        chat_messages = [ChatMessage(**m) for m in messages]
-        start = time.time()
-        try:
-            response = await self._llm.achat(chat_messages)
-        except (ConnectionResetError, openai.APIConnectionError):
-            time.sleep(5)
-            response = await self._llm.achat(chat_messages)
-        logging.debug({'messages': messages, 'response': response.message.content, 'time': time.time() - start})
-        return response.message.content
+        return await achat(messages, model=self._llm)
 
-    def _get_queries(self, original_query: str) -> List[QueryBundle]:
+    def _get_query_blocks(self, original_query: str) -> List[List[Tuple[str, List[float]]]]:
         rewrites, matched_rules = gen_rewrites_from_rules(sql=original_query, schema=self.schema, fun=self._achat, verbose=self._verbose)
 
         for k, v in rewrites.items():
@@ -103,7 +101,7 @@ class MyQueryFusionRetriever(BaseRetriever):
 
         rules_one_hot: List[float] = []
         rules_one_hot.extend(get_one_hot(NL_RULES, matched_rules['nl']))
-        rules_one_hot.extend(get_one_hot(NORMAL_RULES, matched_rules['calcite_normal']))
+        rules_one_hot.extend(get_one_hot(get_normal_rule_names(), matched_rules['calcite_normal']))
         one_cnt = sum(rules_one_hot)
         if one_cnt > 0:
             rules_one_hot = [x / math.sqrt(one_cnt) for x in rules_one_hot]
@@ -115,18 +113,40 @@ class MyQueryFusionRetriever(BaseRetriever):
             sql_templates_str = "\n".join([f'Template {i + 1}: {q}' for i, q in enumerate(sql_templates)])
             logging.info(f"Generated SQL templates:\n{sql_templates_str}")
 
-        query_with_embeddings = [{'query': q, 'embedding': Settings.embed_model.get_query_embedding(q)} for q in queries]
-        sql_template_with_embeddings = [{'query': q, 'embedding': Settings.embed_model.get_query_embedding(q)} for q in sql_templates]
+        embeddings = get_query_embeddings(queries + sql_templates)
+        query_with_embeddings = [{'query': q, 'embedding': e} for q, e in zip(queries, embeddings[:len(queries)])]
+        sql_template_with_embeddings = [{'query': q, 'embedding': e} for q, e in zip(sql_templates, embeddings[len(queries):])]
         if len(sql_templates) == 0:
             sql_template_with_embeddings = [{'query': '', 'embedding': [0] * self.embed_dim}]
+        return [
+            [(q['query'], q['embedding']) for q in query_with_embeddings],
+            [(original_query, rules_one_hot)],
+            [(t['query'], t['embedding']) for t in sql_template_with_embeddings]
+        ]
+
+    def _get_queries(self, original_query: str) -> List[QueryBundle]:
+        # each synthesized query concatenates one variant of every block
+        blocks = self._get_query_blocks(original_query)
         synthesized_queries = []
-        for q in query_with_embeddings:
-            for t in sql_template_with_embeddings:
-                embedding = [x / math.sqrt(3) for x in q['embedding'] + rules_one_hot + t['embedding']]
-                synthesized_queries.append(QueryBundle(f'{q["query"]}\n{original_query}\n{t["query"]}', embedding=embedding))
+        for combination in itertools.product(*blocks):
+            embedding = [x / math.sqrt(len(blocks)) for _, e in combination for x in e]
+            synthesized_queries.append(QueryBundle('\n'.join([q for q, _ in combination]), embedding=embedding))
 
         return synthesized_queries
 
+    def _run_block_queries(
+        self, query_str: str
+    ) -> Dict[Tuple[str, int], List[NodeWithScore]]:
+        blocks = self._get_query_blocks(query_str)
+        block_results = self._block_index.search_product([[e for _, e in block] for block in blocks], 1 / math.sqrt(len(blocks)), self.similarity_top_k)
+
+        results = {}
+        for combination, query_result in block_results.items():
+            query = '\n'.join([blocks[b][i][0] for b, i in enumerate(combination)])
+            results[(query, 0)] = query_result
+
+        return results
+
     def _reciprocal_rerank_fusion(
         self, results: Dict[Tuple[str, int], List[NodeWithScore]]
     ) -> List[NodeWithScore]:
@@ -136,45 +156,12 @@ class MyQueryFusionRetriever(BaseRetriever):
         The original paper uses k=60 for best results:
         https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
         """
-
-        retriever_num_queries = defaultdict(int)
-        for query_tuple in results:
-            retriever_num_queries[query_tuple[1]] += 1
-        
-        k = 60.0  # `k` is a parameter used to control the impact of outlier rankings.
-        fused_scores = {}
-        text_to_node = {}
-        retriever_records = defaultdict(list)
-
-        # compute reciprocal rank scores
-        for query_tuple, nodes_with_scores in results.items():
-            for rank, node_with_score in enumerate(
-                sorted(nodes_with_scores, key=lambda x: x.score or 0.0, reverse=True)
-            ):
-                text = node_with_score.node.get_content()
-                text_to_node[text] = node_with_score
-                if text not in fused_scores:
-                    fused_scores[text] = 0.0
-                retriever_idx = query_tuple[1]
-                cur_score = 1.0 / (rank + k) / retriever_num_queries[retriever_idx]
-                fused_scores[text] += cur_score
-                retriever_records[text].append((retriever_idx, cur_score))
-
-        # sort results
-        reranked_results = dict(
-            sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
-        )
-
-        # adjust node scores
-        reranked_nodes: List[NodeWithScore] = []
-        for text, score in reranked_results.items():
-            reranked_nodes.append(text_to_node[text])
-            reranked_nodes[-1].score = score
+        reranked_nodes, retriever_records = reciprocal_rank_fusion(results, k=60.0)
 
         # log retriever records
         reranked_retriever_records = []
         for n in reranked_nodes:
-            reranked_retriever_records.append({'index': n.id_, 'retriever_records': retriever_records[n.node.get_content()]})
+            reranked_retriever_records.append({'index': n.id_, 'retriever_records': retriever_records[n.id_]})
         logging.debug(f'Reranked Retriever Records: {reranked_retriever_records}')
 
         return reranked_nodes
@@ -185,60 +172,9 @@ class MyQueryFusionRetriever(BaseRetriever):
         dist_based: Optional[bool] = False,
     ) -> List[NodeWithScore]:
         """Apply relative score fusion."""
-        # MinMax scale scores of each result set (highest value becomes 1, lowest becomes 0)
-        # then scale by the weight of the retriever
-        min_max_scores = {}
-        for query_tuple, nodes_with_scores in results.items():
-            if not nodes_with_scores:
-                min_max_scores[query_tuple] = (0.0, 0.0)
-                continue
-            scores = [node_with_score.score for node_with_score in nodes_with_scores]
-            if dist_based:
-                # Set min and max based on mean and std dev
-                mean_score = sum(scores) / len(scores)
-                std_dev = (
-                    sum((x - mean_score) ** 2 for x in scores) / len(scores)
-                ) ** 0.5
-                min_score = mean_score - 3 * std_dev
-                max_score = mean_score + 3 * std_dev
-            else:
-                min_score = min(scores)
-                max_score = max(scores)
-            min_max_scores[query_tuple] = (min_score, max_score)
-
-        retriever_num_queries = defaultdict(int)
-        for query_tuple in results:
-            retriever_num_queries[query_tuple[1]] += 1
-
-        for query_tuple, nodes_with_scores in results.items():
-            for node_with_score in nodes_with_scores:
-                min_score, max_score = min_max_scores[query_tuple]
-                # Scale the score to be between 0 and 1
-                if max_score == min_score:
-                    node_with_score.score = 1.0 if max_score > 0 else 0.0
-                else:
-                    node_with_score.score = (node_with_score.score - min_score) / (
-                        max_score - min_score
-                    )
-                # Scale by the weight of the retriever
-                retriever_idx = query_tuple[1]
-                node_with_score.score *= self._retriever_weights[retriever_idx]
-                # Divide by the number of queries
-                node_with_score.score /= retriever_num_queries[retriever_idx]
-
-        # Use a dict to de-duplicate nodes
-        all_nodes: Dict[str, NodeWithScore] = {}
-
-        # Sum scores for each node
-        for nodes_with_scores in results.values():
-            for node_with_score in nodes_with_scores:
-                text = node_with_score.node.get_content()
-                if text in all_nodes:
-                    all_nodes[text].score += node_with_score.score
-                else:
-                    all_nodes[text] = node_with_score
-
-        return sorted(all_nodes.values(), key=lambda x: x.score or 0.0, reverse=True)
+        # MinMax scale scores of each result set (highest value becomes 1, lowest becomes 0),
+        # scale by the weight of the retriever and sum the scores of each node
+        return relative_score_fusion(results, self._retriever_weights, dist_based=bool(dist_based))
 
     def _simple_fusion(
         self, results: Dict[Tuple[str, int], List[NodeWithScore]]
@@ -301,29 +237,30 @@ class MyQueryFusionRetriever(BaseRetriever):
 
         return results
 
-    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
-        queries: List[List[QueryBundle]] = []
-        synthesized_queries = self._get_queries(query_bundle.query_str)
-        queries.append(synthesized_queries)
+    def _expand_references(
+        self, results: Dict[Tuple[str, int], List[NodeWithScore]]
+    ) -> None:
+        # replace index hits by the StackOverflow answers they reference, fetching every answer once
+        node_id_to_score_maps = {query_tuple: self._reference_index.expand(nodes_with_scores) for query_tuple, nodes_with_scores in results.items()}
+        all_node_ids = list(dict.fromkeys([id for m in node_id_to_score_maps.values() for id in m]))
+        id_to_node = dict(zip(all_node_ids, self.docstore.get_nodes(all_node_ids)))
+        for query_tuple, node_id_to_score_map in node_id_to_score_maps.items():
+            results[query_tuple] = [NodeWithScore(node=id_to_node[id], score=score) for id, score in node_id_to_score_map.items()]
 
-        if self.use_async:
-            results = self._run_nested_async_queries(queries)
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._block_index is not None:
+            results = self._run_block_queries(query_bundle.query_str)
         else:
-            results = self._run_sync_queries(queries)
-
-        for (q, i) in results:
-            node_id_to_score_map = {}
-            for cur_node in results[(q, i)]:
-                cur_node_ids = eval(cur_node.metadata['references'])
-                for cur_node_id in cur_node_ids:
-                    if cur_node_id in node_id_to_score_map:
-                        node_id_to_score_map[cur_node_id] = max(node_id_to_score_map[cur_node_id], cur_node.get_score())
-                    else:
-                        node_id_to_score_map[cur_node_id] = cur_node.get_score()
-            node_ids = node_id_to_score_map.keys()
-            nodes = self.docstore.get_nodes(node_ids)
-            node_with_scores = [NodeWithScore(node=n, score=node_id_to_score_map[id]) for id, n in zip(node_ids, nodes)]
-            results[(q, i)] = node_with_scores
+            queries: List[List[QueryBundle]] = []
+            synthesized_queries = self._get_queries(query_bundle.query_str)
+            queries.append(synthesized_queries)
+
+            if self.use_async:
+                results = self._run_nested_async_queries(queries)
+            else:
+                results = self._run_sync_queries(queries)
+
+        self._expand_references(results)
 
         if self.mode == FUSION_MODES.RECIPROCAL_RANK:
             return self._reciprocal_rerank_fusion(results)[: self.similarity_top_k]
@@ -339,25 +276,16 @@ class MyQueryFusionRetriever(BaseRetriever):
             raise ValueError(f"Invalid fusion mode: {self.mode}")
 
     async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
-        queries: List[List[QueryBundle]] = []
-        synthesized_queries = self._get_queries(query_bundle.query_str)
-        queries.append(synthesized_queries)
-
-        results = await self._run_async_queries(queries)
-
-        for (q, i) in results:
-            node_id_to_score_map = {}
-            for cur_node in results[(q, i)]:
-                cur_node_ids = eval(cur_node.metadata['references'])
-                for cur_node_id in cur_node_ids:
-                    if cur_node_id in node_id_to_score_map:
-                        node_id_to_score_map[cur_node_id] = max(node_id_to_score_map[cur_node_id], cur_node.get_score())
-                    else:
-                        node_id_to_score_map[cur_node_id] = cur_node.get_score()
-            node_ids = node_id_to_score_map.keys()
-            nodes = self.docstore.get_nodes(node_ids)
-            node_with_scores = [NodeWithScore(node=n, score=node_id_to_score_map[id]) for id, n in zip(node_ids, nodes)]
-            results[(q, i)] = node_with_scores
+        if self._block_index is not None:
+            results = self._run_block_queries(query_bundle.query_str)
+        else:
+            queries: List[List[QueryBundle]] = []
+            synthesized_queries = self._get_queries(query_bundle.query_str)
+            queries.append(synthesized_queries)
+
+            results = await self._run_async_queries(queries)
+
+        self._expand_references(results)
 
         if self.mode == FUSION_MODES.RECIPROCAL_RANK:
             return self._reciprocal_rerank_fusion(results)[: self.similarity_top_k]
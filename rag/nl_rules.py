@@ -0,0 +1,233 @@
+import os
+import json
+import signal
+import logging
+import functools
+import threading
+import contextvars
+import multiprocessing
+import typing as t
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import sqlglot
+from sqlglot import exp
+
+from my_rewriter.config import NL_RULE_WORKERS, NL_RULE_TIMEOUT
+
+@functools.lru_cache(maxsize=None)
+def get_rule_descriptions() -> t.Dict[int, str]:
+    rule_descriptions = {}
+    with open('../knowledge-base/rule_cluster_summaries_structured.jsonl', 'r') as fin:
+        for line in fin:
+            rule = json.loads(line)
+            conditions = rule['conditions']
+            transformations = rule['transformations']
+            rule_descriptions[rule['index']] = f'**Conditions**: {conditions}\n**Transformations**: {transformations}'
+    return rule_descriptions
+
+@dataclass(frozen=True)
+class ParsedSQLContext:
+    """A query and its schema parsed once and shared by every NL rule matcher.
+
+    Rules receive copies of `ast` and `schema_statements`, so a rule that mutates its
+    tree (e.g. with `qualify`) cannot affect the rules matched after it.
+    """
+    sql: str
+    schema: t.Optional[str]
+    dialect: t.Optional[str]
+    ast: t.Optional[exp.Expression]
+    ast_error: t.Optional[Exception]
+    schema_statements: t.Tuple[t.Optional[exp.Expression], ...]
+    schema_error: t.Optional[Exception]
+
+@functools.lru_cache(maxsize=16)
+def parse_schema(schema: str, dialect: t.Optional[str] = None) -> t.Tuple[t.Tuple[t.Optional[exp.Expression], ...], t.Optional[Exception]]:
+    # schemas are shared by every query of a benchmark, so they are parsed once per process
+    try:
+        return tuple(sqlglot.parse(schema, dialect=dialect)), None
+    except Exception as e:
+        return (), e
+
+def parse_context(sql: str, schema: t.Optional[str], dialect: t.Optional[str] = None) -> ParsedSQLContext:
+    ast, ast_error = None, None
+    try:
+        ast = sqlglot.parse_one(sql, dialect=dialect)
+    except Exception as e:
+        ast_error = e
+    schema_statements, schema_error = (), None
+    if schema:
+        schema_statements, schema_error = parse_schema(schema, dialect)
+    return ParsedSQLContext(sql=sql, schema=schema, dialect=dialect, ast=ast, ast_error=ast_error, schema_statements=schema_statements, schema_error=schema_error)
+
+_current_context: contextvars.ContextVar[t.Optional[ParsedSQLContext]] = contextvars.ContextVar('nl_rule_context', default=None)
+
+class _ParseOnceSqlglot(object):
+    """Stands in for the `sqlglot` module inside the rule matchers.
+
+    `parse_one`/`parse` of the query and schema being matched return copies of the
+    trees in the current ParsedSQLContext; anything else goes to sqlglot.
+    """
+
+    def __getattr__(self, name: str) -> t.Any:
+        return getattr(sqlglot, name)
+
+    def parse_one(self, sql: str, read: t.Optional[str] = None, dialect: t.Optional[str] = None, **opts) -> exp.Expression:
+        context = _current_context.get()
+        if context is not None and not opts and sql == context.sql and (read or dialect) == context.dialect:
+            if context.ast_error is not None:
+                raise context.ast_error
+            return context.ast.copy()
+        return sqlglot.parse_one(sql, read=read, dialect=dialect, **opts)
+
+    def parse(self, sql: str, read: t.Optional[str] = None, dialect: t.Optional[str] = None, **opts) -> t.List[t.Optional[exp.Expression]]:
+        context = _current_context.get()
+        if context is not None and not opts and sql == context.schema and (read or dialect) == context.dialect:
+            if context.schema_error is not None:
+                raise context.schema_error
+            return [s.copy() if s is not None else None for s in context.schema_statements]
+        return sqlglot.parse(sql, read=read, dialect=dialect, **opts)
+
+def load_rule_functions(rules_path: str) -> t.Dict[str, t.Callable]:
+    funcs = {}
+    for file in os.listdir(rules_path):
+        filename = os.sep.join([rules_path, file])
+        namespace = {'__name__': f'rule_cluster_funcs.{os.path.splitext(file)[0]}'}
+        exec(open(filename, 'r').read(), namespace)
+        # bind after exec so that the rule file's own `import sqlglot` is overridden
+        namespace['sqlglot'] = _ParseOnceSqlglot()
+        for name, obj in namespace.items():
+            if name.startswith('can_be_optimized_by_') and callable(obj):
+                funcs[name] = obj
+    return funcs
+
+RULE_FUNCTION_NAMES = ['can_be_optimized_by_index_transformation', 'can_be_optimized_by_index_pushdown', 'can_be_optimized_by_having', 'can_be_optimized_by_subquery_to_join', 'can_be_optimized_by_index_like', 'can_be_optimized_by_index_block', 'can_be_optimized_by_and_or', 'can_be_optimized_by_multiple_indexes', 'can_be_optimized_by_outer_join', 'can_be_optimized_by_index_scan', 'can_be_optimized_by_set_op', 'can_be_optimized_by_right_join', 'can_be_optimized_by_inner_join_on', 'can_be_optimized_by_tight_index_scan', 'can_be_optimized_by_filter_first_group_by_last', 'can_be_optimized_by_group_by_first', 'can_be_optimized_by_limit', 'can_be_optimized_by_cte_filter_first_group_by_last', 'can_be_optimized_by_distinct', 'can_be_optimized_by_function', 'can_be_optimized_by_order_by_index', 'can_be_optimized_by_null', 'can_be_optimized_by_window_order_over', 'can_be_optimized_by_multiple_table_scan', 'can_be_optimized_by_non_deterministic_function', 'can_be_optimized_by_constant_folding', 'can_be_optimized_by_out_of_range', 'can_be_optimized_by_index_min_max', 'can_be_optimized_by_condition_pushdown', 'can_be_optimized_by_subquery_to_exists']
+
+NL_RULES: t.List[str] = list(RULE_FUNCTION_NAMES)
+
+@functools.lru_cache(maxsize=None)
+def get_rule_functions() -> t.List[t.Callable]:
+    rule_functions = load_rule_functions('../knowledge-base/rule_cluster_funcs')
+    return [rule_functions[name] for name in RULE_FUNCTION_NAMES]
+
+def __getattr__(name: str) -> t.Any:
+    # the rule KB is read on first use rather than on import
+    if name == 'rule_descriptions':
+        return get_rule_descriptions()
+    if name == 'RULE_FUNCTIONS':
+        return get_rule_functions()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def match_nl_rule(i: int, sql: str, schema: str, context: t.Optional[ParsedSQLContext] = None) -> t.Optional[t.Dict]:
+    func = get_rule_functions()[i]
+    try:
+        token = _current_context.set(context)
+        try:
+            res = func(sql, schema)
+        finally:
+            _current_context.reset(token)
+        if res:
+            rule = {'name': func.__name__, 'description': get_rule_descriptions()[i]}
+            if isinstance(res, str):
+                rule['hint'] = res
+            return rule
+    except Exception as e:
+        logging.warn(e)
+    return None
+
+def match_nl_rules(sql: str, schema: str, parse_once: bool = True, workers: t.Optional[int] = NL_RULE_WORKERS, timeout: t.Optional[float] = NL_RULE_TIMEOUT) -> t.List[t.Dict]:
+    if workers:
+        return match_nl_rules_batch([sql], schema, workers=workers, timeout=timeout)[0]
+    context = parse_context(sql, schema) if parse_once else None
+    rules = []
+    for i in range(len(RULE_FUNCTION_NAMES)):
+        rule = match_nl_rule(i, sql, schema, context=context)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+class RuleTimeout(BaseException):
+    # not an Exception, so that broad `except Exception` clauses inside the rules cannot swallow it
+    pass
+
+def _raise_rule_timeout(signum, frame):
+    raise RuleTimeout()
+
+def _init_worker(schemas: t.Tuple[str, ...]):
+    signal.signal(signal.SIGALRM, _raise_rule_timeout)
+    for schema in schemas:
+        if schema:
+            parse_schema(schema)
+
+def _ping() -> int:
+    return os.getpid()
+
+def _match_rules_task(sql: str, schema: str, rule_indices: t.List[int], timeout: t.Optional[float]) -> t.List[t.Tuple[int, t.Optional[t.Dict]]]:
+    context = parse_context(sql, schema)
+    res = []
+    for i in rule_indices:
+        rule = None
+        try:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                rule = match_nl_rule(i, sql, schema, context=context)
+            finally:
+                if timeout:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except RuleTimeout:
+            logging.warning(f'NL rule {NL_RULES[i]} timed out after {timeout}s')
+        res.append((i, rule))
+    return res
+
+_nl_rule_pool: t.Optional[ProcessPoolExecutor] = None
+_nl_rule_pool_workers = 0
+_nl_rule_pool_lock = threading.Lock()
+
+def start_nl_rule_pool(workers: int, schemas: t.Sequence[str] = ()) -> ProcessPoolExecutor:
+    global _nl_rule_pool, _nl_rule_pool_workers
+    with _nl_rule_pool_lock:
+        if _nl_rule_pool is not None and _nl_rule_pool_workers == workers:
+            return _nl_rule_pool
+        if _nl_rule_pool is not None:
+            _nl_rule_pool.shutdown()
+        # fork where available: workers inherit the loaded rules and do not re-run the caller's script
+        get_rule_functions()
+        get_rule_descriptions()
+        mp_context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker, initargs=(tuple(schemas),))
+        # pre-warm so that the first query does not pay for starting the workers
+        for future in [pool.submit(_ping) for _ in range(workers)]:
+            future.result()
+        _nl_rule_pool, _nl_rule_pool_workers = pool, workers
+        return pool
+
+def shutdown_nl_rule_pool():
+    global _nl_rule_pool, _nl_rule_pool_workers
+    with _nl_rule_pool_lock:
+        if _nl_rule_pool is not None:
+            _nl_rule_pool.shutdown()
+        _nl_rule_pool, _nl_rule_pool_workers = None, 0
+
+def match_nl_rules_batch(sqls: t.List[str], schema: str, workers: t.Optional[int] = NL_RULE_WORKERS, timeout: t.Optional[float] = NL_RULE_TIMEOUT) -> t.List[t.List[t.Dict]]:
+    if not workers or len(sqls) == 0:
+        return [match_nl_rules(sql, schema, workers=None) for sql in sqls]
+    pool = start_nl_rule_pool(workers, [schema])
+    # split the rules of each query into strided chunks so that a few queries still keep every worker busy
+    chunks = max(1, min(len(RULE_FUNCTION_NAMES), workers // len(sqls)))
+    matched = [{} for _ in sqls]
+    try:
+        futures = []
+        for q, sql in enumerate(sqls):
+            for c in range(chunks):
+                futures.append((q, pool.submit(_match_rules_task, sql, schema, list(range(c, len(RULE_FUNCTION_NAMES), chunks)), timeout)))
+        for q, future in futures:
+            for i, rule in future.result():
+                if rule is not None:
+                    matched[q][i] = rule
+    except BrokenProcessPool as e:
+        logging.warning(f'NL rule worker pool broke ({e}), matching serially')
+        shutdown_nl_rule_pool()
+        return [match_nl_rules(sql, schema, workers=None) for sql in sqls]
+    return [[m[i] for i in sorted(m)] for m in matched]
@@ -19,6 +19,7 @@ from llama_index.core import VectorStoreIndex, StorageContext, Settings
 
 sys.path.append('..')
 from my_rewriter.config import init_llms
+from rag.reference_index import write_reference_index
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--model', type=str, default='')
@@ -79,4 +80,5 @@ class MyVectorStoreIndex(VectorStoreIndex):
             results.append(result)
         return results
 
-index = MyVectorStoreIndex(index_nodes, storage_context=storage_context, show_progress=True)
\ No newline at end of file
+index = MyVectorStoreIndex(index_nodes, storage_context=storage_context, show_progress=True)
+write_reference_index('./chroma_db', 'stackoverflow_summary', index_nodes)
@@ -22,6 +22,7 @@ from llama_index.core import VectorStoreIndex, StorageContext, Settings
 sys.path.append('..')
 from rag.gen_rewrites_from_rules import NL_RULES, NORMAL_RULES
 from my_rewriter.config import init_llms
+from rag.reference_index import write_reference_index
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--model', type=str, default='')
@@ -154,4 +155,5 @@ class MyVectorStoreIndex(VectorStoreIndex):
             results.append(result)
         return results
 
-index = MyVectorStoreIndex(index_nodes, storage_context=storage_context, show_progress=True)
\ No newline at end of file
+index = MyVectorStoreIndex(index_nodes, storage_context=storage_context, show_progress=True)
+write_reference_index('./chroma_db', 'stackoverflow_structure', index_nodes)
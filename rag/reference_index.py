@@ -0,0 +1,123 @@
+import os
+import ast
+import logging
+import argparse
+import typing as t
+from collections import OrderedDict
+
+import numpy as np
+from llama_index.core.schema import BaseNode, NodeWithScore
+
+REFERENCE_INDEX_VERSION = 1
+
+def get_reference_index_path(chroma_path: str, collection_name: str) -> str:
+    return os.path.join(chroma_path, f'{collection_name}_references.npz')
+
+def parse_references(node: BaseNode) -> t.List[str]:
+    return ast.literal_eval(node.metadata['references'])
+
+class ReferenceIndex(object):
+    """CSR mapping from index node ids to the ids of the StackOverflow answers they reference.
+
+    The references of node row `i` are `ref_ids[indices[indptr[i]:indptr[i + 1]]]`. Nodes that
+    are not in the mapping (e.g. added after it was built) fall back to their `references` metadata.
+    """
+
+    def __init__(self, node_ids: t.List[str], indptr: np.ndarray, indices: np.ndarray, ref_ids: t.List[str]):
+        self.node_rows = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.ref_ids = list(ref_ids)
+
+    @classmethod
+    def from_references(cls, node_references: t.Dict[str, t.List[str]]) -> 'ReferenceIndex':
+        ref_rows = OrderedDict()
+        indptr = [0]
+        indices = []
+        for refs in node_references.values():
+            for ref_id in refs:
+                indices.append(ref_rows.setdefault(ref_id, len(ref_rows)))
+            indptr.append(len(indices))
+        return cls(list(node_references.keys()), np.asarray(indptr), np.asarray(indices), list(ref_rows.keys()))
+
+    @classmethod
+    def from_nodes(cls, nodes: t.Sequence[BaseNode]) -> 'ReferenceIndex':
+        return cls.from_references(OrderedDict([(node.node_id, parse_references(node)) for node in nodes]))
+
+    @classmethod
+    def from_collection(cls, collection) -> 'ReferenceIndex':
+        # the ids and flattened metadata that ChromaVectorStore stored for each node
+        res = collection.get(include=['metadatas'])
+        return cls.from_references(OrderedDict([(node_id, ast.literal_eval(metadata['references'])) for node_id, metadata in zip(res['ids'], res['metadatas']) if metadata and 'references' in metadata]))
+
+    @classmethod
+    def empty(cls) -> 'ReferenceIndex':
+        return cls([], np.zeros(1), np.zeros(0), [])
+
+    @classmethod
+    def load(cls, path: str) -> 'ReferenceIndex':
+        if not os.path.exists(path):
+            return cls.empty()
+        data = np.load(path, allow_pickle=False)
+        if int(data['version']) != REFERENCE_INDEX_VERSION:
+            return cls.empty()
+        return cls(data['node_ids'].tolist(), data['indptr'], data['indices'], data['ref_ids'].tolist())
+
+    def save(self, path: str):
+        node_ids = sorted(self.node_rows, key=self.node_rows.get)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fout:
+            np.savez(fout, version=np.asarray(REFERENCE_INDEX_VERSION), node_ids=np.asarray(node_ids, dtype=str), indptr=self.indptr, indices=self.indices, ref_ids=np.asarray(self.ref_ids, dtype=str))
+        os.replace(tmp_path, path)
+
+    def get(self, node: BaseNode) -> t.List[str]:
+        row = self.node_rows.get(node.node_id)
+        if row is None:
+            return parse_references(node)
+        return [self.ref_ids[i] for i in self.indices[self.indptr[row]:self.indptr[row + 1]].tolist()]
+
+    def expand(self, nodes_with_scores: t.List[NodeWithScore]) -> t.Dict[str, float]:
+        """Map hits to the answers they reference with each answer's best score, in order of first reference."""
+        rows = np.asarray([self.node_rows.get(n.node.node_id, -1) for n in nodes_with_scores], dtype=np.int64)
+        if len(rows) == 0 or (rows < 0).any():
+            ref_id_to_score = {}
+            for n in nodes_with_scores:
+                for ref_id in self.get(n.node):
+                    ref_id_to_score[ref_id] = max(ref_id_to_score[ref_id], n.get_score()) if ref_id in ref_id_to_score else n.get_score()
+            return ref_id_to_score
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        # positions of every reference of every hit, hit by hit
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        refs = self.indices[offsets + np.arange(counts.sum())]
+        scores = np.repeat(np.asarray([n.get_score() for n in nodes_with_scores], dtype=np.float64), counts)
+        unique_refs, first, inverse = np.unique(refs, return_index=True, return_inverse=True)
+        best = np.full(len(unique_refs), -np.inf)
+        np.maximum.at(best, inverse.reshape(-1), scores)
+        order = np.argsort(first, kind='stable')
+        return {self.ref_ids[ref]: score for ref, score in zip(unique_refs[order].tolist(), best[order].tolist())}
+
+def write_reference_index(chroma_path: str, collection_name: str, nodes: t.Sequence[BaseNode]):
+    index = ReferenceIndex.from_nodes(nodes)
+    index.save(get_reference_index_path(chroma_path, collection_name))
+    logging.info(f'Reference Index of {collection_name}: {len(index.node_rows)} nodes, {len(index.ref_ids)} references')
+
+def build_reference_index(chroma_path: str, collection_name: str, collection=None) -> ReferenceIndex:
+    """Build and save the reference index of an existing collection without re-embedding it."""
+    if collection is None:
+        import chromadb
+        collection = chromadb.PersistentClient(path=chroma_path).get_collection(collection_name)
+    index = ReferenceIndex.from_collection(collection)
+    index.save(get_reference_index_path(chroma_path, collection_name))
+    logging.info(f'Reference Index of {collection_name}: {len(index.node_rows)} nodes, {len(index.ref_ids)} references')
+    return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chroma_path', type=str, default='./chroma_db')
+    parser.add_argument('--collections', type=str, nargs='+', default=['stackoverflow', 'stackoverflow_summary', 'stackoverflow_structure'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for collection_name in args.collections:
+        build_reference_index(args.chroma_path, collection_name)